@@ -0,0 +1,70 @@
+"""
+用 M 个 RBP 模型给同一个推理 h5 打分：逐个模型各读一遍 h5（相当于每个 RBP 启动一次 --infer）与 --infer --rbp_list 的单次读取 + MultiRBPCNN 的速度对比。
+
+    python -m benchmarks.bench_multi_rbp --h5 data/predict_data/human_test.h5 --models 16 --stack_size 8
+
+模型为随机初始化的 CNN，只比较速度；两种方式的输出差异也会打印出来。不计入 RNAfold 折叠时间（--rbp_list 只折叠一次）。
+"""
+import argparse
+import time
+import numpy as np
+import torch
+
+from model_code.model import CNN, MultiRBPCNN
+from train_code.train_loop import stream_inference
+from utils import H5RangeDataset, create_h5_dataloader
+
+
+class MemoryWriter(object):
+    """Stands in for InferenceWriter and keeps the probabilities."""
+
+    def __init__(self):
+        self.path = None
+        self.probs = []
+
+    def write(self, labels, probs):
+        self.probs.append(np.asarray(probs).reshape(len(labels), -1))
+
+    def close(self):
+        pass
+
+
+def score(model, device, h5_file, batch_size, num_workers):
+    writer = MemoryWriter()
+    data_loader = create_h5_dataloader(H5RangeDataset([h5_file]), batch_size, shuffle=False, num_workers=num_workers)
+    stream_inference(model, device, data_loader, writer)
+    return np.concatenate(writer.probs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark multi-RBP inference against one pass per RBP.")
+    parser.add_argument('--h5', type=str, required=True, help='inference h5 file (written by --infer)')
+    parser.add_argument('--models', type=int, default=16, help='number of RBP models')
+    parser.add_argument('--stack_size', type=int, default=8, help='models per StackedCNN')
+    parser.add_argument('--batch_size', type=int, default=64, help='batch size')
+    parser.add_argument('--num_workers', type=int, default=0, help='DataLoader workers')
+    parser.add_argument('--gpuid', type=int, default=0, help='GPU to use if available')
+    args = parser.parse_args()
+
+    device = torch.device(f"cuda:{args.gpuid}" if torch.cuda.is_available() else "cpu")
+    torch.manual_seed(0)
+    models = [CNN().to(device).eval() for _ in range(args.models)]
+    windows = len(H5RangeDataset([args.h5]))
+
+    start = time.perf_counter()
+    per_rbp = np.concatenate([score(model, device, args.h5, args.batch_size, args.num_workers) for model in models], axis=1)
+    per_rbp_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    one_pass = score(MultiRBPCNN(models, args.stack_size).to(device).eval(), device, args.h5, args.batch_size, args.num_workers)
+    one_pass_time = time.perf_counter() - start
+
+    print(f"{args.models} models x {windows} windows, stack size {args.stack_size}, device {device}")
+    print(f"   one pass per RBP: {per_rbp_time:8.2f} s ({args.models * windows / per_rbp_time:.0f} window-scores/s)")
+    print(f"  single --rbp_list: {one_pass_time:8.2f} s ({args.models * windows / one_pass_time:.0f} window-scores/s, "
+          f"{per_rbp_time / one_pass_time:.2f}x)")
+    print(f"  max |diff| {np.abs(per_rbp - one_pass).max():.2e}")
+
+
+if __name__ == "__main__":
+    main()
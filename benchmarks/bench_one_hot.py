@@ -0,0 +1,62 @@
+"""
+逐条 one-hot 编码与批量编码的速度对比，并校验两者结果一致。
+
+    python -m benchmarks.bench_one_hot --n 1000000
+"""
+import argparse
+import time
+import numpy as np
+
+from data_gerenate.one_hot_encode_decode import *
+
+
+ENCODERS = [
+    ("seq_4", convert_one_hot_seq_4, convert_one_hot_seq_4_batch, "ACGUacgu"),
+    ("str_2", convert_one_hot_str_2, convert_one_hot_str_2_batch, "UP"),
+    ("str_4", convert_one_hot_str_4, convert_one_hot_str_4_batch, "PLUM"),
+    ("str_7", convert_one_hot_str_7, convert_one_hot_str_7_batch, "BEHLMRT"),
+    ("seq_str_8", convert_one_hot_seq_str_8, convert_one_hot_seq_str_8_batch, "ABCDEFGH"),
+    ("seq_str_16", convert_one_hot_seq_str_16, convert_one_hot_seq_str_16_batch, "ABCDEFGHIJKLMNOP"),
+    ("seq_str_28", convert_one_hot_seq_str_28, convert_one_hot_seq_str_28_batch, "ABCDEFGHIJKLMNOPQRSTUVWXYZab"),
+]
+
+
+def random_windows(n, letters, min_length, max_length, rng):
+    letters = np.frombuffer(letters.encode(), dtype=np.uint8)
+    lengths = rng.integers(min_length, max_length + 1, size=n)
+    codes = letters[rng.integers(0, len(letters), size=lengths.sum())].tobytes().decode()
+    ends = np.cumsum(lengths)
+    return [codes[end - length:end] for end, length in zip(ends, lengths)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark batch one-hot encoders against the per-string encoders.")
+    parser.add_argument('--n', type=int, default=1000000, help='number of windows encoded by the batch encoder')
+    parser.add_argument('--n_reference', type=int, default=20000, help='number of windows encoded per string')
+    parser.add_argument('--max_length', type=int, default=200, help='encoded length')
+    parser.add_argument('--batch_size', type=int, default=65536, help='windows per batch encoder call')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    for name, encode, encode_batch, letters in ENCODERS:
+        # 长度覆盖截断（> max_length）和补零（< max_length）两种情况
+        windows = random_windows(args.n, letters, args.max_length // 2, args.max_length + 20, rng)
+
+        reference = windows[:args.n_reference]
+        start = time.time()
+        expected = np.stack([encode(window, args.max_length) for window in reference])
+        per_string = (time.time() - start) / len(reference)
+        if not np.array_equal(expected, encode_batch(reference, args.max_length)):
+            raise AssertionError(f"{name}: batch encoder output differs from {encode.__name__}")
+
+        start = time.time()
+        for i in range(0, len(windows), args.batch_size):
+            encode_batch(windows[i:i + args.batch_size], args.max_length)
+        batch = time.time() - start
+
+        print(f"{name:>10}: per-string {per_string * len(windows):8.1f}s (extrapolated)  "
+              f"batch {batch:6.2f}s  for {len(windows)} windows  [identical]")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+向运行中的 inference_server.py 并发发送小请求，统计客户端看到的吞吐量与延迟，并打印服务端的延迟与批大小直方图。
+
+    python inference_server.py --rbp_list AGO2_MiClip --port 8765 &
+    python -m benchmarks.bench_server --url http://127.0.0.1:8765 --clients 16 --requests 2000 --sequences 4
+
+--unix_socket 连接以 unix socket 监听的服务。请求中的序列为随机的 200 nt 序列，默认附带结构（不触发 RNAfold），
+--raw 时不带结构，由服务端折叠。
+"""
+import argparse
+import http.client
+import json
+import socket
+import threading
+import time
+import numpy as np
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=60):
+        http.client.HTTPConnection.__init__(self, "localhost", timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def connect(args):
+    if args.unix_socket:
+        return UnixHTTPConnection(args.unix_socket)
+    host, _, port = args.url.split("://", 1)[-1].partition(":")
+    return http.client.HTTPConnection(host, int(port or 80), timeout=60)
+
+
+def request(conn, method, path, body=None):
+    data = None if body is None else json.dumps(body).encode("utf-8")
+    conn.request(method, path, body=data, headers={"Content-Type": "application/json"})
+    response = conn.getresponse()
+    result = json.loads(response.read())
+    if response.status != 200:
+        raise RuntimeError(f"{response.status}: {result.get('error')}")
+    return result
+
+
+def random_payload(rng, n, raw):
+    sequences = []
+    for i in range(n):
+        sequence = "".join(rng.choice(list("ACGU"), 200))
+        # 简单的茎环结构，只用于编码
+        record = {"name": f"s{i}", "sequence": sequence}
+        if not raw:
+            record["structure"] = "((((((" + "." * 188 + "))))))"
+        sequences.append(record)
+    return {"sequences": sequences}
+
+
+def percentile_ms(latencies, q):
+    return np.percentile(latencies, q) * 1000.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test inference_server.py with concurrent small requests.")
+    parser.add_argument('--url', type=str, default="http://127.0.0.1:8765", help='server address')
+    parser.add_argument('--unix_socket', type=str, default=None, help='connect to this unix socket instead')
+    parser.add_argument('--clients', type=int, default=16, help='concurrent client threads')
+    parser.add_argument('--requests', type=int, default=1000, help='total requests')
+    parser.add_argument('--sequences', type=int, default=4, help='sequences per request')
+    parser.add_argument('--raw', action='store_true', help='send sequences without structure (server folds them)')
+    args = parser.parse_args()
+
+    health = request(connect(args), "GET", "/health")
+    print(f"server: {len(health['rbps'])} RBPs on {health['device']}")
+    latencies = []
+    lock = threading.Lock()
+
+    def client(seed, n_requests):
+        rng = np.random.RandomState(seed)
+        conn = connect(args)
+        for _ in range(n_requests):
+            payload = random_payload(rng, args.sequences, args.raw)
+            start = time.perf_counter()
+            request(conn, "POST", "/score", payload)
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    shares = [len(part) for part in np.array_split(np.arange(args.requests), args.clients)]
+    threads = [threading.Thread(target=client, args=(seed, n)) for seed, n in enumerate(shares)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    print(f"{args.requests} requests x {args.sequences} sequences from {args.clients} clients in {elapsed:.2f} s: "
+          f"{args.requests / elapsed:.0f} requests/s, {args.requests * args.sequences / elapsed:.0f} windows/s")
+    print(f"client latency ms: p50 {percentile_ms(latencies, 50):.1f} p95 {percentile_ms(latencies, 95):.1f} "
+          f"p99 {percentile_ms(latencies, 99):.1f}")
+    metrics = request(connect(args), "GET", "/metrics")
+    for name in ("request_latency_ms", "scoring_latency_ms", "batch_windows", "batch_requests"):
+        histogram = metrics[name]
+        counts = " ".join(f"<={bucket['le']}:{bucket['count']}" for bucket in histogram["buckets"] if bucket["count"])
+        print(f"{name}: n={histogram['count']} mean={histogram['mean']:.2f} p50={histogram['p50']} "
+              f"p95={histogram['p95']} p99={histogram['p99']}  {counts}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+逐个训练 M 个 CNN 与用 StackedCNN 同步训练的速度对比，并校验 StackedCNN 的输出与各个 CNN 一致。
+
+    python -m benchmarks.bench_stacked --models 8 --steps 10 --batch_size 64
+"""
+import argparse
+import time
+import torch
+import torch.nn as nn
+
+from model_code.model import CNN, StackedCNN
+from train_code.train_loop import train, train_stacked
+from benchmarks.bench_train_step import random_batches
+
+
+def synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark lockstep training of stacked CNNs.")
+    parser.add_argument('--models', type=int, default=8, help='number of models')
+    parser.add_argument('--steps', type=int, default=10, help='training steps per model')
+    parser.add_argument('--batch_size', type=int, default=64, help='batch size')
+    parser.add_argument('--max_length', type=int, default=200, help='window length')
+    parser.add_argument('--gpuid', type=int, default=0, help='GPU to use if available')
+    args = parser.parse_args()
+
+    GREEN = "\033[32m"
+    RED = "\033[31m"
+    RESET = "\033[0m"
+    device = torch.device(f"cuda:{args.gpuid}" if torch.cuda.is_available() else "cpu")
+    criterion = nn.BCEWithLogitsLoss(pos_weight=torch.tensor(2.0))
+    loaders = [random_batches(args.steps, args.batch_size, args.max_length, 0.85, seed=i) for i in range(args.models)]
+
+    torch.manual_seed(0)
+    stacked = StackedCNN([CNN() for _ in range(args.models)]).to(device).eval()
+    x = torch.stack([loader[0][0] for loader in loaders], dim=1).to(device)
+    with torch.no_grad():
+        expected = torch.cat([model(x[:, i]) for i, model in enumerate(stacked.models)], dim=1)
+        diff = (stacked(x) - expected).abs().max().item()
+    ok = diff < 1e-4
+    print(f"stacked vs per-model outputs: max |diff| = {diff:.2e} {GREEN + 'OK' if ok else RED + 'MISMATCH'}{RESET}")
+
+    models = [CNN().to(device) for _ in range(args.models)]
+    synchronize(device)
+    start = time.perf_counter()
+    for model, loader in zip(models, loaders):
+        optimizer = torch.optim.Adam(model.parameters(), lr=0.001)
+        train(model, device, loader, criterion, optimizer, args.batch_size, 0.85)
+    synchronize(device)
+    sequential = time.perf_counter() - start
+
+    optimizers = [torch.optim.Adam(model.parameters(), lr=0.001) for model in stacked.models]
+    synchronize(device)
+    start = time.perf_counter()
+    train_stacked(stacked, device, loaders, criterion, optimizers, args.batch_size, 0.85)
+    synchronize(device)
+    lockstep = time.perf_counter() - start
+
+    windows = args.models * args.steps * args.batch_size
+    print(f"{args.models} models x {args.steps} steps, batch {args.batch_size}, device {device}")
+    print(f"  sequential: {sequential:8.2f} s ({windows / sequential:.0f} windows/s)")
+    print(f"     stacked: {lockstep:8.2f} s ({windows / lockstep:.0f} windows/s, {sequential / lockstep:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
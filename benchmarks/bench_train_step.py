@@ -0,0 +1,138 @@
+"""
+旧的两次 backward 训练步与单次 backward 的融合训练步的速度对比，并校验 legacy 模式与旧训练步的参数更新一致。
+
+    python -m benchmarks.bench_train_step --steps 50 --batch_size 64
+"""
+import argparse
+import copy
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+
+from model_code.model import CNN
+from train_code.train_loop import train
+
+
+def two_backward_train(model, device, train_loader, criterion, optimizer, batch_size, smooth_rate):
+    """
+    重构前的训练循环（仅保留参数更新部分），作为对照。
+    """
+    model.train()
+    previous_loss_cls = 0.0
+    previous_loss_smooth = 0.0
+    for x0, y0, y_s0 in train_loader:
+        x, y, y_s = x0.float().to(device), y0.to(device).float(), y_s0.to(device).float()
+        if y0.sum() == 0 or y0.sum() == batch_size:
+            continue
+        optimizer.zero_grad()
+        output = model(x).squeeze(1)
+        loss_cls = criterion(output, y)
+        loss_smooth = criterion(output, y_s)
+        loss_cls.backward(retain_graph=True)
+        loss_smooth.backward()
+        gradients_loss_cls = [p.grad for p in model.parameters()]
+        gradients_loss_smooth = [p.grad for p in model.parameters()]
+        delta_smooth = loss_smooth.item() / previous_loss_smooth if previous_loss_smooth > 0 else 1
+        delta_cls = loss_cls.item() / previous_loss_cls if previous_loss_cls > 0 else 1
+        weight_cross_entropy = 1 / delta_cls
+        weight_smooth = 1 / delta_smooth
+        weight_cross_entropy_norm = weight_cross_entropy / (weight_cross_entropy + weight_smooth)
+        weight_smooth_norm = weight_smooth / (weight_cross_entropy + weight_smooth)
+        final_gradients = [weight_cross_entropy_norm * grad_lc + weight_smooth_norm * grad_smooth
+                           for grad_lc, grad_smooth in zip(gradients_loss_cls, gradients_loss_smooth)]
+        torch.sigmoid(output).to(device='cpu').detach().numpy()
+        torch.nn.utils.clip_grad_norm_(model.parameters(), 5)
+        for param, final_grad in zip(model.parameters(), final_gradients):
+            param.grad = final_grad
+        optimizer.step()
+        previous_loss_cls = loss_cls.item()
+        previous_loss_smooth = loss_smooth.item()
+
+
+def random_batches(steps, batch_size, max_length, smooth_rate, seed=0):
+    rng = np.random.default_rng(seed)
+    batches = []
+    for _ in range(steps):
+        x = np.zeros((batch_size, 6, max_length), dtype=np.float32)
+        positions = np.arange(max_length)
+        x[np.arange(batch_size)[:, None], rng.integers(0, 4, (batch_size, max_length)), positions] = 1
+        x[np.arange(batch_size)[:, None], 4 + rng.integers(0, 2, (batch_size, max_length)), positions] = 1
+        y = np.zeros(batch_size, dtype=np.float32)
+        y[:batch_size // 2] = 1
+        y_s = y * smooth_rate + (1 - y) * (1 - smooth_rate)
+        batches.append((torch.from_numpy(x), torch.from_numpy(y), torch.from_numpy(y_s)))
+    return batches
+
+
+def run(step, model, device, batches, batch_size, smooth_rate, adam=True, **kwargs):
+    if adam:
+        optimizer = torch.optim.Adam(model.parameters(), lr=0.001, betas=(0.9, 0.999), weight_decay=1e-6)
+    else:
+        optimizer = torch.optim.SGD(model.parameters(), lr=0.01)
+    criterion = nn.BCEWithLogitsLoss(pos_weight=torch.tensor(2.0))
+    # 相同的 dropout 掩码，参数更新才可以逐一比较
+    torch.manual_seed(1)
+    start = time.perf_counter()
+    step(model, device, batches, criterion, optimizer, batch_size, smooth_rate, **kwargs)
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    return time.perf_counter() - start
+
+
+def max_param_diff(model_a, model_b):
+    return max((a - b).abs().max().item() for a, b in zip(model_a.parameters(), model_b.parameters()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the fused single-backward training step.")
+    parser.add_argument('--steps', type=int, default=50, help='training steps per run')
+    parser.add_argument('--batch_size', type=int, default=64, help='batch size')
+    parser.add_argument('--max_length', type=int, default=200, help='window length')
+    parser.add_argument('--smooth_rate', type=float, default=0.85, help='label smoothing rate')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per variant, the fastest is reported')
+    parser.add_argument('--gpuid', type=int, default=0, help='GPU to use if available')
+    args = parser.parse_args()
+
+    GREEN = "\033[32m"
+    RED = "\033[31m"
+    RESET = "\033[0m"
+    device = torch.device(f"cuda:{args.gpuid}" if torch.cuda.is_available() else "cpu")
+    # train() skips batches whose labels are all equal to this batch_size argument, as in main.py
+    batches = random_batches(args.steps, args.batch_size, args.max_length, args.smooth_rate)
+    torch.manual_seed(0)
+    initial = CNN().to(device)
+
+    variants = [
+        ("two-backward (old)", two_backward_train, {}),
+        ("fused legacy", train, {"loss_weighting": "legacy"}),
+        ("fused dynamic", train, {"loss_weighting": "dynamic"}),
+    ]
+    timings = {}
+    for name, step, kwargs in variants:
+        best = float("inf")
+        for _ in range(args.repeat):
+            model = copy.deepcopy(initial)
+            best = min(best, run(step, model, device, batches, args.batch_size, args.smooth_rate, **kwargs))
+        timings[name] = best
+
+    baseline = timings["two-backward (old)"]
+    print(f"{args.steps} steps, batch {args.batch_size}, device {device}")
+    for name, _, _ in variants:
+        print(f"{name:>20}: {1000 * timings[name] / args.steps:8.2f} ms/step  ({baseline / timings[name]:.2f}x)")
+
+    # 参数一致性用 SGD 校验：卷积偏置接在 BatchNorm 前，梯度理论上为 0，
+    # Adam 会把两种求和顺序之间的舍入误差放大成 lr 量级的更新
+    parity = []
+    for step, kwargs in [(two_backward_train, {}), (train, {"loss_weighting": "legacy"})]:
+        model = copy.deepcopy(initial)
+        run(step, model, device, batches, args.batch_size, args.smooth_rate, adam=False, **kwargs)
+        parity.append(model)
+    diff = max_param_diff(*parity)
+    ok = diff < 1e-5
+    print(f"legacy vs old parameters after {args.steps} SGD steps: max |diff| = {diff:.2e} "
+          f"{GREEN + 'OK' if ok else RED + 'MISMATCH'}{RESET}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+检查 DenseScanCNN 的密集扫描与逐窗口 CNN.forward 的一致性，并比较两者的速度；任一精确检查超过容差时返回非零。
+
+    python -m benchmarks.check_dense_scan --model music/out/model/LIN28A_HITS-CLIP_Human_music_within_best.pth
+
+精确检查（感受野等价的情形）：
+  1. 长度不超过 200 nt 的序列只有一个窗口，密集扫描应与 CNN.forward 相同；
+  2. 分块计算（--chunk_size）与整条计算相同；
+  3. 固定 SE 门控后，窗口内部（距窗口边缘 3 nt 以上）每个位置的打分与单独计算该窗口时相同。
+长转录本上 SE 门控取自以每个位置为中心的窗口、窗口边缘看到真实的侧翼序列，与逐窗口结果不再精确相等，
+改为按概率差的最大值和平均值检查（--long_max_diff、--long_mean_diff），Pearson 相关系数只做报告
+（打分方差很小的模型上相关系数不稳定）。
+输入为随机的 seq_4 + str_2 编码序列，没有 --model 时使用随机初始化的 CNN。
+"""
+import argparse
+import sys
+import time
+import numpy as np
+import torch
+
+from model_code.model import CNN, DenseScanCNN
+from utils import load_model
+
+
+def random_encoded(length, rng):
+    x = np.zeros((1, 6, length), dtype=np.float32)
+    x[0, rng.randint(0, 4, length), np.arange(length)] = 1
+    x[0, 4 + rng.randint(0, 2, length), np.arange(length)] = 1
+    return torch.from_numpy(x)
+
+
+def window_by_window(model, x, window, batch_size):
+    """CNN.forward on every window (stride 1) of x (1, H, L)."""
+    windows = x[0].unfold(1, window, 1).permute(1, 0, 2)
+    return torch.cat([model(windows[i:i + batch_size]) for i in range(0, len(windows), batch_size)]).t()
+
+
+class FixedGateScan(DenseScanCNN):
+    """DenseScanCNN with the SE gate set to 0.5 everywhere, so each position depends only on its 7-nt neighbourhood."""
+
+    def _gates(self, x):
+        return torch.full_like(x[:, :, :1, :1], 0.5)
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check DenseScanCNN against window-by-window CNN.forward.")
+    parser.add_argument('--model', type=str, default=None, help='CNN checkpoint, default: a randomly initialized CNN')
+    parser.add_argument('--lengths', type=int, nargs='+', default=[1000, 5000], help='lengths of the long test sequences')
+    parser.add_argument('--chunk_size', type=int, default=97, help='chunk size compared with whole-sequence scoring')
+    parser.add_argument('--tolerance', type=float, default=1e-4, help='maximum logit difference of the exact checks')
+    parser.add_argument('--long_max_diff', type=float, default=0.2, help='maximum probability difference on the long sequences')
+    parser.add_argument('--long_mean_diff', type=float, default=0.02, help='maximum mean probability difference on the long sequences')
+    parser.add_argument('--batch_size', type=int, default=256, help='windows per CNN.forward batch')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args()
+
+    GREEN = "\033[32m"
+    RED = "\033[31m"
+    RESET = "\033[0m"
+    window = 200
+    torch.manual_seed(args.seed)
+    rng = np.random.RandomState(args.seed)
+    model = CNN() if args.model is None else load_model(CNN(), args.model, "cpu")
+    model.eval()
+    dense = DenseScanCNN(model, window)
+    failed = False
+
+    def report(name, error):
+        nonlocal failed
+        ok = error <= args.tolerance
+        failed = failed or not ok
+        print(f"  {name}: max |logit diff| {error:.2e} {GREEN + 'OK' if ok else RED + 'FAILED'}{RESET}")
+
+    with torch.no_grad():
+        print("exact checks")
+        error = 0.0
+        for length in (window, 150, 1):
+            x = random_encoded(length, rng)
+            # the encoder centres sequences shorter than the window
+            padded = torch.nn.functional.pad(x, ((window - length) // 2, window - length - (window - length) // 2))
+            error = max(error, (dense(x)[0, :, 0] - model(padded)[0]).abs().max().item())
+        report("single window (200, 150 and 1 nt)", error)
+
+        x = random_encoded(max(args.lengths), rng)
+        chunked = DenseScanCNN(model, window, chunk_size=args.chunk_size)
+        report(f"chunks of {args.chunk_size} vs whole sequence", (chunked(x) - dense(x)).abs().max().item())
+
+        fixed = FixedGateScan(model, window)
+        positions = fixed.position_scores(x)
+        error = 0.0
+        for start in rng.randint(0, x.shape[2] - window + 1, 32):
+            alone = fixed.position_scores(x[..., start:start + window])
+            error = max(error, (alone[..., 3:-3] - positions[..., start + 3:start + window - 3]).abs().max().item())
+        report("fixed SE gate, window interior", error)
+
+        print(f"long sequences (SE gate of the centred window, real flanking context; tolerance: probability |diff| "
+              f"max {args.long_max_diff}, mean {args.long_mean_diff})")
+        for length in args.lengths:
+            x = random_encoded(length, rng)
+            dense_logits, dense_time = timed(dense, x)
+            window_logits, window_time = timed(window_by_window, model, x, window, args.batch_size)
+            p_dense = torch.sigmoid(dense_logits[0, 0]).numpy()
+            p_window = torch.sigmoid(window_logits[0]).numpy()
+            diff = np.abs(p_dense - p_window)
+            pearson = np.corrcoef(p_dense, p_window)[0, 1]
+            ok = diff.max() <= args.long_max_diff and diff.mean() <= args.long_mean_diff
+            failed = failed or not ok
+            print(f"  {length} nt, {len(p_dense)} windows: probability |diff| max {diff.max():.4f} mean {diff.mean():.4f}, "
+                  f"pearson {pearson:.4f} {GREEN + 'OK' if ok else RED + 'FAILED'}{RESET}")
+            print(f"    window by window: {window_time:7.3f} s, dense: {dense_time:7.3f} s ({window_time / dense_time:.0f}x)")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+在 within_species_test 的测试集上比较 fp32 与 bf16/fp16 autocast 的 AUC 与吞吐量，AUC 差异超过容差时返回非零。
+
+    python -m benchmarks.check_precision --file_path data/within_species_test/ --precision bf16 fp16
+
+每个 RBP 使用 music/out/model/<rbp>_<exp_name>_within_best.pth，没有模型的 RBP 跳过。
+测试集 h5 不存在时按 --validate 的流程生成（需要 RNAfold）。
+"""
+import argparse
+import os
+import sys
+import time
+import torch
+import torch.nn as nn
+
+from model_code.model import CNN
+from train_code.train_loop import PRECISIONS, validate
+from utils import load_model, validation_dataset
+
+
+def timed_validate(model, device, data_loader, criterion, precision):
+    start = time.perf_counter()
+    met, y_all, _ = validate(None, model, device, data_loader, criterion, 1, precision=precision)
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    return met.auc, len(y_all) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that autocast precisions keep the validation AUC of fp32.")
+    parser.add_argument('--file_path', type=str, default="data/within_species_test/", help='dataset directory')
+    parser.add_argument('--rbp_name', type=str, nargs='+', default=None, help='RBPs to check, default: all in file_path')
+    parser.add_argument('--out_dir', type=str, default="music", help='directory with out/model/*.pth')
+    parser.add_argument('--exp_name', type=str, default="music", help='experiment name of the checkpoints')
+    parser.add_argument('--precision', type=str, nargs='+', default=["bf16"], choices=PRECISIONS[1:],
+                        help='precisions compared against fp32')
+    parser.add_argument('--tolerance', type=float, default=0.005, help='maximum absolute AUC difference')
+    parser.add_argument('--batch_size', type=int, default=256, help='batch size')
+    parser.add_argument('--gpuid', type=int, default=0, help='GPU to use if available')
+    args = parser.parse_args()
+
+    GREEN = "\033[32m"
+    RED = "\033[31m"
+    RESET = "\033[0m"
+    device = torch.device(f"cuda:{args.gpuid}" if torch.cuda.is_available() else "cpu")
+    rbp_names = args.rbp_name or sorted(os.listdir(args.file_path))
+    criterion = nn.BCEWithLogitsLoss(pos_weight=torch.tensor(2.0))
+
+    failed = False
+    for rbp in rbp_names:
+        model_path = f"{args.out_dir}/out/model/{rbp}_{args.exp_name}_within_best.pth"
+        if not os.path.exists(model_path):
+            print(f"{rbp}: {model_path} not found, skipped")
+            continue
+        model = load_model(CNN().to(device), model_path, device)
+        data_loader = validation_dataset(args.file_path, rbp, args.batch_size, 1)
+        # 预热一次，避免首个精度的计时包含数据读取与内核初始化
+        timed_validate(model, device, data_loader, criterion, "fp32")
+
+        auc_fp32, speed_fp32 = timed_validate(model, device, data_loader, criterion, "fp32")
+        print(f"{rbp} ({device}): fp32 AUC {auc_fp32:.4f}, {speed_fp32:.0f} windows/s")
+        for precision in args.precision:
+            auc, speed = timed_validate(model, device, data_loader, criterion, precision)
+            ok = abs(auc - auc_fp32) <= args.tolerance
+            failed |= not ok
+            print(f"  {precision}: AUC {auc:.4f} (diff {auc - auc_fp32:+.4f}) "
+                  f"{GREEN + 'OK' if ok else RED + 'FAILED'}{RESET}, "
+                  f"{speed:.0f} windows/s ({speed / speed_fp32:.2f}x)")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,72 +1,80 @@
 import argparse
 from .annotation_tools import *
 from .data_utils import load_data_save_h5
+from .h5_cache import build_inference_h5
 import os
 
-def process_train_rnafold_data(data_path, rbp_name):
+def process_train_rnafold_data(data_path, rbp_name, fold_workers=None, fold_cache=None, save_annotation=False):
     """
     处理 RNAfold 数据，并执行折叠和注释。
     
     参数:
         data_path (str): 数据所在路径
         rbp_name (str): RBP 名称，如 "AGO2_MiClip"
+        fold_workers (int): 并发的 RNAfold 进程数，None 表示使用全部核心
+        fold_cache: 折叠缓存路径，None 使用默认缓存，False 关闭缓存
+        save_annotation (bool): 是否同时保存注释 TSV
     """
     # 数据类型（positive 和 negative）和任务类型（train 和 test）
     dts = ["positive", "negative"]
 
     # 遍历所有数据类型和任务类型的组合
     for dt in dts:
-        # 执行 RNAfold
-        rnafold_result = run_rnafold(data_path, dt, rbp_name, tt = "train")
-        # 生成注释文件的路径
-        seq_str_anno_file = f"{data_path}/{rbp_name}/{dt}_data/train_annotation.tsv"
-        # 进行 RNAfold 结果的处理和注释
-        process_rnafold_and_annotate(rnafold_result, seq_str_anno_file)
+        input_file_path = f"{data_path}/{rbp_name}/{dt}_data/train.fa"
+        # 注释文件只在 save_annotation 时保存
+        seq_str_anno_file = f"{data_path}/{rbp_name}/{dt}_data/train_annotation.tsv" if save_annotation else None
         output_file = f"{data_path}/{rbp_name}/{dt}_data/train.h5"
-        load_data_save_h5(seq_str_anno_file, output_file, max_length=200)
+        # 折叠、注释、编码流式完成，直接生成 h5
+        run_rnafold_to_h5(input_file_path, output_file, rnafold="RNAfold",
+                          target_directory=os.path.join(data_path, "RNAfold_results", rbp_name),
+                          fold_workers=fold_workers, fold_cache=fold_cache, annotation_file=seq_str_anno_file)
 
     print("RNAfold processing, annotation complete and generate h5 file for MuSIC.")
 
-def process_validation_rnafold_data(data_path, rbp_name):
+def process_validation_rnafold_data(data_path, rbp_name, fold_workers=None, fold_cache=None, save_annotation=False):
     """
     处理 RNAfold 数据，并执行折叠和注释。
     
     参数:
         data_path (str): 数据所在路径
         rbp_name (str): RBP 名称，如 "AGO2_MiClip"
+        fold_workers (int): 并发的 RNAfold 进程数，None 表示使用全部核心
+        fold_cache: 折叠缓存路径，None 使用默认缓存，False 关闭缓存
+        save_annotation (bool): 是否同时保存注释 TSV
     """
     # 数据类型（positive 和 negative）和任务类型（train 和 test）
     dts = ["positive", "negative"]
 
     # 遍历所有数据类型和任务类型的组合
     for dt in dts:
-        # 执行 RNAfold
-        rnafold_result = run_rnafold(data_path, dt, rbp_name ,tt = "test")
-        # 生成注释文件的路径
-        seq_str_anno_file = f"{data_path}/{rbp_name}/{dt}_data/test_annotation.tsv"
-
-        print("Begin to process RNAfold result and generate annotation file.")
-
-        process_rnafold_and_annotate(rnafold_result, seq_str_anno_file)
+        input_file_path = f"{data_path}/{rbp_name}/{dt}_data/test.fa"
+        # 注释文件只在 save_annotation 时保存
+        seq_str_anno_file = f"{data_path}/{rbp_name}/{dt}_data/test_annotation.tsv" if save_annotation else None
         output_file = f"{data_path}/{rbp_name}/{dt}_data/test.h5"
-        load_data_save_h5(seq_str_anno_file, output_file, max_length=200)
+        # 折叠、注释、编码流式完成，直接生成 h5
+        run_rnafold_to_h5(input_file_path, output_file, rnafold="RNAfold",
+                          target_directory=os.path.join(data_path, "RNAfold_results", rbp_name),
+                          fold_workers=fold_workers, fold_cache=fold_cache, annotation_file=seq_str_anno_file)
 
     print("RNAfold processing, annotation complete and generate h5 file for MuSIC.")
 
 
-def process_rnafold_infer_data(fasta_filepath):
+def process_rnafold_infer_data(fasta_filepath, fold_workers=None, fold_cache=None, save_annotation=False):
     """
     处理没有label的数据集，进行inference 或者 计算 HAR 等等
-    """
-    # 执行 RNAfold
-    rnafold_result = run_infer_rnafold(fasta_filepath)
-    # 生成注释文件的路径
-    seq_str_anno_file = os.path.splitext(fasta_filepath)[0] + "_annotation.tsv"
 
-    print("Begin to process RNAfold result and generate annotation file.")
-
-    process_rnafold_and_annotate(rnafold_result, seq_str_anno_file)
-    output_file = os.path.splitext(fasta_filepath)[0] + ".h5"
-    load_data_save_h5(seq_str_anno_file, output_file, max_length=200)
+    参数:
+        fasta_filepath (str): fasta 文件路径（普通文本或 gzip，不会被改写）
+        fold_workers (int): 并发的 RNAfold 进程数，None 表示使用全部核心
+        fold_cache: 折叠缓存路径，None 使用默认缓存，False 关闭缓存
+        save_annotation (bool): 是否同时保存注释 TSV
+    """
+    # 注释文件只在 save_annotation 时保存
+    seq_str_anno_file = fasta_stem(fasta_filepath) + "_annotation.tsv" if save_annotation else None
+    output_file = fasta_stem(fasta_filepath) + ".h5"
+    # 清单与 FASTA 内容、编码和折叠参数一致时直接复用已有的 h5，否则只重新折叠变化的记录
+    build_inference_h5(fasta_filepath, output_file, rnafold=INFER_RNAFOLD,
+                       target_directory=os.path.dirname(fasta_filepath),
+                       fold_workers=fold_workers, fold_cache=fold_cache, annotation_file=seq_str_anno_file)
 
     print("RNAfold processing, annotation complete and generate h5 file for MuSIC.")
@@ -1,36 +1,18 @@
 import subprocess
-import tempfile
 import argparse
 import os
 import shutil
-from tqdm import tqdm  # 导入tqdm库来显示进度条
-import threading
-import time
 
-import glob
+from .fold_executor import run_parallel_rnafold, default_fold_workers, iter_fold_result_file, FoldProgress
+from .structure_annotator import annotate_structures
+from .h5_pipeline import fasta_to_h5
+from .fasta_io import count_fasta_records, fasta_stem
 
+# inference 数据使用的 RNAfold 路径
+INFER_RNAFOLD = "/data3/software/viennarna/viennarna-install-2.4.14/bin/RNAfold"
 
-def monitor_folding_progress(output_file, total_sequences, pbar):
-    """
-    监控 RNAfold 计算进度，不再依赖 .ps 文件，而是从 output_file 统计 '>' 头的个数。
 
-    参数:
-        output_file (str): RNAfold 结果文件路径。
-        total_sequences (int): 输入 RNA 序列的总数。
-        pbar (tqdm): 进度条对象。
-    """
-    folded_rna_count = 0
-    while folded_rna_count < total_sequences:
-        # 统计 output_file 中 ">" 的个数
-        if os.path.exists(output_file):
-            with open(output_file, "r") as f:
-                folded_rna_count = sum(1 for line in f if line.startswith(">"))
-
-        pbar.update(folded_rna_count - pbar.n)  # 更新进度条
-        time.sleep(1)  # 每隔1秒检查一次
-
-
-def run_rnafold(data_path, data_type, rbp_name, tt):
+def run_rnafold(data_path, data_type, rbp_name, tt, fold_workers=None, fold_cache=None):
     """
     处理 RNAfold 计算，类似于 Bash 脚本中的 RNAfold 调用，输出结果为 RNAfold 结果文本。
 
@@ -39,6 +21,8 @@ def run_rnafold(data_path, data_type, rbp_name, tt):
         data_type (str): 数据类型（如：训练数据，测试数据等）
         rbp_name (str): RBP 名称
         tt (str): 输入文件名（不包括扩展名）
+        fold_workers (int): 并发的 RNAfold 进程数，None 表示使用全部核心
+        fold_cache: 折叠缓存路径，None 使用默认缓存，False 关闭缓存
     """
     # RNAfold 命令路径
     RNAfold = "RNAfold"
@@ -56,53 +40,22 @@ def run_rnafold(data_path, data_type, rbp_name, tt):
     os.makedirs(target_directory, exist_ok=True)
 
     # 统计输入文件中序列的数量
-    with open(input_file_path, "r") as infile:
-        total_sequences = sum(1 for line in infile if line.startswith(">"))
+    total_sequences = count_fasta_records(input_file_path)
 
     # 结果文件路径
     output_file = os.path.join(target_directory, f"{tt}_fold.result")
 
+    fold_workers = fold_workers or default_fold_workers()
     print(f"Total sequences: {total_sequences}")
-    print(f"Folding sequences...")
-
-    # 使用 tqdm 显示进度条
-    with tqdm(total=total_sequences, desc="Folding RNA", unit="seq") as pbar:
-        # 启动监控线程，实时追踪 output_file 中的 ">" 行数
-        monitor_thread = threading.Thread(target=monitor_folding_progress, args=(output_file, total_sequences, pbar))
-        monitor_thread.daemon = True
-        monitor_thread.start()
-
-        # 定义定期删除 .ps 文件的函数
-        def delete_ps_files_periodically():
-            while True:
-                for file_path in glob.iglob(os.path.join(target_directory, "*.ps")):
-                    try:
-                        os.remove(file_path)
-                    except Exception:
-                        # 不输出任何信息，直接忽略删除失败的情况
-                        pass
-                # 每隔 2 秒执行一次删除操作
-                import time
-                time.sleep(2)
-
-        # 启动定期删除 .ps 文件的线程
-        ps_deletion_thread = threading.Thread(target=delete_ps_files_periodically)
-        ps_deletion_thread.daemon = True
-        ps_deletion_thread.start()
-
-        # 执行 RNAfold 计算
-        with open(input_file_path, "r") as infile, open(output_file, "w") as outfile:
-            subprocess.run(
-                [RNAfold, "-p", "--noPS"],
-                stdin=infile,
-                stdout=outfile,
-                cwd=target_directory
-            )
-
-        monitor_thread.join()  # 等待监控线程结束
-        # 让主线程等待一段时间，确保删除线程有机会完成最后一次删除
-        import time
-        time.sleep(2)
+    print(f"Folding sequences with {fold_workers} RNAfold workers...")
+
+    # 折叠进度由工作线程在每条记录完成时直接上报
+    with FoldProgress(total_sequences, desc="Folding RNA") as progress:
+        # 分片并行执行 RNAfold 计算，结果按输入顺序合并
+        run_parallel_rnafold(input_file_path, output_file, rnafold=RNAfold,
+                             fold_workers=fold_workers, cwd=target_directory, fold_cache=fold_cache,
+                             progress=progress)
+    print(progress.summary())
 
     # 输出统计信息
     print(f"Folding complete: {total_sequences}/{total_sequences} sequences folded.")
@@ -110,14 +63,16 @@ def run_rnafold(data_path, data_type, rbp_name, tt):
 
     return output_file
 
-def run_infer_rnafold(fasta_filepath):
+def run_infer_rnafold(fasta_filepath, fold_workers=None, fold_cache=None):
     """
     处理 RNAfold 计算，类似于 Bash 脚本中的 RNAfold 调用，输出结果为 RNAfold 结果文本。
 
     参数:
         fasta_filepath: fasta 文件的路径
+        fold_workers (int): 并发的 RNAfold 进程数，None 表示使用全部核心
+        fold_cache: 折叠缓存路径，None 使用默认缓存，False 关闭缓存
     """
-    RNAfold = "/data3/software/viennarna/viennarna-install-2.4.14/bin/RNAfold"
+    RNAfold = INFER_RNAFOLD
     GREEN = "\033[32m"
     RESET = "\033[0m"
 
@@ -127,143 +82,117 @@ def run_infer_rnafold(fasta_filepath):
     os.makedirs(target_directory, exist_ok=True)
 
     # 生成 RNAfold 结果文件路径
-    output_file = os.path.splitext(fasta_filepath)[0] + "_fold.result"
+    output_file = fasta_stem(fasta_filepath) + "_fold.result"
 
     # 统计输入文件中序列的数量
-    with open(fasta_filepath, "r") as infile:
-        total_sequences = sum(1 for line in infile if line.startswith(">"))
-
-    print(f"Total sequences to fold: {total_sequences}")
-
-    # 使用 tqdm 显示进度条
-    with tqdm(total=total_sequences, desc="Folding RNA", unit="seq") as pbar:
-        # 启动监控线程，实时追踪 output_file 中的 ">" 行数
-        monitor_thread = threading.Thread(target=monitor_folding_progress, args=(output_file, total_sequences, pbar))
-        monitor_thread.daemon = True
-        monitor_thread.start()
-
-        # 启动一个新线程来定期删除 .ps 文件
-        def delete_ps_files_periodically():
-            while True:
-                for file_path in glob.iglob(os.path.join(target_directory, "*.ps")):
-                    try:
-                        os.remove(file_path)
-                    except Exception:
-                        # 不输出任何信息，直接忽略删除失败的情况
-                        pass
-                # 每隔 2 秒执行一次删除操作
-                import time
-                time.sleep(2)
-
-        ps_deletion_thread = threading.Thread(target=delete_ps_files_periodically)
-        ps_deletion_thread.daemon = True
-        ps_deletion_thread.start()
-
-        # 执行 RNAfold 计算
-        with open(fasta_filepath, "r") as infile, open(output_file, "w") as outfile:
-            subprocess.run(
-                [RNAfold, "-p", "--noPS"],
-                stdin=infile,
-                stdout=outfile,
-                cwd=target_directory
-            )
-
-        monitor_thread.join()  # 等待监控线程结束
-        # 虽然线程是守护线程，但这里可以让主线程等待一小段时间确保删除线程有机会执行最后一次删除
-        import time
-        time.sleep(2)
+    total_sequences = count_fasta_records(fasta_filepath)
+
+    fold_workers = fold_workers or default_fold_workers()
+    print(f"Total sequences to fold: {total_sequences} ({fold_workers} RNAfold workers)")
+
+    # 折叠进度由工作线程在每条记录完成时直接上报
+    with FoldProgress(total_sequences, desc="Folding RNA") as progress:
+        # 分片并行执行 RNAfold 计算，结果按输入顺序合并
+        run_parallel_rnafold(fasta_filepath, output_file, rnafold=RNAfold,
+                             fold_workers=fold_workers, cwd=target_directory, fold_cache=fold_cache,
+                             progress=progress)
+    print(progress.summary())
 
     print(f"Folding complete: {total_sequences}/{total_sequences} sequences folded.")
     print(f"Folding complete. Result saved to: {output_file}")
 
     return output_file
 
+
+def run_rnafold_to_h5(input_file_path, output_file, rnafold="RNAfold", target_directory=None, fold_workers=None,
+                      fold_cache=None, annotation_file=None, max_length=200):
+    """
+    流式完成 RNAfold 折叠、结构注释和 one-hot 编码，直接生成 h5 文件，
+    不再写出中间的 RNAfold 结果文件和注释 TSV（除非指定 annotation_file）。
+
+    参数:
+        input_file_path (str): 输入 FASTA 文件路径
+        output_file (str): 输出 h5 文件路径
+        rnafold (str): RNAfold 可执行文件路径
+        target_directory (str): RNAfold 的工作目录
+        fold_workers (int): 并发的 RNAfold 进程数，None 表示使用全部核心
+        fold_cache: 折叠缓存路径，None 使用默认缓存，False 关闭缓存
+        annotation_file (str): 若指定，同时保存注释 TSV
+        max_length (int): one-hot 编码的长度
+    """
+    GREEN = "\033[32m"
+    RED = "\033[31m"
+    RESET = "\033[0m"
+    print(f"Start using RNAfold folding {GREEN}{input_file_path}{RESET}")
+
+    if target_directory:
+        os.makedirs(target_directory, exist_ok=True)
+
+    # 统计输入文件中序列的数量
+    total_sequences = count_fasta_records(input_file_path)
+
+    fold_workers = fold_workers or default_fold_workers()
+    print(f"Total sequences to fold: {total_sequences} ({fold_workers} RNAfold workers)")
+
+    with FoldProgress(total_sequences, desc="Folding RNA") as progress:
+        total = fasta_to_h5(input_file_path, output_file, rnafold=rnafold, fold_workers=fold_workers,
+                            cwd=target_directory, fold_cache=fold_cache, progress=progress, max_length=max_length,
+                            annotation_file=annotation_file)
+    print(progress.summary())
+
+    if annotation_file is not None:
+        print(f"Sequence and Structure Annotation Files {RED}{annotation_file}{RESET} has been saved.")
+    print("combined feature matrix shape after one-hot encode is ", (total, 6, max_length))
+    print(f"Data saved to {GREEN}{output_file}{RESET}")
+
+    return output_file
+
     
 def annotate_str(mfe_structure_line):
     """
-    注释单个 MFE 结构行，保存到临时文件后调用 C 程序进行处理，并提取注释结果。
+    注释单个 MFE 结构行，结果与 C 程序 parse_secondary_structure_v2 一致。
 
     参数:
         mfe_structure_line (str): 点括号格式的 MFE 结构。
 
     返回:
-        str: 注释后的字符串（C 程序输出）。
+        str: 注释后的 7-letter 结构字符串。
     """
-    try:
-        # 使用 tempfile 创建临时文件
-        with tempfile.NamedTemporaryFile(delete=True, mode="w") as structure_file, \
-             tempfile.NamedTemporaryFile(delete=True, mode="r") as annotation_file:
-
-            # 将 MFE 结构保存到临时文件
-            structure_file.write(mfe_structure_line + "\n")
-            structure_file.flush()  # 确保写入文件
-
-            # 调用 C 程序对临时文件进行注释
-            c_program = "./data_gerenate/fold_str_annotion/parse_secondary_structure_v2"  # C 程序的路径
-            subprocess.run(
-                [c_program, structure_file.name, annotation_file.name],
-                check=True)
-            # 从注释文件中读取结果
-            annotated_structure = annotation_file.read().strip()
-
-        return annotated_structure
-
-    except subprocess.CalledProcessError as e:
-        print(f"Error running C program: {e}")
-        return None
-
-    except Exception as e:
-        print(f"Unexpected error: {e}")
-        return None
-
-def process_rnafold_and_annotate(input_file, output_file):
+    struct_7, _, _ = annotate_structures([mfe_structure_line])
+    return struct_7[0]
+
+def process_rnafold_and_annotate(input_file, output_file, batch_size=4096):
     """
-    从 RNAfold 输出文件中提取第 1 行（标题行）、第 2 行（RNA 序列行）和第 3 行（MFE 结构行），
-    对结构进行注释，并将结构转换为 2-letter 格式，然后将结果保存为 TSV 格式。
+    流式读取 RNAfold 输出文件中的每条记录（标题行、RNA 序列行和 MFE 结构行），
+    按批对结构进行注释，并将结构转换为 2-letter 格式，然后将结果保存为 TSV 格式。
+    兼容 RNAfold -p 输出与 MFE-only 输出（例如命中折叠缓存的记录）。
 
     参数:
         input_file (str): 输入 RNAfold 输出文件路径。
         output_file (str): 输出处理后结果文件路径（应以 .tsv 结尾）。
+        batch_size (int): 每批注释的记录数，决定内存占用上限。
     """
-    # 定义7-letter到4-letter和4-letter到2-letter结构的转换字典
-    struct_7_convert_4 = {'B': 'M', 'E': 'U', 'H': 'L', 'L': 'P', 'M': 'M', 'R': 'P', 'T': 'M'}
-    struct_4_convert_2 = {'P': 'P', 'L': 'U', 'U': 'U', 'M': 'U'}
-
     # 检查输出目录是否存在，不存在则创建
     dirname = os.path.dirname(output_file)
     if not os.path.exists(dirname):
         os.makedirs(dirname)
 
-    # 打开输入文件并处理每个 RNA 记录块
-    with open(input_file, "r") as infile, open(output_file, "w") as outfile:
-        lines = infile.readlines()
-
-        # 每个 RNA 记录块的行数为 6 行
-        for i in range(0, len(lines), 6):
-            # 检查当前块是否有足够的行
-            if i + 2 < len(lines):
-                header_line = lines[i].strip()  # 第 1 行
-                sequence_line = lines[i + 1].strip()  # 第 2 行
-                mfe_structure_line = lines[i + 2].strip().split()[0]  # 第 3 行，去掉能量值
-
-                # 对结构进行注释（调用注释函数）
-                annotated_structure = annotate_str(mfe_structure_line)
-
-                # 转换结构：7-letter -> 4-letter -> 2-letter
-                struct_4 = []
-                struct_2 = []
-
-                for i in range(len(annotated_structure)):
-                    # Convert the 7-letter structure to 4-letter and then to 2-letter
-                    struct_4.append(struct_7_convert_4[annotated_structure[i]])
-                    struct_2.append(struct_4_convert_2[struct_7_convert_4[annotated_structure[i]]])
-
-                # Join the results into strings
-                struct_4 = ''.join(struct_4)
-                struct_2 = ''.join(struct_2)
-
-                # Write the final results: header, sequence, original structure, annotated structure
-                outfile.write(f"{header_line}\t{sequence_line}\t{struct_2}\n")
+    def write_batch(outfile, batch):
+        # 批量注释结构，同时得到 7-letter、4-letter 和 2-letter 结构
+        struct_7, struct_4, struct_2 = annotate_structures([structure for _, _, structure in batch])
+        # Write the final results: header, sequence, annotated structure
+        outfile.writelines(f"{header_line}\t{sequence_line}\t{struct_2_line}\n"
+                           for (header_line, sequence_line, _), struct_2_line in zip(batch, struct_2))
+
+    with open(output_file, "w") as outfile:
+        batch = []
+        for header_line, sequence_line, mfe_structure, _ in iter_fold_result_file(input_file):
+            batch.append((header_line, sequence_line, mfe_structure))
+            if len(batch) >= batch_size:
+                write_batch(outfile, batch)
+                batch = []
+        if batch:
+            write_batch(outfile, batch)
 
     RED = "\033[31m"
     RESET = "\033[0m"
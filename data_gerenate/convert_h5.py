@@ -0,0 +1,77 @@
+import argparse
+import os
+import h5py
+import numpy as np
+
+from .data_utils import H5Appender, H5_STORAGE_TOKENS, H5_STORAGE_ONE_HOT, h5_storage, h5_windows, read_h5_one_hot
+from .one_hot_encode_decode import encode_tokens, expand_tokens
+
+"""
+在 token 格式与旧的 float32 one_hot_matrices 格式之间转换 h5，逐块进行，内存占用与文件大小无关。
+
+    python -m data_gerenate.convert_h5 --input data/186rbp_dataset/AGO2_MiClip/positive_data/train.h5
+    python -m data_gerenate.convert_h5 --input train.h5 --output train_one_hot.h5 --to one_hot
+
+不指定 --output 时原地替换（先写临时文件，成功后再替换）。
+"""
+
+
+def convert_h5(input_file, output_file=None, storage=H5_STORAGE_TOKENS, chunk_size=8192):
+    """
+    转换 h5 的存储格式。
+
+    参数:
+        input_file (str): 输入 h5 文件。
+        output_file (str): 输出 h5 文件，None 表示原地替换。
+        storage (str): 目标格式，"tokens" 或 "one_hot"。
+        chunk_size (int): 每次转换的窗口数。
+
+    返回:
+        (str, int): 输出文件路径和窗口数。
+    """
+    output_file = output_file or input_file
+    total = 0
+    with h5py.File(input_file, "r") as h5f:
+        rna_names = h5f["rna_names"]
+        windows = h5_windows(h5f)
+        max_length = windows.shape[-1]
+        # 输出先写入 output_file + ".tmp"，原地转换时也不会在读取过程中覆盖输入
+        with H5Appender(output_file, max_length, storage=storage) as writer:
+            for start in range(0, len(windows), chunk_size):
+                if storage == H5_STORAGE_TOKENS and h5_storage(h5f) == H5_STORAGE_ONE_HOT:
+                    matrices = windows[start:start + chunk_size]
+                    chunk = encode_tokens(matrices)
+                    # 只有严格 one-hot 的矩阵才能无损压缩为 token
+                    if not np.array_equal(expand_tokens(chunk), matrices):
+                        raise ValueError(f"{input_file}: windows {start}-{start + len(matrices)} are not "
+                                         "one-hot encoded and cannot be stored as tokens")
+                else:
+                    chunk = read_h5_one_hot(h5f, start, start + chunk_size) \
+                        if storage == H5_STORAGE_ONE_HOT else windows[start:start + chunk_size]
+                writer.append(rna_names[start:start + chunk_size], chunk)
+                total += len(chunk)
+    return output_file, total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert MuSIC h5 files between the token and float one-hot formats.")
+    parser.add_argument('--input', type=str, nargs='+', required=True, help='h5 files to convert')
+    parser.add_argument('--output', type=str, default=None, help='output h5 (single input only), default: in place')
+    parser.add_argument('--to', type=str, default=H5_STORAGE_TOKENS, choices=[H5_STORAGE_TOKENS, H5_STORAGE_ONE_HOT],
+                        help='target storage format')
+    parser.add_argument('--chunk_size', type=int, default=8192, help='windows converted per chunk')
+    args = parser.parse_args()
+    if args.output is not None and len(args.input) > 1:
+        parser.error("--output can only be used with a single --input")
+
+    GREEN = "\033[32m"
+    RESET = "\033[0m"
+    for input_file in args.input:
+        size_before = os.path.getsize(input_file)
+        output_file, total = convert_h5(input_file, args.output, args.to, args.chunk_size)
+        print(f"{total} windows converted to {args.to}: {GREEN}{output_file}{RESET} "
+              f"({size_before / 2 ** 20:.1f} MB -> {os.path.getsize(output_file) / 2 ** 20:.1f} MB)")
+
+
+if __name__ == "__main__":
+    main()
@@ -76,50 +76,149 @@ def load_data_test(data_file, matrices_to_concatenate, max_length=200):
     
     return combined_oh
 
-def load_data_save_h5(data_file, output_file, max_length):
+H5_STORAGE_TOKENS = "tokens"
+H5_STORAGE_ONE_HOT = "one_hot"
+
+
+def h5_storage(h5f):
+    """
+    判断 h5 的存储格式：token 格式（`tokens`，(N, L) uint8）或旧的 float 格式（`one_hot_matrices`，(N, 6, L)）。
     """
-    该函数读取数据文件，将其中的 `seq_4` 和 `str_2` 特征进行 one-hot 编码，
-    然后将它们合并并保存为 HDF5 格式。
+    return H5_STORAGE_TOKENS if "tokens" in h5f else H5_STORAGE_ONE_HOT
 
-    参数:
-        data_file (str): 输入的数据文件路径，包含 `seq_4` 和 `str_2` 列。
-        output_file (str): 输出文件路径，将保存为 HDF5 格式。
-        max_length (int): 用于 one-hot 编码时序列的最大长度。
+
+def h5_windows(h5f):
     """
-    
-    dirname = os.path.dirname(output_file)
-    if not os.path.exists(dirname):
-        os.makedirs(dirname)
-    
-    # 读取数据
-    df = pd.read_csv(data_file, sep="\t", header=None)
-    
-    all_combined_matrices = []  # 用于保存每一行的合并后的矩阵
-    all_rna_names = []  # 保存每一行的 RNA 名称
-    
-    for index, row in df.iterrows():
-        rna_name = row.iloc[0]
-        one_hot_matrices = []
+    返回存放窗口数据的 h5 数据集（按存储格式为 `tokens` 或 `one_hot_matrices`）。
+    """
+    return h5f["tokens"] if h5_storage(h5f) == H5_STORAGE_TOKENS else h5f["one_hot_matrices"]
 
-        seq_4 = row.iloc[1]
-        seq_4_oh = convert_one_hot_seq_4(seq_4, max_length)
-        one_hot_matrices.append(seq_4_oh)
 
-        str_2 = row.iloc[2]
-        str_2_oh = convert_one_hot_str_2(str_2, max_length)
-        one_hot_matrices.append(str_2_oh)
+def read_h5_one_hot(h5f, start=None, stop=None):
+    """
+    读取 [start, stop) 范围的窗口并统一返回 (n, 6, L) float32 one-hot 矩阵，两种存储格式都适用。
+    """
+    windows = h5_windows(h5f)[start:stop]
+    if h5_storage(h5f) == H5_STORAGE_TOKENS:
+        return expand_tokens(windows)
+    return windows
+
+
+class H5Appender(object):
+    """
+    以追加方式写入 h5：`rna_names` 与窗口数据均为分块、可扩展的数据集，
+    每来一批数据就扩展一次，内存占用只与批大小有关。
+
+    storage="tokens"（默认）时窗口保存为 (N, L) 的 uint8 token（见 one_hot_encode_decode 中的 token 格式），
+    storage="one_hot" 时保存为旧的 (N, 6, L) float32 `one_hot_matrices`。
+
+    先写入 output_file + ".tmp"，close() 时再替换为 output_file，
+    中途失败不会留下一个看似完整的 h5 文件。
+    """
+
+    def __init__(self, output_file, max_length, chunk_rows=256, storage=H5_STORAGE_TOKENS, record_digests=False):
+        dirname = os.path.dirname(output_file)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self.output_file = output_file
+        self.tmp_file = output_file + ".tmp"
+        self.storage = storage
+        self.size = 0
+        self.h5f = h5py.File(self.tmp_file, "w")
+        self.rna_names = self.h5f.create_dataset(
+            "rna_names", shape=(0,), maxshape=(None,), chunks=(chunk_rows,),
+            dtype=h5py.special_dtype(vlen=bytes)
+        )
+        if storage == H5_STORAGE_TOKENS:
+            window_shape, name, dtype = (max_length,), "tokens", np.uint8
+        else:
+            window_shape, name, dtype = (6, max_length), "one_hot_matrices", np.float32
+        self.windows = self.h5f.create_dataset(
+            name, shape=(0,) + window_shape, maxshape=(None,) + window_shape,
+            chunks=(chunk_rows,) + window_shape, dtype=dtype
+        )
+        # 每条记录的内容摘要（sha1），用于增量重建，见 h5_cache
+        self.record_digests = None
+        if record_digests:
+            self.record_digests = self.h5f.create_dataset(
+                "record_digests", shape=(0, 20), maxshape=(None, 20), chunks=(chunk_rows, 20), dtype=np.uint8
+            )
+
+    def append(self, rna_names, windows, digests=None):
+        """
+        追加一批数据。
+
+        参数:
+            rna_names (list): RNA 名称（str 或 bytes）。
+            windows (np.ndarray): (N, L) uint8 token 或 (N, 6, L) one-hot 矩阵，按需转换为存储格式。
+            digests (np.ndarray): (N, 20) uint8 记录摘要，仅在 record_digests=True 时写入。
+        """
+        n = len(rna_names)
+        if n == 0:
+            return
+        windows = np.asarray(windows)
+        if self.storage == H5_STORAGE_TOKENS and windows.ndim == 3:
+            windows = encode_tokens(windows)
+        elif self.storage == H5_STORAGE_ONE_HOT and windows.ndim == 2:
+            windows = expand_tokens(windows)
+        start, self.size = self.size, self.size + n
+        self.rna_names.resize((self.size,))
+        self.windows.resize((self.size,) + self.windows.shape[1:])
+        self.rna_names[start:self.size] = [name.encode() if isinstance(name, str) else name for name in rna_names]
+        self.windows[start:self.size] = windows
+        if self.record_digests is not None:
+            self.record_digests.resize((self.size, 20))
+            self.record_digests[start:self.size] = digests
+
+    def close(self):
+        self.h5f.close()
+        os.replace(self.tmp_file, self.output_file)
+
+    def abort(self):
+        self.h5f.close()
+        os.remove(self.tmp_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def encode_seq_str_2(sequences, structures, max_length):
+    """
+    将一批序列和 2-letter 结构编码为 (N, 6, max_length) 的 seq_4 + str_2 矩阵。
+    """
+    return combine_one_hot_matrix(
+        [convert_one_hot_seq_4_batch(sequences, max_length), convert_one_hot_str_2_batch(structures, max_length)],
+        axis=1
+    )
 
-        combined_oh = combine_one_hot_matrix(one_hot_matrices, axis=0)
 
-        all_rna_names.append(rna_name)
-        all_combined_matrices.append(combined_oh)
+def load_data_save_h5(data_file, output_file, max_length, chunksize=4096, storage=H5_STORAGE_TOKENS):
+    """
+    该函数分块读取数据文件，将其中的 `seq_4` 和 `str_2` 特征进行 one-hot 编码，
+    然后将它们合并并追加保存为 HDF5 格式。
 
-    print("combined feature matrix shape after one-hot encode is ", np.array(all_combined_matrices).shape)
+    参数:
+        data_file (str): 输入的数据文件路径，包含 `seq_4` 和 `str_2` 列。
+        output_file (str): 输出文件路径，将保存为 HDF5 格式。
+        max_length (int): 用于 one-hot 编码时序列的最大长度。
+        chunksize (int): 每次读取并编码的行数。
+        storage (str): "tokens"（默认，紧凑的 token 格式）或 "one_hot"（旧的 float32 格式）。
+    """
     GREEN = "\033[32m"
     RESET = "\033[0m"
 
-    # 保存到 HDF5 文件
-    with h5py.File(output_file, "w") as h5f:
-        h5f.create_dataset("rna_names", data=np.array(all_rna_names, dtype='S'))
-        h5f.create_dataset("one_hot_matrices", data=np.array(all_combined_matrices, dtype=np.float32))
+    total = 0
+    with H5Appender(output_file, max_length, storage=storage) as writer:
+        for df in pd.read_csv(data_file, sep="\t", header=None, chunksize=chunksize):
+            writer.append(list(df.iloc[:, 0]),
+                          convert_tokens_seq_str_2_batch(list(df.iloc[:, 1]), list(df.iloc[:, 2]), max_length))
+            total += len(df)
+
+    print("combined feature matrix shape after one-hot encode is ", (total, 6, max_length))
     print(f"Data saved to {GREEN}{output_file}{RESET}")
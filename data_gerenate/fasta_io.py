@@ -0,0 +1,100 @@
+import gzip
+import os
+import re
+
+"""
+流式读写 FASTA（支持普通文本与 gzip），读取时即时规范化标题行，不再改写输入文件。
+"""
+
+_HEADER_WHITESPACE = re.compile(r'[\s\t]+')
+_GZIP_MAGIC = b"\x1f\x8b"
+
+
+def is_gzip_file(path):
+    with open(path, "rb") as infile:
+        return infile.read(2) == _GZIP_MAGIC
+
+
+def open_text(path, mode="r"):
+    """
+    以文本方式打开文件，.gz 结尾（或读取时检测到 gzip 文件头）的文件按 gzip 读写。
+    """
+    if path.endswith(".gz") or ("r" in mode and is_gzip_file(path)):
+        return gzip.open(path, mode + "t")
+    return open(path, mode)
+
+
+def fasta_stem(path):
+    """
+    去掉 .gz 和 FASTA 扩展名后的路径，用于生成同名的 .h5 等文件。
+    """
+    if path.endswith(".gz"):
+        path = path[:-3]
+    return os.path.splitext(path)[0]
+
+
+def normalize_header(header, replacement='|'):
+    """
+    将标题行中的空白字符替换为 replacement，例如 '>chr1 100 200' -> '>chr1|100|200'。
+    """
+    return _HEADER_WHITESPACE.sub(replacement, header.strip())
+
+
+def iter_fasta(fasta_path, normalize_headers=True, replacement='|'):
+    """
+    逐条读取 FASTA 文件（普通文本或 gzip），返回 (header, sequence)。
+
+    参数:
+        fasta_path (str): FASTA 文件路径。
+        normalize_headers (bool): 是否即时规范化标题行（见 normalize_header）。
+        replacement (str): 替换标题行空白字符的字符。
+
+    返回:
+        generator: header 保留 '>' 前缀，sequence 为拼接后的多行序列。
+    """
+    header = None
+    seq_lines = []
+    with open_text(fasta_path, "r") as infile:
+        for line in infile:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith(">"):
+                if header is not None:
+                    yield header, "".join(seq_lines)
+                header = normalize_header(line, replacement) if normalize_headers else line
+                seq_lines = []
+            else:
+                seq_lines.append(line)
+    if header is not None:
+        yield header, "".join(seq_lines)
+
+
+def count_fasta_records(fasta_path):
+    """
+    统计 FASTA 文件中的序列数量。
+    """
+    with open_text(fasta_path, "r") as infile:
+        return sum(1 for line in infile if line.startswith(">"))
+
+
+def format_fasta(records):
+    """
+    将 (header, sequence) 记录格式化为 FASTA 文本，每条序列占一行。
+    """
+    return "".join(f"{header}\n{sequence}\n" for header, sequence in records)
+
+
+def write_fasta(records, fasta_path):
+    """
+    流式写出 FASTA 文件，.gz 结尾时按 gzip 压缩。
+
+    返回:
+        int: 写出的记录数。
+    """
+    count = 0
+    with open_text(fasta_path, "w") as outfile:
+        for header, sequence in records:
+            outfile.write(f"{header}\n{sequence}\n")
+            count += 1
+    return count
@@ -0,0 +1,170 @@
+import os
+import hashlib
+import sqlite3
+import subprocess
+import threading
+import numpy as np
+
+
+# 点括号结构的 2-bit 编码：'.' -> 0, '(' -> 1, ')' -> 2
+_BRACKET_TO_CODE = np.full(256, 255, dtype=np.uint8)
+_BRACKET_TO_CODE[ord(".")] = 0
+_BRACKET_TO_CODE[ord("(")] = 1
+_BRACKET_TO_CODE[ord(")")] = 2
+_CODE_TO_BRACKET = np.frombuffer(b".()", dtype=np.uint8)
+
+_rnafold_versions = {}
+
+
+def default_fold_cache_path():
+    """
+    默认的折叠缓存路径，可通过环境变量 MUSIC_FOLD_CACHE 覆盖。
+    """
+    return os.environ.get(
+        "MUSIC_FOLD_CACHE",
+        os.path.join(os.path.expanduser("~"), ".cache", "music", "fold_cache.sqlite")
+    )
+
+
+def rnafold_params(rnafold, fold_args):
+    """
+    生成缓存键中的折叠参数部分：RNAfold 版本 + 命令行参数。
+
+    参数:
+        rnafold (str): RNAfold 可执行文件路径。
+        fold_args (tuple): RNAfold 参数。
+
+    返回:
+        str: 折叠参数字符串。
+    """
+    if rnafold not in _rnafold_versions:
+        result = subprocess.run([rnafold, "--version"], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                universal_newlines=True)
+        _rnafold_versions[rnafold] = result.stdout.strip()
+    return "{}|{}".format(_rnafold_versions[rnafold], " ".join(fold_args))
+
+
+def normalize_fold_sequence(sequence):
+    """
+    RNAfold 对大小写不敏感并将 T 视为 U，缓存键按同样的规则归一化。
+    """
+    return sequence.upper().replace("T", "U")
+
+
+def sequence_digest(sequence, params):
+    return hashlib.sha1(f"{params}\0{normalize_fold_sequence(sequence)}".encode()).digest()
+
+
+def encode_brackets(structure):
+    """
+    将点括号结构压缩为 2-bit 编码（每字节 4 个位置）。
+
+    返回:
+        bytes 或 None: 结构中包含 '.()' 以外的字符时返回 None。
+    """
+    codes = _BRACKET_TO_CODE[np.frombuffer(structure.encode(), dtype=np.uint8)]
+    if (codes == 255).any():
+        return None
+    codes = np.concatenate([codes, np.zeros((-len(codes)) % 4, dtype=np.uint8)]).reshape(-1, 4)
+    packed = codes[:, 0] | (codes[:, 1] << 2) | (codes[:, 2] << 4) | (codes[:, 3] << 6)
+    return packed.astype(np.uint8).tobytes()
+
+
+def decode_brackets(packed, length):
+    """
+    将 2-bit 编码还原为点括号结构。
+    """
+    packed = np.frombuffer(packed, dtype=np.uint8)
+    codes = np.stack([packed & 3, (packed >> 2) & 3, (packed >> 4) & 3, (packed >> 6) & 3], axis=1).reshape(-1)
+    return _CODE_TO_BRACKET[codes[:length]].tobytes().decode()
+
+
+class FoldCache(object):
+    """
+    以序列摘要为键的持久化折叠缓存（SQLite）。
+
+    键为 sha1(折叠参数 + 归一化序列)，值为 MFE 结构（2-bit 编码）和自由能。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS folds ("
+            "digest BLOB PRIMARY KEY, length INTEGER, structure BLOB, energy REAL)"
+        )
+        self.conn.commit()
+
+    def get_many(self, sequences, params):
+        """
+        批量查询缓存。
+
+        参数:
+            sequences (list): 序列列表。
+            params (str): 折叠参数，见 rnafold_params。
+
+        返回:
+            list: 与输入对应的 (structure, energy)，未命中为 None。
+        """
+        digests = [sequence_digest(seq, params) for seq in sequences]
+        found = {}
+        with self.lock:
+            # SQLite 默认最多 999 个绑定参数
+            for i in range(0, len(digests), 900):
+                chunk = digests[i:i + 900]
+                rows = self.conn.execute(
+                    "SELECT digest, length, structure, energy FROM folds WHERE digest IN ({})".format(
+                        ",".join("?" * len(chunk))),
+                    chunk
+                ).fetchall()
+                for digest, length, structure, energy in rows:
+                    found[bytes(digest)] = (decode_brackets(structure, length), energy)
+        return [found.get(digest) for digest in digests]
+
+    def put_many(self, items, params):
+        """
+        批量写入缓存。
+
+        参数:
+            items (list): (sequence, structure, energy) 列表。
+            params (str): 折叠参数。
+        """
+        rows = []
+        for sequence, structure, energy in items:
+            packed = encode_brackets(structure)
+            if packed is None:
+                continue
+            rows.append((sequence_digest(sequence, params), len(structure), packed, energy))
+        if not rows:
+            return
+        with self.lock:
+            self.conn.executemany("INSERT OR REPLACE INTO folds VALUES (?, ?, ?, ?)", rows)
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def open_fold_cache(fold_cache=None):
+    """
+    打开折叠缓存。
+
+    参数:
+        fold_cache: None 使用默认路径，False 关闭缓存，str 为缓存文件路径，
+                    也可以直接传入 FoldCache 实例。
+
+    返回:
+        FoldCache 或 None。
+    """
+    if fold_cache is False:
+        return None
+    if isinstance(fold_cache, FoldCache):
+        return fold_cache
+    return FoldCache(fold_cache or default_fold_cache_path())
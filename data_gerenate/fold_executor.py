@@ -0,0 +1,368 @@
+import os
+import subprocess
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+
+from .fold_cache import FoldCache, open_fold_cache, rnafold_params, normalize_fold_sequence
+from .fasta_io import iter_fasta, format_fasta
+
+# 默认的 RNAfold 参数：-p 同时计算配分函数，--noPS 不输出结构图
+DEFAULT_FOLD_ARGS = ("-p", "--noPS")
+
+
+class FoldCancelled(RuntimeError):
+    """
+    折叠因 stop 事件被取消。
+    """
+
+
+def default_fold_workers():
+    """
+    默认的折叠并发数：使用机器上全部 CPU 核心。
+    """
+    return os.cpu_count() or 1
+
+
+def iter_shards(records, shard_size):
+    """
+    将记录流按 shard_size 切分成若干分片。
+    """
+    shard = []
+    for record in records:
+        shard.append(record)
+        if len(shard) >= shard_size:
+            yield shard
+            shard = []
+    if shard:
+        yield shard
+
+
+def check_sequences(records):
+    """
+    逐条检查记录流：RNAfold 不为空序列输出任何记录，分片结果又按位置与输入对应，因此空序列直接抛出 ValueError。
+    """
+    for header, sequence in records:
+        if not sequence:
+            raise ValueError(f"{header} has an empty sequence; remove it from the input before folding")
+        yield header, sequence
+
+
+class FoldProgress(object):
+    """
+    折叠进度：由折叠工作线程在每条记录完成时直接上报，不再轮询输出文件。
+
+    提供已完成序列数、序列/秒、预计剩余时间以及每个工作线程的吞吐量。
+    """
+
+    def __init__(self, total, desc="Folding RNA"):
+        self.total = total
+        self.done = 0
+        self.worker_counts = {}
+        self.start_time = time.time()
+        self.lock = threading.Lock()
+        self.pbar = tqdm(total=total, desc=desc, unit="seq")
+
+    def update(self, n=1, worker=None):
+        """
+        上报 n 条记录折叠完成，worker 默认为当前线程名。
+        """
+        worker = worker or threading.current_thread().name
+        with self.lock:
+            self.done += n
+            self.worker_counts[worker] = self.worker_counts.get(worker, 0) + n
+            self.pbar.update(n)
+
+    def rate(self):
+        elapsed = time.time() - self.start_time
+        return self.done / elapsed if elapsed > 0 else 0.0
+
+    def eta(self):
+        rate = self.rate()
+        return (self.total - self.done) / rate if rate > 0 else float("inf")
+
+    def worker_throughput(self):
+        """
+        每个工作线程的吞吐量（序列/秒）。
+        """
+        elapsed = max(time.time() - self.start_time, 1e-9)
+        with self.lock:
+            return {worker: count / elapsed for worker, count in sorted(self.worker_counts.items())}
+
+    def snapshot(self):
+        return {
+            "done": self.done,
+            "total": self.total,
+            "seq_per_s": self.rate(),
+            "eta_s": self.eta(),
+            "workers": self.worker_throughput(),
+        }
+
+    def summary(self):
+        workers = ", ".join(f"{worker}: {rate:.1f}" for worker, rate in self.worker_throughput().items())
+        return (f"Folded {self.done}/{self.total} sequences in {time.time() - self.start_time:.1f}s "
+                f"({self.rate():.1f} seq/s; per worker seq/s: {workers})")
+
+    def close(self):
+        self.pbar.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _feed_stdin(stdin, text):
+    try:
+        stdin.write(text)
+        stdin.close()
+    except BrokenPipeError:
+        # RNAfold 已被终止（取消折叠）
+        pass
+
+
+def fold_shard(shard, rnafold="RNAfold", fold_args=DEFAULT_FOLD_ARGS, cwd=None, progress=None, stop=None):
+    """
+    使用一个 RNAfold 进程折叠一个分片，边读取输出边上报每条完成的记录。
+
+    参数:
+        shard (list): (header, sequence) 列表。
+        rnafold (str): RNAfold 可执行文件路径。
+        fold_args (tuple): RNAfold 参数。
+        cwd (str): 在该目录下为 RNAfold 创建临时工作目录。
+        progress (FoldProgress): 折叠进度，可为 None。
+        stop (threading.Event): 若被设置，在下一条记录完成时终止 RNAfold 并抛出 FoldCancelled，可为 None。
+
+    返回:
+        str: 该分片的 RNAfold 输出文本。
+    """
+    if stop is not None and stop.is_set():
+        raise FoldCancelled()
+    fasta_text = format_fasta(shard)
+    output_lines = []
+
+    def tee(stdout):
+        for line in stdout:
+            output_lines.append(line)
+            yield line
+
+    # -p 会写出 *_dp.ps 点图，放在临时工作目录中随目录一起删除
+    with tempfile.TemporaryDirectory(dir=cwd) as workdir:
+        proc = subprocess.Popen(
+            [rnafold, *fold_args],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+            cwd=workdir
+        )
+        writer = threading.Thread(target=_feed_stdin, args=(proc.stdin, fasta_text), daemon=True)
+        writer.start()
+        cancelled = False
+        for _ in iter_fold_records(tee(proc.stdout)):
+            if progress is not None:
+                progress.update(1)
+            if stop is not None and stop.is_set():
+                proc.kill()
+                cancelled = True
+                break
+        writer.join()
+        returncode = proc.wait()
+        proc.stdout.close()
+    if cancelled:
+        raise FoldCancelled()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, [rnafold, *fold_args])
+    return "".join(output_lines)
+
+
+def split_fold_output(text):
+    """
+    按 '>' 标题行把 RNAfold 输出切分为单条记录的文本。
+    """
+    records = []
+    for line in text.splitlines(True):
+        if line.startswith(">") or not records:
+            records.append(line)
+        else:
+            records[-1] += line
+    return records
+
+
+def parse_mfe_line(line):
+    """
+    解析 MFE 结构行，例如 '((...)). ( -1.20)'。
+
+    返回:
+        (str, float): 点括号结构和自由能。
+    """
+    structure = line.split()[0]
+    energy = float(line[len(structure):].strip().strip("()"))
+    return structure, energy
+
+
+def iter_fold_records(lines):
+    """
+    流式解析 RNAfold 输出：以 '>' 标题行划分记录，每条记录只读取其后的序列行和 MFE 结构行，
+    其余行（-p 输出的配分函数、质心结构等）直接跳过，因此同时兼容 MFE-only 与 -p 两种输出格式。
+
+    参数:
+        lines (iterable): RNAfold 输出的行（文件对象或行列表）。
+
+    返回:
+        generator: (header, sequence, structure, energy)。
+    """
+    header = None
+    sequence = None
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith(">"):
+            header = line
+            sequence = None
+        elif header is None:
+            continue
+        elif sequence is None:
+            sequence = line
+        else:
+            structure, energy = parse_mfe_line(line)
+            yield header, sequence, structure, energy
+            header = None
+
+
+def iter_fold_result_file(fold_result_file):
+    """
+    逐条读取 RNAfold 结果文件，内存占用与文件大小无关。
+    """
+    with open(fold_result_file, "r") as infile:
+        yield from iter_fold_records(infile)
+
+
+def format_mfe_record(header, sequence, structure, energy):
+    """
+    以 RNAfold MFE 输出格式（不含 -p 的配分函数行）生成一条记录。
+    """
+    return f"{header}\n{sequence}\n{structure} ({energy:6.2f})\n"
+
+
+def fold_shard_cached(shard, hits, rnafold="RNAfold", fold_args=DEFAULT_FOLD_ARGS, cwd=None, progress=None, stop=None):
+    """
+    只折叠分片中未命中缓存的序列，并按原顺序拼接命中与新折叠的记录。
+
+    参数:
+        shard (list): (header, sequence) 列表。
+        hits (list): 与 shard 对应的缓存结果 (structure, energy)，未命中为 None。
+        progress (FoldProgress): 折叠进度，可为 None。
+        stop (threading.Event): 取消折叠的事件，见 fold_shard，可为 None。
+
+    返回:
+        (str, list): 分片输出文本，以及需要写入缓存的 (sequence, structure, energy)。
+    """
+    misses = [record for record, hit in zip(shard, hits) if hit is None]
+    folded = split_fold_output(fold_shard(misses, rnafold, fold_args, cwd, progress, stop)) if misses else []
+
+    outputs = []
+    new_entries = []
+    folded_iter = iter(folded)
+    for (header, sequence), hit in zip(shard, hits):
+        if hit is None:
+            record_text = next(folded_iter)
+            for _, _, structure, energy in iter_fold_records(record_text.splitlines()):
+                new_entries.append((sequence, structure, energy))
+            outputs.append(record_text)
+        else:
+            structure, energy = hit
+            outputs.append(format_mfe_record(header, normalize_fold_sequence(sequence), structure, energy))
+    return "".join(outputs), new_entries
+
+
+def fold_records(records, rnafold="RNAfold", fold_args=DEFAULT_FOLD_ARGS, fold_workers=None, shard_size=128, cwd=None,
+                 fold_cache=None, progress=None, stop=None):
+    """
+    分片并行折叠：将输入切分为分片，用有界的线程池同时运行多个 RNAfold 进程，
+    并按输入顺序依次返回每个分片的结果。折叠前先查询折叠缓存，只折叠未命中的序列。
+
+    参数:
+        records (iterable): (header, sequence) 记录流，序列不能为空（见 check_sequences）。
+        rnafold (str): RNAfold 可执行文件路径。
+        fold_args (tuple): RNAfold 参数。
+        fold_workers (int): 并发的 RNAfold 进程数，None 表示使用全部核心。
+        shard_size (int): 每个分片包含的序列数。
+        cwd (str): RNAfold 的工作目录。
+        fold_cache: 折叠缓存，见 open_fold_cache。
+        progress (FoldProgress): 折叠进度，每条记录完成时更新，可为 None。
+        stop (threading.Event): 若被设置，不再提交新分片，正在运行的 RNAfold 被终止，抛出 FoldCancelled，可为 None。
+
+    返回:
+        generator: (分片序列数, 分片 RNAfold 输出文本)，顺序与输入一致。
+    """
+    fold_workers = fold_workers or default_fold_workers()
+    # 在途分片数量有上限，避免一次性把整个输入读入内存
+    max_pending = fold_workers * 2
+
+    cache = open_fold_cache(fold_cache)
+    params = rnafold_params(rnafold, fold_args) if cache is not None else None
+
+    def collect(n, future):
+        shard_output, new_entries = future.result()
+        if cache is not None:
+            cache.put_many(new_entries, params)
+        return n, shard_output
+
+    try:
+        with ThreadPoolExecutor(max_workers=fold_workers, thread_name_prefix="fold") as executor:
+            pending = deque()
+            try:
+                for shard in iter_shards(check_sequences(records), shard_size):
+                    if stop is not None and stop.is_set():
+                        raise FoldCancelled()
+                    if cache is not None:
+                        hits = cache.get_many([sequence for _, sequence in shard], params)
+                        if progress is not None:
+                            progress.update(sum(hit is not None for hit in hits), worker="cache")
+                    else:
+                        hits = [None] * len(shard)
+                    pending.append((len(shard), executor.submit(fold_shard_cached, shard, hits, rnafold, fold_args, cwd,
+                                                                progress, stop)))
+                    if len(pending) >= max_pending:
+                        yield collect(*pending.popleft())
+                while pending:
+                    yield collect(*pending.popleft())
+            finally:
+                # 提前结束（出错、取消或生成器被关闭）时，尚未开始的分片不再折叠，线程池只等待正在运行的分片
+                for _, future in pending:
+                    future.cancel()
+    finally:
+        if cache is not None and not isinstance(fold_cache, FoldCache):
+            cache.close()
+
+
+def run_parallel_rnafold(input_file_path, output_file, rnafold="RNAfold", fold_workers=None, cwd=None, fold_cache=None,
+                         progress=None):
+    """
+    并行折叠整个 FASTA 文件，并按输入顺序合并写入 output_file。
+
+    参数:
+        input_file_path (str): 输入 FASTA 文件路径（普通文本或 gzip），标题行在读取时规范化。
+        output_file (str): RNAfold 结果文件路径。
+        rnafold (str): RNAfold 可执行文件路径。
+        fold_workers (int): 并发的 RNAfold 进程数。
+        cwd (str): RNAfold 的工作目录。
+        fold_cache: 折叠缓存，见 open_fold_cache。
+        progress (FoldProgress): 折叠进度，可为 None。
+
+    返回:
+        int: 折叠的序列数。
+    """
+    total = 0
+    with open(output_file, "w") as outfile:
+        for n, shard_output in fold_records(iter_fasta(input_file_path), rnafold=rnafold,
+                                            fold_workers=fold_workers, cwd=cwd, fold_cache=fold_cache,
+                                            progress=progress):
+            outfile.write(shard_output)
+            total += n
+    return total
@@ -0,0 +1,204 @@
+import hashlib
+import json
+import os
+import h5py
+import numpy as np
+
+from .fasta_io import iter_fasta
+from .fold_cache import rnafold_params
+from .fold_executor import DEFAULT_FOLD_ARGS, FoldProgress, default_fold_workers, iter_shards
+from .data_utils import H5Appender, H5_STORAGE_TOKENS, h5_storage, h5_windows
+from .h5_pipeline import fasta_to_h5
+
+"""
+inference h5 的内容校验缓存。
+
+每个生成的 h5 旁边保存一个清单 <h5>.manifest.json，记录 FASTA 内容摘要、编码版本、max_length、
+存储格式和折叠参数（RNAfold 版本 + 参数）；h5 中的 record_digests 保存每条记录（规范化标题 + 序列）的 sha1。
+
+- 清单与当前输入完全一致：直接复用 h5。
+- 编码与折叠参数一致、只有 FASTA 内容变化：只折叠摘要不在旧 h5 中的记录，其余记录直接从旧 h5 复制。
+- 其他情况（没有清单、编码或折叠参数变化）：全部重新生成。
+"""
+
+# 编码方式变化时递增，旧的 h5 会被整体重建
+H5_ENCODER_VERSION = "seq_4+str_2/v1"
+
+
+def manifest_path(h5_file):
+    return h5_file + ".manifest.json"
+
+
+def read_manifest(h5_file):
+    """
+    读取 h5 的清单，h5 或清单不存在时返回 None。
+    """
+    path = manifest_path(h5_file)
+    if not os.path.exists(h5_file) or not os.path.exists(path):
+        return None
+    with open(path, "r") as infile:
+        return json.load(infile)
+
+
+def write_manifest(h5_file, manifest):
+    tmp_path = manifest_path(h5_file) + ".tmp"
+    with open(tmp_path, "w") as outfile:
+        json.dump(manifest, outfile, indent=2)
+    os.replace(tmp_path, manifest_path(h5_file))
+
+
+def record_digest(header, sequence):
+    return hashlib.sha1(f"{header}\0{sequence}".encode()).digest()
+
+
+def fasta_record_digests(fasta_path):
+    """
+    流式计算 FASTA 中每条记录的摘要。
+
+    返回:
+        np.ndarray: (N, 20) uint8。
+    """
+    digests = bytearray()
+    for header, sequence in iter_fasta(fasta_path):
+        digests += record_digest(header, sequence)
+    return np.frombuffer(bytes(digests), dtype=np.uint8).reshape(-1, 20)
+
+
+def _same_encoding(old, new):
+    """
+    旧 h5 中的记录能否直接复用：编码版本、长度、存储格式一致，且折叠参数一致（无法确定当前折叠参数时不比较）。
+    """
+    keys = ["encoder_version", "max_length", "storage"]
+    if new["fold_params"] is not None:
+        keys.append("fold_params")
+    return all(old.get(key) == new[key] for key in keys)
+
+
+def _merge_h5(fasta_path, output_file, digests, old_file, old_rows, delta_file, max_length, storage,
+              batch_size=4096):
+    """
+    按新 FASTA 的顺序合并：未变化的记录从旧 h5 复制，变化的记录依次从 delta h5 读取。
+    """
+    with H5Appender(output_file, max_length, storage=storage, record_digests=True) as writer:
+        old_h5 = h5py.File(old_file, "r") if old_file is not None else None
+        delta_h5 = h5py.File(delta_file, "r") if delta_file is not None else None
+        try:
+            delta_pos = 0
+            for start, batch in enumerate_batches(iter_fasta(fasta_path), batch_size):
+                batch_digests = digests[start:start + len(batch)]
+                rows = old_rows[start:start + len(batch)]
+                names = [header for header, _ in batch]
+                windows = np.empty((len(batch),) + writer.windows.shape[1:], dtype=writer.windows.dtype)
+
+                copied = np.flatnonzero(rows >= 0)
+                if len(copied):
+                    # h5py 的花式索引要求递增且不重复
+                    unique_rows, inverse = np.unique(rows[copied], return_inverse=True)
+                    windows[copied] = h5_windows(old_h5)[unique_rows][inverse]
+
+                folded = np.flatnonzero(rows < 0)
+                if len(folded):
+                    windows[folded] = h5_windows(delta_h5)[delta_pos:delta_pos + len(folded)]
+                    for i, name in zip(folded, delta_h5["rna_names"][delta_pos:delta_pos + len(folded)]):
+                        names[i] = name
+                    delta_pos += len(folded)
+
+                writer.append(names, windows, digests=batch_digests)
+        finally:
+            for h5f in (old_h5, delta_h5):
+                if h5f is not None:
+                    h5f.close()
+
+
+def enumerate_batches(records, batch_size):
+    start = 0
+    for batch in iter_shards(records, batch_size):
+        yield start, batch
+        start += len(batch)
+
+
+def build_inference_h5(fasta_path, output_file, rnafold="RNAfold", target_directory=None, fold_workers=None,
+                       fold_cache=None, annotation_file=None, max_length=200, storage=H5_STORAGE_TOKENS):
+    """
+    生成或更新 FASTA 对应的 h5：内容未变时直接复用，变化时只重新折叠变化的记录。
+
+    参数:
+        fasta_path (str): 输入 FASTA 文件路径。
+        output_file (str): h5 文件路径，清单保存在 output_file + ".manifest.json"。
+        rnafold (str): RNAfold 可执行文件路径。
+        target_directory (str): RNAfold 的工作目录。
+        fold_workers (int): 并发的 RNAfold 进程数，None 表示使用全部核心。
+        fold_cache: 折叠缓存，见 open_fold_cache。
+        annotation_file (str): 若指定，保存注释 TSV（需要全部记录，因此会整体重建）。
+        max_length (int): 编码长度。
+        storage (str): h5 存储格式。
+
+    返回:
+        str: 本次的处理方式，"reused"、"updated" 或 "rebuilt"。
+    """
+    GREEN = "\033[32m"
+    RESET = "\033[0m"
+
+    try:
+        fold_params = rnafold_params(rnafold, DEFAULT_FOLD_ARGS)
+    except OSError:
+        # 没有 RNAfold 时无法确认折叠参数，只按内容和编码判断能否复用
+        print(f"{rnafold} not found, fold parameters of {output_file} cannot be checked.")
+        fold_params = None
+
+    digests = fasta_record_digests(fasta_path)
+    manifest = {
+        "fasta_digest": hashlib.sha1(digests.tobytes()).hexdigest(),
+        "n_records": len(digests),
+        "encoder_version": H5_ENCODER_VERSION,
+        "max_length": max_length,
+        "storage": storage,
+        "fold_params": fold_params,
+    }
+
+    old = read_manifest(output_file)
+    if old is not None and _same_encoding(old, manifest) and old.get("fasta_digest") == manifest["fasta_digest"] \
+            and annotation_file is None:
+        print(f"{GREEN}{output_file}{RESET} is up to date with {fasta_path}, reusing it.")
+        return "reused"
+
+    # 找出旧 h5 中可以复用的记录
+    old_file = None
+    old_rows = np.full(len(digests), -1, dtype=np.int64)
+    if old is not None and _same_encoding(old, manifest) and annotation_file is None:
+        with h5py.File(output_file, "r") as h5f:
+            if "record_digests" in h5f and h5_storage(h5f) == storage:
+                old_index = {digest.tobytes(): row for row, digest in enumerate(h5f["record_digests"][:])}
+                old_rows = np.array([old_index.get(digest.tobytes(), -1) for digest in digests], dtype=np.int64)
+                old_file = output_file
+    changed = old_rows < 0
+    n_changed = int(changed.sum())
+    if old_file is not None:
+        print(f"{output_file} is stale: {len(digests) - n_changed} records unchanged, {n_changed} to fold.")
+    elif os.path.exists(output_file):
+        print(f"{output_file} was built with different inputs or settings, rebuilding it.")
+
+    delta_file = None
+    try:
+        if n_changed:
+            delta_file = output_file + ".delta"
+            print(f"Start using RNAfold folding {GREEN}{fasta_path}{RESET}")
+            fold_workers = fold_workers or default_fold_workers()
+            print(f"Total sequences to fold: {n_changed} ({fold_workers} RNAfold workers)")
+            if target_directory:
+                os.makedirs(target_directory, exist_ok=True)
+            records = (record for record, is_changed in zip(iter_fasta(fasta_path), changed) if is_changed)
+            with FoldProgress(n_changed, desc="Folding RNA") as progress:
+                fasta_to_h5(fasta_path, delta_file, rnafold=rnafold, fold_workers=fold_workers,
+                            cwd=target_directory, fold_cache=fold_cache, progress=progress, max_length=max_length,
+                            annotation_file=annotation_file, storage=storage, records=records)
+            print(progress.summary())
+        _merge_h5(fasta_path, output_file, digests, old_file, old_rows, delta_file, max_length, storage)
+    finally:
+        if delta_file is not None and os.path.exists(delta_file):
+            os.remove(delta_file)
+    write_manifest(output_file, manifest)
+
+    print("combined feature matrix shape after one-hot encode is ", (len(digests), 6, max_length))
+    print(f"Data saved to {GREEN}{output_file}{RESET}")
+    return "updated" if old_file is not None else "rebuilt"
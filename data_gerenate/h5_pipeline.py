@@ -0,0 +1,148 @@
+import os
+import queue
+import threading
+
+from .fold_executor import fold_records, iter_fold_records
+from .fasta_io import iter_fasta
+from .structure_annotator import annotate_structures
+from .data_utils import H5Appender, H5_STORAGE_TOKENS
+from .one_hot_encode_decode import convert_tokens_seq_str_2_batch
+
+"""
+FASTA -> RNAfold -> 结构注释 -> one-hot 编码 -> h5 的流式流水线。
+
+各阶段运行在各自的线程中，阶段之间用有界队列连接：
+    折叠（fold_records，内部再并行多个 RNAfold 进程）
+      -> 注释（annotate_structures，按批向量化）
+      -> 编码为 token 并追加写入 h5（H5Appender）
+任一时刻在途的数据只有队列容量 x 批大小条记录，内存占用与输入规模无关。
+中间的 RNAfold 结果文件不再生成，注释 TSV 只在指定 annotation_file 时写出。
+任一阶段（包括写 h5）出错时，通过 stop 事件通知其余阶段停止、终止正在运行的 RNAfold，等待所有线程退出后再抛出异常。
+"""
+
+_DONE = object()
+
+
+class _StageError(object):
+    def __init__(self, exc):
+        self.exc = exc
+
+
+def _run_stage(target, out_queue):
+    """
+    在线程中运行一个阶段，结束时向下游发送 _DONE，异常则转交给下游重新抛出。
+    """
+    try:
+        target()
+    except BaseException as exc:
+        out_queue.put(_StageError(exc))
+    else:
+        out_queue.put(_DONE)
+
+
+def _iter_queue(in_queue):
+    while True:
+        item = in_queue.get()
+        if item is _DONE:
+            return
+        if isinstance(item, _StageError):
+            raise item.exc
+        yield item
+
+
+def _drain(in_queue):
+    """
+    丢弃队列中现有的全部元素，使阻塞在 put() 上的上游阶段得以继续。
+    """
+    while True:
+        try:
+            in_queue.get_nowait()
+        except queue.Empty:
+            return
+
+
+def fasta_to_h5(fasta_path, output_file, rnafold="RNAfold", fold_workers=None, cwd=None, fold_cache=None,
+                progress=None, max_length=200, batch_size=1024, queue_size=4, annotation_file=None,
+                storage=H5_STORAGE_TOKENS, records=None):
+    """
+    流式地将 FASTA 折叠、注释、编码并写入 h5。
+
+    参数:
+        fasta_path (str): 输入 FASTA 文件路径（普通文本或 gzip），标题行在读取时规范化，输入文件不会被改写。
+        output_file (str): 输出 h5 文件路径。
+        rnafold (str): RNAfold 可执行文件路径。
+        fold_workers (int): 并发的 RNAfold 进程数，None 表示使用全部核心。
+        cwd (str): RNAfold 的工作目录。
+        fold_cache: 折叠缓存，见 open_fold_cache。
+        progress (FoldProgress): 折叠进度，可为 None。
+        max_length (int): one-hot 编码的长度。
+        batch_size (int): 注释与编码阶段每批的记录数。
+        queue_size (int): 阶段之间队列的容量（批数）。
+        annotation_file (str): 若指定，同时写出 header/seq/struct_2 的注释 TSV。
+        storage (str): h5 存储格式，"tokens"（默认）或 "one_hot"，见 H5Appender。
+        records (iterable): 若指定，折叠这些 (header, sequence) 记录而不是读取 fasta_path。
+
+    返回:
+        int: 写入 h5 的记录数。
+    """
+    folded = queue.Queue(maxsize=queue_size)
+    annotated = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+
+    def fold_stage():
+        batch = []
+        source = iter_fasta(fasta_path) if records is None else records
+        for _, shard_output in fold_records(source, rnafold=rnafold,
+                                            fold_workers=fold_workers, cwd=cwd, fold_cache=fold_cache,
+                                            progress=progress, stop=stop):
+            for header, sequence, structure, _ in iter_fold_records(shard_output.splitlines()):
+                batch.append((header, sequence, structure))
+            if len(batch) >= batch_size:
+                folded.put(batch)
+                batch = []
+        if batch:
+            folded.put(batch)
+
+    def annotate_stage():
+        outfile = None
+        if annotation_file is not None:
+            dirname = os.path.dirname(annotation_file)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            outfile = open(annotation_file, "w")
+        try:
+            for batch in _iter_queue(folded):
+                if stop.is_set():
+                    return
+                headers, sequences, structures = zip(*batch)
+                _, _, struct_2 = annotate_structures(list(structures))
+                if outfile is not None:
+                    outfile.writelines(f"{header}\t{sequence}\t{structure}\n"
+                                       for header, sequence, structure in zip(headers, sequences, struct_2))
+                annotated.put((headers, sequences, struct_2))
+        finally:
+            if outfile is not None:
+                outfile.close()
+
+    threads = [
+        threading.Thread(target=_run_stage, args=(fold_stage, folded), daemon=True),
+        threading.Thread(target=_run_stage, args=(annotate_stage, annotated), daemon=True),
+    ]
+    for thread in threads:
+        thread.start()
+
+    total = 0
+    try:
+        with H5Appender(output_file, max_length, storage=storage) as writer:
+            for headers, sequences, struct_2 in _iter_queue(annotated):
+                writer.append(headers, convert_tokens_seq_str_2_batch(sequences, struct_2, max_length))
+                total += len(headers)
+    finally:
+        # 正常结束时各阶段已经退出；出错时通知它们停止，并不断清空队列，直到阻塞在 put() 上的阶段全部退出
+        stop.set()
+        for thread in threads:
+            while thread.is_alive():
+                _drain(folded)
+                _drain(annotated)
+                thread.join(timeout=0.05)
+    return total
@@ -389,4 +389,224 @@ def decode_seq_str_28(m):
 def combine_one_hot_matrix(matrices, axis=0):
     combined_matrix = np.concatenate(matrices, axis=axis)
     # print(f"Combined shape: {combined_matrix.shape}")
-    return combined_matrix
\ No newline at end of file
+    return combined_matrix
+
+# 批量编码：各编码方式的通道顺序（与上面逐条编码函数中的映射一致）
+SEQ_4_ALPHABET = "ACGU"
+STR_2_ALPHABET = "UP"
+STR_4_ALPHABET = "PLUM"
+STR_7_ALPHABET = "BEHLMRT"
+SEQ_STR_8_ALPHABET = "ABCDEFGH"
+SEQ_STR_16_ALPHABET = "ABCDEFGHIJKLMNOP"
+SEQ_STR_28_ALPHABET = "ABCDEFGHIJKLMNOPQRSTUVWXYZab"
+
+# 删除 ASCII 非字母字符的 str.translate 表（seq_str_28 只保留字母）
+_DELETE_NON_ALPHA = {code: None for code in range(128) if not chr(code).isalpha()}
+
+
+def _channel_lut(alphabet):
+    """
+    字节 -> 通道号的查找表，不在字母表中的字符为 -1（该位置全 0）。
+    """
+    lut = np.full(256, -1, dtype=np.int8)
+    for i, letter in enumerate(alphabet):
+        lut[ord(letter)] = i
+    return lut
+
+
+def _keep_alpha(text):
+    text = text.translate(_DELETE_NON_ALPHA)
+    # 剩余的非 ASCII 字符按 Unicode 规则判断
+    return text if text.isalpha() else "".join(char for char in text if char.isalpha())
+
+
+def channel_index_batch(sequences, alphabet, max_length, upper=True, alpha_only=False):
+    """
+    批量计算每个位置的通道号，截断与居中补零规则与逐条编码函数一致。
+
+    返回:
+        np.ndarray: (N, max_length) int8 矩阵，-1 表示补零或不在字母表中的字符（该列全 0）。
+    """
+    texts = [str(sequence) for sequence in sequences]
+    if upper:
+        texts = [text.upper() for text in texts]
+    if alpha_only:
+        texts = [_keep_alpha(text) for text in texts]
+    # 截断并居中补齐为定长文本（补齐字符 ' ' 不在任何字母表中），一次转换为 (N, max_length) 字节矩阵；
+    # 非 ASCII 字符编码为 '?'，同样不对应任何通道
+    padded = "".join((" " * ((max_length - len(text[:max_length])) // 2) + text[:max_length]).ljust(max_length)
+                     for text in texts)
+    codes = np.frombuffer(padded.encode("ascii", "replace"), dtype=np.uint8).reshape(len(texts), max_length)
+    return _channel_lut(alphabet)[codes]
+
+
+def convert_one_hot_batch(sequences, alphabet, max_length, upper=True, alpha_only=False, dtype=np.float32):
+    """
+    批量 one-hot 编码，结果与逐条编码函数完全一致（截断到 max_length，不足时左右居中补零）。
+
+    参数:
+        sequences (list): 字符串列表（或 numpy 字符串数组）。
+        alphabet (str): 通道顺序，第 i 个字母对应第 i 个通道。
+        max_length (int): 编码长度。
+        upper (bool): 是否先转换为大写。
+        alpha_only (bool): 是否先过滤掉非字母字符（seq_str_28 的行为）。
+        dtype: 输出的数据类型。
+
+    返回:
+        np.ndarray: (N, len(alphabet), max_length) 矩阵。
+    """
+    channel_matrix = channel_index_batch(sequences, alphabet, max_length, upper, alpha_only)
+    channel_ids = np.arange(len(alphabet), dtype=np.int8)
+    return (channel_matrix[:, None, :] == channel_ids[None, :, None]).astype(dtype)
+
+
+def convert_one_hot_seq_4_batch(sequences, max_length, dtype=np.float32):
+    return convert_one_hot_batch(sequences, SEQ_4_ALPHABET, max_length, dtype=dtype)
+
+
+def convert_one_hot_str_2_batch(sequences, max_length, dtype=np.float32):
+    return convert_one_hot_batch(sequences, STR_2_ALPHABET, max_length, dtype=dtype)
+
+
+def convert_one_hot_str_4_batch(sequences, max_length, dtype=np.float32):
+    return convert_one_hot_batch(sequences, STR_4_ALPHABET, max_length, dtype=dtype)
+
+
+def convert_one_hot_str_7_batch(sequences, max_length, dtype=np.float32):
+    return convert_one_hot_batch(sequences, STR_7_ALPHABET, max_length, dtype=dtype)
+
+
+def convert_one_hot_seq_str_8_batch(sequences, max_length, dtype=np.float32):
+    return convert_one_hot_batch(sequences, SEQ_STR_8_ALPHABET, max_length, dtype=dtype)
+
+
+def convert_one_hot_seq_str_16_batch(sequences, max_length, dtype=np.float32):
+    return convert_one_hot_batch(sequences, SEQ_STR_16_ALPHABET, max_length, dtype=dtype)
+
+
+def convert_one_hot_seq_str_28_batch(sequences, max_length, dtype=np.float32):
+    # 与 convert_one_hot_seq_str_28 一致：不转大写，只保留字母
+    return convert_one_hot_batch(sequences, SEQ_STR_28_ALPHABET, max_length, upper=False, alpha_only=True,
+                                 dtype=dtype)
+
+
+def decode_one_hot_batch(matrices, alphabet, skip_empty=True):
+    """
+    批量解码 (N, C, L) 的 one-hot 矩阵为字符串，与逐条解码函数一致：
+    每列只有一个通道为 1 时输出对应字母，否则（补零列等）跳过该列。
+
+    参数:
+        matrices (np.ndarray): (N, C, L) 矩阵。
+        alphabet (str): 通道顺序。
+        skip_empty (bool): False 时不跳过任何列，直接取 argmax（decode_seq_str_28 的行为）。
+
+    返回:
+        list: 解码后的字符串列表。
+    """
+    matrices = np.asarray(matrices)
+    alphabet_codes = np.frombuffer(alphabet.encode(), dtype=np.uint8)
+    if not skip_empty:
+        return [row.tobytes().decode() for row in alphabet_codes[np.argmax(matrices, axis=1)]]
+    hot = matrices == 1
+    return _join_columns(alphabet_codes[np.argmax(hot, axis=1)], hot.sum(axis=1) == 1)
+
+
+def _join_columns(letters, keep):
+    """
+    将 (N, L) 的字母矩阵按 keep 掩码逐行拼接为字符串。
+    """
+    text = letters[keep].tobytes().decode()
+    lengths = keep.sum(axis=1)
+    ends = np.cumsum(lengths)
+    return [text[end - length:end] for end, length in zip(ends, lengths)]
+
+
+def decode_seq_4_batch(matrices):
+    return decode_one_hot_batch(matrices, SEQ_4_ALPHABET)
+
+
+def decode_str_2_batch(matrices):
+    # 与 decode_str_2 一致：U 通道为 1 即为 'U'，否则 P 通道为 1 为 'P'
+    matrices = np.asarray(matrices)
+    is_u, is_p = matrices[:, 0] == 1, matrices[:, 1] == 1
+    return _join_columns(np.where(is_u, ord("U"), ord("P")).astype(np.uint8), is_u | is_p)
+
+
+def decode_str_4_batch(matrices):
+    return decode_one_hot_batch(matrices, STR_4_ALPHABET)
+
+
+def decode_str_7_batch(matrices):
+    return decode_one_hot_batch(matrices, STR_7_ALPHABET)
+
+
+def decode_seq_str_8_batch(matrices):
+    return decode_one_hot_batch(matrices, SEQ_STR_8_ALPHABET)
+
+
+def decode_seq_str_16_batch(matrices):
+    return decode_one_hot_batch(matrices, SEQ_STR_16_ALPHABET)
+
+
+def decode_seq_str_28_batch(matrices):
+    return decode_one_hot_batch(matrices, SEQ_STR_28_ALPHABET, skip_empty=False)
+
+
+"""
+紧凑的 token 存储格式（seq_4 + str_2）：每个位置一个 uint8，
+低 3 位为核苷酸编号（0 为空，1-4 对应 A/C/G/U），第 3-4 位为结构编号（0 为空，1 为 U，2 为 P）。
+每个窗口只占 max_length 字节，是 float32 6 通道矩阵的 1/24，读取后再按批展开为 one-hot。
+"""
+TOKEN_STRUCT_SHIFT = 3
+
+
+def _token_one_hot_lut():
+    """
+    token -> 6 通道列向量的查找表。
+    """
+    lut = np.zeros((1 << (TOKEN_STRUCT_SHIFT + 2), len(SEQ_4_ALPHABET) + len(STR_2_ALPHABET)), dtype=np.float32)
+    for token in range(len(lut)):
+        seq_code, str_code = token & ((1 << TOKEN_STRUCT_SHIFT) - 1), token >> TOKEN_STRUCT_SHIFT
+        if 0 < seq_code <= len(SEQ_4_ALPHABET):
+            lut[token, seq_code - 1] = 1
+        if 0 < str_code <= len(STR_2_ALPHABET):
+            lut[token, len(SEQ_4_ALPHABET) + str_code - 1] = 1
+    return lut
+
+
+TOKEN_ONE_HOT_LUT = _token_one_hot_lut()
+
+
+def convert_tokens_seq_str_2_batch(sequences, structures, max_length):
+    """
+    直接将序列和 2-letter 结构编码为 token，等价于 encode_tokens(seq_4 + str_2 的 one-hot 矩阵)。
+
+    返回:
+        np.ndarray: (N, max_length) uint8。
+    """
+    seq_index = channel_index_batch(sequences, SEQ_4_ALPHABET, max_length).astype(np.uint8) + 1
+    str_index = channel_index_batch(structures, STR_2_ALPHABET, max_length).astype(np.uint8) + 1
+    # 通道号 -1 加 1 后为 0，正好表示空位置
+    return seq_index | (str_index << TOKEN_STRUCT_SHIFT)
+
+
+def encode_tokens(matrices):
+    """
+    将 (N, 6, L) 的 seq_4 + str_2 one-hot 矩阵压缩为 (N, L) 的 uint8 token。
+
+    只有每列在序列和结构两部分中都至多一个通道为 1 时才能无损压缩，
+    可用 np.array_equal(expand_tokens(tokens), matrices) 检查。
+    """
+    matrices = np.asarray(matrices)
+    n_seq = len(SEQ_4_ALPHABET)
+    seq_part, str_part = matrices[:, :n_seq] == 1, matrices[:, n_seq:] == 1
+    seq_code = np.where(seq_part.any(axis=1), np.argmax(seq_part, axis=1) + 1, 0)
+    str_code = np.where(str_part.any(axis=1), np.argmax(str_part, axis=1) + 1, 0)
+    return (seq_code | (str_code << TOKEN_STRUCT_SHIFT)).astype(np.uint8)
+
+
+def expand_tokens(tokens, dtype=np.float32):
+    """
+    将 (N, L) 的 token 展开为 (N, 6, L) 的 one-hot 矩阵。
+    """
+    return np.ascontiguousarray(TOKEN_ONE_HOT_LUT[np.asarray(tokens)].transpose(0, 2, 1), dtype=dtype)
@@ -0,0 +1,156 @@
+import numpy as np
+
+"""
+点括号结构 -> 7-letter 结构注释（与 fold_str_annotion/parse_secondary_structure_v2.cpp 逐字节一致）
+
+Alphabet
+L : paired, 5' end  (
+R : paired, 3' end  )
+H : hairpin loop
+T : internal loop
+B : bulge loop
+M : multiloop
+E : external region
+"""
+
+STRUCT_7_ALPHABET = "BEHLMRT"
+_B, _E, _H, _L, _M, _R, _T = range(7)
+_N = 7  # 暂未确定的内环/多分支环，最后再区分为 T 或 M
+
+# 7-letter -> 4-letter -> 2-letter 的转换
+struct_7_convert_4 = {'B': 'M', 'E': 'U', 'H': 'L', 'L': 'P', 'M': 'M', 'R': 'P', 'T': 'M'}
+struct_4_convert_2 = {'P': 'P', 'L': 'U', 'U': 'U', 'M': 'U'}
+
+# 供已有 7-letter/4-letter 字符串使用的 str.translate 转换表
+STRUCT_7_TO_4 = str.maketrans(struct_7_convert_4)
+STRUCT_4_TO_2 = str.maketrans(struct_4_convert_2)
+STRUCT_7_TO_2 = str.maketrans({c: struct_4_convert_2[struct_7_convert_4[c]] for c in STRUCT_7_ALPHABET})
+
+_CODE_TO_STRUCT_7 = np.frombuffer(STRUCT_7_ALPHABET.encode(), dtype=np.uint8)
+
+
+def find_pairs(is_open, is_close):
+    """
+    批量配对：对每个括号求其配对位置（栈式配对的向量化版本）。
+
+    同一深度上的左右括号按位置排序后严格交替出现，相邻两个即为一对。
+
+    参数:
+        is_open (np.ndarray): (N, L) 布尔矩阵，'(' 位置。
+        is_close (np.ndarray): (N, L) 布尔矩阵，')' 位置。
+
+    返回:
+        np.ndarray: (N, L) 配对位置，未配对为 -1。
+    """
+    n, length = is_open.shape
+    depth = np.cumsum(is_open.astype(np.int32) - is_close.astype(np.int32), axis=1)
+    # '(' 的层级为其之后的深度，')' 的层级为其之前的深度
+    level = depth + is_close
+
+    flat = np.flatnonzero(is_open | is_close)
+    rows, cols = np.divmod(flat, length)
+    # 按 (行, 层级, 位置) 排序
+    key = (rows * (length + 1) + level.ravel()[flat]) * length + cols
+    flat = flat[np.argsort(key, kind="stable")]
+
+    pairs = np.full(n * length, -1, dtype=np.int64)
+    open_flat, close_flat = flat[0::2], flat[1::2]
+    pairs[open_flat] = close_flat % length
+    pairs[close_flat] = open_flat % length
+    return pairs.reshape(n, length)
+
+
+def _annotate_codes(codes):
+    """
+    对 (N, L) 的点括号字节矩阵做 7-letter 注释，返回 (N, L) 的注释编码。
+    """
+    n, length = codes.shape
+    is_open = codes == ord("(")
+    is_close = codes == ord(")")
+    is_paren = is_open | is_close
+    is_dot = ~is_paren
+    pairs = find_pairs(is_open, is_close)
+    depth = np.cumsum(is_open.astype(np.int32) - is_close.astype(np.int32), axis=1)
+
+    positions = np.arange(length)
+    row_base = (np.arange(n) * length)[:, None]
+
+    def gather(values, index):
+        return values.ravel()[row_base + index]
+
+    # 每个位置左侧（含自身）最近的括号 k，右侧（含自身）最近的括号 m
+    k = np.maximum.accumulate(np.where(is_paren, positions, -1), axis=1)
+    m = np.minimum.accumulate(np.where(is_paren, positions, length)[:, ::-1], axis=1)[:, ::-1]
+
+    k_safe = np.maximum(k, 0)
+    m_safe = np.minimum(m, length - 1)
+    k_open, k_close = gather(is_open, k_safe), gather(is_close, k_safe)
+    m_open, m_close = gather(is_open, m_safe), gather(is_close, m_safe)
+
+    alph = np.full((n, length), _E, dtype=np.uint8)
+    alph[is_open] = _L
+    alph[is_close] = _R
+    inner = is_dot & (k >= 0) & (m < length)
+    alph[inner & k_open & m_close] = _H
+    # m 与 k 的配对碱基相邻，说明该段未配对碱基属于 bulge，否则暂记为 N
+    same_side = inner & ((k_close & m_close) | (k_open & m_open))
+    consecutive = gather(pairs, m_safe) + 1 == gather(pairs, k_safe)
+    alph[same_side & consecutive] = _B
+    alph[same_side & ~consecutive] = _N
+    alph[inner & k_close & m_open & (gather(depth, k_safe) > 0)] = _M
+
+    # 多分支环：对每个 R 后紧跟 L 或 M 的位置，两侧茎区外的未配对区段都属于多分支环
+    next_alph = np.full((n, length), _E, dtype=np.uint8)
+    next_alph[:, :-1] = alph[:, 1:]
+    switch_rows, switch_cols = np.nonzero(is_close & ((next_alph == _L) | (next_alph == _M)))
+    # 未配对区段以其左侧最近的括号位置标识
+    marked = np.zeros((n, length), dtype=bool)
+
+    s = pairs[switch_rows, switch_cols] - 1
+    s_safe = np.maximum(s, 0)
+    left_key = k[switch_rows, s_safe]
+    left_ok = (s >= 0) & is_dot[switch_rows, s_safe] & (left_key >= 0)
+    marked[switch_rows[left_ok], left_key[left_ok]] = True
+
+    right_key = pairs[switch_rows, m[switch_rows, switch_cols + 1]]
+    e = right_key + 1
+    right_ok = (e < length) & is_dot[switch_rows, np.minimum(e, length - 1)]
+    marked[switch_rows[right_ok], right_key[right_ok]] = True
+
+    undetermined = alph == _N
+    alph[undetermined & gather(marked, k_safe)] = _M
+    alph[alph == _N] = _T
+    return alph
+
+
+def annotate_structures(structures, batch_size=65536):
+    """
+    批量注释点括号结构，一次调用同时给出 7-letter、4-letter 和 2-letter 结构。
+
+    参数:
+        structures (list): 点括号结构字符串列表。
+        batch_size (int): 每批处理的结构数，限制中间矩阵的内存。
+
+    返回:
+        (list, list, list): struct_7, struct_4, struct_2 字符串列表。
+    """
+    struct_7, struct_4, struct_2 = [], [], []
+    for start in range(0, len(structures), batch_size):
+        batch = structures[start:start + batch_size]
+        lengths = [len(structure) for structure in batch]
+        max_length = max(lengths) if lengths else 0
+        if max_length == 0:
+            struct_7.extend([""] * len(batch))
+            struct_4.extend([""] * len(batch))
+            struct_2.extend([""] * len(batch))
+            continue
+        # 末尾用 '.' 补齐：补齐部分右侧没有括号，只会被注释为 E，不影响原有位置
+        padded = "".join(structure.ljust(max_length, ".") for structure in batch)
+        codes = np.frombuffer(padded.encode(), dtype=np.uint8).reshape(len(batch), max_length)
+        alph = _annotate_codes(codes)
+        text_7 = _CODE_TO_STRUCT_7[alph].tobytes().decode()
+        # 整批一次 str.translate 完成 7-letter -> 4-letter / 2-letter 转换
+        for text, out in ((text_7, struct_7), (text_7.translate(STRUCT_7_TO_4), struct_4),
+                          (text_7.translate(STRUCT_7_TO_2), struct_2)):
+            out.extend(text[i * max_length:i * max_length + length] for i, length in enumerate(lengths))
+    return struct_7, struct_4, struct_2
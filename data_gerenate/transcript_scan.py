@@ -0,0 +1,205 @@
+import os
+from collections import deque
+
+import numpy as np
+
+from .fasta_io import iter_fasta, write_fasta
+from .fold_executor import fold_records, iter_fold_records
+from .structure_annotator import annotate_structures
+
+"""
+将完整转录本按滑动窗口切分成推理用的窗口，标题行与 data/predict_data 中预切分的窗口一致：
+    >转录本ID|起点|终点|转录本长度      （1 起始、闭区间）
+最后一个窗口与转录本末端对齐，短于窗口长度的转录本只有一个窗口。
+步长越小，每个核苷酸被越多的窗口覆盖，结合轨迹的分辨率越高，但窗口数（折叠与打分的工作量）约为 转录本长度 / 步长。
+密集扫描（DenseScanCNN）不切分窗口，而是折叠整条转录本（iter_folded_transcripts）后一次前向给出每个起点的窗口打分。
+密集扫描的折叠不计算配分函数（不加 -p），并把碱基对跨度限制在窗口长度以内（--maxBPspan），结构与逐窗口折叠一样是局部的；
+长转录本再切成有重叠的折叠片段（fold_segment_starts），每个位置取离片段边缘至少一个窗口长度的那段的结构，
+因此折叠的时间和内存都随转录本长度线性增长。
+"""
+
+# 密集扫描中每个 RNAfold 片段的长度（nt）
+DENSE_FOLD_SEGMENT = 2000
+
+
+def window_starts(length, window=200, stride=200):
+    """
+    长度为 length 的转录本上各窗口的起点（0 起始）。
+
+    参数:
+        length (int): 转录本长度。
+        window (int): 窗口长度。
+        stride (int): 相邻窗口起点的间隔。
+
+    返回:
+        np.ndarray: 递增的起点，最后一个窗口结束于转录本末端。
+    """
+    if stride < 1:
+        raise ValueError(f"stride must be at least 1, got {stride}")
+    if length <= window:
+        return np.zeros(1, dtype=np.int64)
+    starts = np.arange(0, length - window + 1, stride, dtype=np.int64)
+    if starts[-1] != length - window:
+        starts = np.append(starts, length - window)
+    return starts
+
+
+def transcript_id(header):
+    """
+    标题行中的转录本 ID：去掉 '>' 后第一个 '|' 之前的部分（标题行已由 iter_fasta 规范化）。
+    """
+    return header.lstrip(">").split("|", 1)[0]
+
+
+def parse_window_header(name):
+    """
+    解析窗口标题行，返回 (转录本ID, 起点, 终点, 转录本长度)，坐标与标题行相同（1 起始、闭区间）。
+    """
+    tid, start, end, length = name.lstrip(">").rsplit("|", 3)
+    return tid, int(start), int(end), int(length)
+
+
+def is_window_record(header, sequence):
+    """
+    记录是否为预切分的窗口：标题行为 ID|起点|终点|转录本长度，且窗口长度与序列长度一致。
+    """
+    parts = header.lstrip(">").rsplit("|", 3)
+    if len(parts) != 4 or not all(part.isdigit() for part in parts[1:]):
+        return False
+    start, end, length = (int(part) for part in parts[1:])
+    return end - start + 1 == len(sequence) and end <= length
+
+
+def iter_transcripts(fasta_path):
+    """
+    逐条读取完整转录本的 FASTA，并检查输入确实是完整转录本。
+
+    返回:
+        generator: (header, sequence)。遇到预切分的窗口（见 is_window_record）或重复的转录本 ID 时抛出 ValueError。
+    """
+    seen = set()
+    for header, sequence in iter_fasta(fasta_path):
+        if is_window_record(header, sequence):
+            raise ValueError(f"{fasta_path}: {header} is a pre-tiled window (ID|start|end|length); "
+                             f"scanning needs the full transcripts")
+        tid = transcript_id(header)
+        if tid in seen:
+            raise ValueError(f"{fasta_path}: duplicate transcript ID {tid}")
+        seen.add(tid)
+        yield header, sequence
+
+
+def dense_fold_args(window=200):
+    """
+    密集扫描的 RNAfold 参数：只计算 MFE，碱基对跨度不超过 window。
+    """
+    return ("--noPS", f"--maxBPspan={window}")
+
+
+def fold_segment_starts(length, window=200, segment=DENSE_FOLD_SEGMENT):
+    """
+    密集扫描时长度为 length 的转录本被切成的折叠片段的起点（0 起始），片段长 segment，相邻片段重叠 2 x window。
+
+    片段 k 的结构只用于 [起点 + window, 下一片段起点 + window) 的位置（首尾片段延伸到转录本两端），
+    这些位置离片段内部的边缘至少 window nt，而碱基对跨度不超过 window。
+    """
+    if segment <= 2 * window:
+        raise ValueError(f"segment must be longer than 2 * window ({2 * window}), got {segment}")
+    return window_starts(length, segment, segment - 2 * window)
+
+
+def stitch_segments(length, starts, parts, window=200):
+    """
+    按 fold_segment_starts 的规则把各片段的逐位置结构注释拼接为整条转录本的注释。
+    """
+    pieces = []
+    for k, (start, part) in enumerate(zip(starts, parts)):
+        keep_start = 0 if k == 0 else start + window
+        keep_end = length if k == len(starts) - 1 else starts[k + 1] + window
+        pieces.append(part[keep_start - start:keep_end - start])
+    return "".join(pieces)
+
+
+def tile_transcripts(records, window=200, stride=200):
+    """
+    将 (header, sequence) 转录本记录切分为窗口记录。
+
+    返回:
+        generator: (窗口标题行, 窗口序列)，同一转录本的窗口连续且按起点排列。
+    """
+    for header, sequence in records:
+        tid = transcript_id(header)
+        length = len(sequence)
+        for start in window_starts(length, window, stride):
+            end = min(start + window, length)
+            yield f">{tid}|{start + 1}|{end}|{length}", sequence[start:end]
+
+
+def write_transcript_windows(fasta_path, output_path, window=200, stride=200):
+    """
+    读取完整转录本的 FASTA（见 iter_transcripts），把切分后的窗口写到 output_path。
+    输入不是完整转录本时抛出 ValueError，并删除写了一半的 output_path。
+
+    返回:
+        tuple: (转录本数, 核苷酸总数, 窗口数)。
+    """
+    stats = {"transcripts": 0, "nucleotides": 0}
+
+    def records():
+        for header, sequence in iter_transcripts(fasta_path):
+            stats["transcripts"] += 1
+            stats["nucleotides"] += len(sequence)
+            yield header, sequence
+
+    try:
+        n_windows = write_fasta(tile_transcripts(records(), window, stride), output_path)
+    except BaseException:
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        raise
+    return stats["transcripts"], stats["nucleotides"], n_windows
+
+
+def iter_folded_transcripts(fasta_path, rnafold="RNAfold", fold_workers=None, cwd=None, fold_cache=None, progress=None,
+                            window=200, segment=DENSE_FOLD_SEGMENT):
+    """
+    折叠 FASTA 中的整条转录本并注释结构，供密集扫描按转录本编码。
+
+    转录本按 fold_segment_starts 切成重叠的片段，以 dense_fold_args(window) 折叠（各片段与其他转录本的片段一起并行，
+    并使用折叠缓存），各片段的 2-letter 注释再拼接回整条转录本（stitch_segments）。
+
+    参数:
+        fasta_path (str): 完整转录本的 FASTA 文件路径。
+        rnafold (str): RNAfold 可执行文件路径。
+        fold_workers (int): 并发的 RNAfold 进程数，None 表示使用全部核心。
+        cwd (str): RNAfold 的工作目录。
+        fold_cache: 折叠缓存，见 open_fold_cache。
+        progress (FoldProgress): 折叠进度（按片段计数），可为 None。
+        window (int): 窗口长度，即最大碱基对跨度。
+        segment (int): 折叠片段的长度。
+
+    返回:
+        generator: (header, sequence, struct_2)，顺序与输入一致。
+    """
+    # 已送去折叠、尚未拼接完成的转录本
+    transcripts = deque()
+
+    def segments():
+        for header, sequence in iter_fasta(fasta_path):
+            starts = fold_segment_starts(len(sequence), window, segment)
+            transcripts.append((header, sequence, starts))
+            for start in starts:
+                yield header, sequence[start:start + segment]
+
+    parts = []
+    for _, shard_output in fold_records(segments(), rnafold=rnafold, fold_args=dense_fold_args(window),
+                                        fold_workers=fold_workers, cwd=cwd, fold_cache=fold_cache, progress=progress):
+        structures = [structure for _, _, structure, _ in iter_fold_records(shard_output.splitlines())]
+        _, _, struct_2 = annotate_structures(structures)
+        for part in struct_2:
+            parts.append(part)
+            header, sequence, starts = transcripts[0]
+            if len(parts) == len(starts):
+                transcripts.popleft()
+                yield header, sequence, stitch_segments(len(sequence), starts, parts, window)
+                parts = []
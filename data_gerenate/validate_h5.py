@@ -0,0 +1,183 @@
+import argparse
+import itertools
+import sys
+import h5py
+import numpy as np
+
+from .fasta_io import iter_fasta
+from .fold_cache import normalize_fold_sequence
+from .one_hot_encode_decode import *
+from .data_utils import h5_windows, read_h5_one_hot
+
+"""
+逐块校验生成的 h5（rna_names + seq_4/str_2 窗口，token 或 one_hot_matrices 格式）与其来源数据是否一致。
+
+    python -m data_gerenate.validate_h5 --h5 data/predict_data/mouse_test.h5 \
+        --fasta data/predict_data/mouse_test.fa [--annotation data/predict_data/mouse_test_annotation.tsv]
+
+- 与 FASTA 对比：记录数、RNA 名称、序列通道（按 RNAfold 的规则将序列转为大写并把 T 换成 U），
+  以及结构通道覆盖的位置是否恰好是序列所在的窗口。
+- 与注释 TSV 对比：记录数、RNA 名称、序列通道和 2-letter 结构通道逐位一致。
+"""
+
+
+def iter_annotation_records(annotation_file):
+    """
+    逐行读取注释 TSV，返回 (header, sequence, struct_2)。
+    """
+    with open(annotation_file, "r") as infile:
+        for line in infile:
+            line = line.rstrip("\n")
+            if line:
+                header, sequence, structure = line.split("\t")[:3]
+                yield header, sequence, structure
+
+
+def _window_mask(lengths, max_length):
+    lengths = np.minimum(lengths, max_length)
+    offsets = (max_length - lengths) // 2
+    positions = np.arange(max_length)
+    return (positions >= offsets[:, None]) & (positions < (offsets + lengths)[:, None])
+
+
+class H5Validator(object):
+    """
+    累计各类不一致的记录数，并保留前 max_errors 条的详细信息。
+    """
+
+    def __init__(self, max_errors=10):
+        self.max_errors = max_errors
+        self.checked = 0
+        self.errors = {}
+        self.examples = []
+
+    def report(self, kind, index, detail):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+        if len(self.examples) < self.max_errors:
+            self.examples.append((kind, index, detail))
+
+    def check_chunk(self, start, rna_names, matrices, records, source, count=True):
+        """
+        校验一块 h5 数据。
+
+        参数:
+            start (int): 该块第一条记录的序号。
+            rna_names (np.ndarray): h5 中的 RNA 名称。
+            matrices (np.ndarray): (n, 6, L) 编码矩阵。
+            records (list): 来源记录，FASTA 为 (header, sequence)，TSV 为 (header, sequence, struct_2)。
+            source (str): "fasta" 或 "annotation"。
+            count (bool): 是否计入已校验的记录数（同一块对照多个来源时只计一次）。
+        """
+        max_length = matrices.shape[2]
+        n = min(len(records), len(matrices))
+        names = [name.decode() if isinstance(name, bytes) else str(name) for name in rna_names[:n]]
+        seq_oh, str_oh = matrices[:n, :4], matrices[:n, 4:6]
+
+        if source == "fasta":
+            sequences = [normalize_fold_sequence(record[1]) for record in records[:n]]
+        else:
+            sequences = [record[1] for record in records[:n]]
+        expected_seq = convert_one_hot_seq_4_batch(sequences, max_length)
+
+        binary = ((matrices[:n] == 0) | (matrices[:n] == 1)).all(axis=(1, 2))
+        name_ok = np.array([name == record[0] for name, record in zip(names, records)], dtype=bool)
+        seq_ok = (seq_oh == expected_seq).all(axis=(1, 2))
+        if source == "fasta":
+            # 没有注释时只能校验结构通道恰好覆盖序列所在的窗口、且每个位置只有一个通道
+            lengths = np.fromiter(map(len, sequences), dtype=np.int64, count=n)
+            str_ok = ((str_oh.sum(axis=1) == 1) == _window_mask(lengths, max_length)).all(axis=1)
+        else:
+            expected_str = convert_one_hot_str_2_batch([record[2] for record in records[:n]], max_length)
+            str_ok = (str_oh == expected_str).all(axis=(1, 2))
+
+        bad = np.flatnonzero(~(binary & name_ok & seq_ok & str_ok))
+        if len(bad):
+            decoded_seq = decode_seq_4_batch(seq_oh[bad])
+            decoded_str = decode_str_2_batch(str_oh[bad])
+            for j, i in enumerate(bad):
+                if not binary[i]:
+                    self.report("non_binary", start + i, "values other than 0/1")
+                if not name_ok[i]:
+                    self.report(f"{source}_name", start + i, f"h5 {names[i]!r} != {source} {records[i][0]!r}")
+                if not seq_ok[i]:
+                    self.report(f"{source}_sequence", start + i, f"h5 {decoded_seq[j]} != {source} {sequences[i]}")
+                if not str_ok[i]:
+                    expected = records[i][2] if source == "annotation" else f"{len(sequences[i])} positions"
+                    self.report(f"{source}_structure", start + i, f"h5 {decoded_str[j]} != {source} {expected}")
+        if count:
+            self.checked += n
+
+    def summary(self):
+        GREEN = "\033[32m"
+        RED = "\033[31m"
+        RESET = "\033[0m"
+        lines = []
+        for kind, index, detail in self.examples:
+            lines.append(f"  [{kind}] record {index}: {detail}")
+        if self.errors:
+            counts = ", ".join(f"{kind}: {count}" for kind, count in self.errors.items())
+            lines.append(f"{RED}FAILED{RESET}: {self.checked} records checked ({counts})")
+        else:
+            lines.append(f"{GREEN}OK{RESET}: {self.checked} records round-trip")
+        return "\n".join(lines)
+
+
+def validate_h5(h5_file, fasta_file=None, annotation_file=None, chunk_size=4096, max_errors=10,
+                normalize_headers=True):
+    """
+    分块校验 h5 与来源 FASTA / 注释 TSV，内存占用只与 chunk_size 有关。
+    normalize_headers 与生成 h5 时读取 FASTA 的标题行规范化一致（见 fasta_io.iter_fasta）。
+
+    返回:
+        H5Validator: 校验结果，errors 为空表示一致。
+    """
+    if fasta_file is None and annotation_file is None:
+        raise ValueError("validate_h5 needs a source FASTA or annotation file")
+    sources = []
+    if fasta_file is not None:
+        sources.append(("fasta", iter_fasta(fasta_file, normalize_headers=normalize_headers)))
+    if annotation_file is not None:
+        sources.append(("annotation", iter_annotation_records(annotation_file)))
+
+    validator = H5Validator(max_errors=max_errors)
+    with h5py.File(h5_file, "r") as h5f:
+        rna_names = h5f["rna_names"]
+        total = len(h5_windows(h5f))
+        for start in range(0, total, chunk_size):
+            names = rna_names[start:start + chunk_size]
+            matrices = read_h5_one_hot(h5f, start, start + chunk_size)
+            for source, records in sources:
+                chunk = list(itertools.islice(records, len(matrices)))
+                if chunk:
+                    validator.check_chunk(start, names, matrices, chunk, source, count=source == sources[0][0])
+                if len(chunk) < len(matrices) and f"{source}_count" not in validator.errors:
+                    validator.report(f"{source}_count", start + len(chunk),
+                                     f"{source} has fewer records than the h5 ({total})")
+        for source, records in sources:
+            extra = sum(1 for _ in records)
+            if extra:
+                validator.report(f"{source}_count", total, f"{source} has {extra} more records than the h5 ({total})")
+    return validator
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Round-trip an encoded h5 against its source FASTA/annotation.")
+    parser.add_argument('--h5', type=str, required=True, help='h5 file with rna_names and tokens/one_hot_matrices')
+    parser.add_argument('--fasta', type=str, default=None, help='source FASTA file')
+    parser.add_argument('--annotation', type=str, default=None, help='source annotation TSV (header, seq, struct_2)')
+    parser.add_argument('--chunk_size', type=int, default=4096, help='records validated per chunk')
+    parser.add_argument('--raw_headers', action='store_true',
+                        help='compare against FASTA headers as-is (h5 files generated before header normalization)')
+    parser.add_argument('--max_errors', type=int, default=10, help='number of mismatching records to print')
+    args = parser.parse_args()
+    if args.fasta is None and args.annotation is None:
+        parser.error("at least one of --fasta or --annotation is required")
+
+    validator = validate_h5(args.h5, args.fasta, args.annotation, args.chunk_size, args.max_errors,
+                            normalize_headers=not args.raw_headers)
+    print(validator.summary())
+    sys.exit(1 if validator.errors else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,422 @@
+"""
+Long-running local scoring service that keeps the CNN checkpoints warm.
+
+    python inference_server.py --rbp_list AGO2_MiClip TARDBP_HUMAN --port 8765
+    python inference_server.py --rbp_list rbps.txt --unix_socket /tmp/music.sock
+
+Endpoints (JSON over HTTP, on TCP or a unix socket):
+    POST /score    {"sequences": [{"name": "s1", "sequence": "ACGU...", "structure": "((..))..."}], "rbps": ["..."]}
+                   "structure" (balanced dot-bracket, same length as the sequence) is optional: sequences without it
+                   are folded with RNAfold through the fold cache. "rbps" (a list of names) selects a subset of the
+                   loaded RBPs. Invalid requests get a 400 with {"error": ...}.
+                   Returns {"rbps": [...], "results": [{"name": ..., "scores": [...]}], "folded": n, "latency_ms": t}
+    GET  /health   loaded RBPs and device
+    GET  /metrics  request latency, scoring latency and batch size histograms
+
+Concurrent requests are coalesced by a MicroBatcher: the first request in the queue waits at most
+--max_latency_ms for others to join its batch (up to --max_batch_size windows), then all of them are scored
+in one forward pass. The plotting/SHAP imports of main.py are not loaded.
+"""
+import argparse
+import bisect
+import json
+import os
+import queue
+import signal
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import numpy as np
+import torch
+
+from data_gerenate.annotation_tools import INFER_RNAFOLD
+from data_gerenate.data_utils import encode_seq_str_2
+from data_gerenate.fold_cache import open_fold_cache, normalize_fold_sequence
+from data_gerenate.fold_executor import fold_records, iter_fold_records
+from data_gerenate.structure_annotator import annotate_structures
+from model_code.model import CNN, MultiRBPCNN
+from train_code.precision import PRECISIONS, autocast
+from utils import load_model, load_multitask_model, model_identity, read_rbp_list, scoring_stack_size
+
+LATENCY_BUCKETS_MS = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096)
+STRUCTURE_CHARACTERS = frozenset(".()")
+
+
+def is_dot_bracket(structure):
+    """True for a string of '.', '(' and ')' whose brackets are balanced."""
+    if not isinstance(structure, str) or not set(structure) <= STRUCTURE_CHARACTERS:
+        return False
+    depth = 0
+    for c in structure:
+        if c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+            if depth < 0:
+                return False
+    return depth == 0
+
+
+class Histogram(object):
+    """Thread-safe counts of observations in fixed buckets; bounds are inclusive upper bounds, plus +Inf."""
+
+    def __init__(self, bounds):
+        self.bounds = list(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.bounds, value)] += 1
+            self.count += 1
+            self.sum += value
+
+    def _quantile(self, q):
+        # upper bound of the bucket holding the q-quantile
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.bounds + [float("inf")], self.counts):
+            cumulative += count
+            if count and cumulative >= rank:
+                return bound
+        return None
+
+    def snapshot(self):
+        with self.lock:
+            buckets = [{"le": bound, "count": count} for bound, count in zip(self.bounds, self.counts)]
+            buckets.append({"le": "+Inf", "count": self.counts[-1]})
+            return {
+                "count": self.count,
+                "sum": self.sum,
+                "mean": self.sum / self.count if self.count else None,
+                "p50": self._quantile(0.5),
+                "p95": self._quantile(0.95),
+                "p99": self._quantile(0.99),
+                "buckets": buckets,
+            }
+
+
+class MicroBatcher(object):
+    """
+    Scores encoded windows submitted from many threads in shared forward passes.
+
+    submit() queues the windows of one request and returns a Future with their probabilities. A worker thread
+    takes the oldest request, waits until it has been queued for max_latency_ms (or max_batch_size windows
+    are waiting), then scores everything it collected as one batch and resolves the futures. A request of
+    max_batch_size windows or more is not held back, and is scored in slices of max_batch_size.
+    """
+
+    def __init__(self, model, device, precision="fp32", max_batch_size=256, max_latency_ms=5.0):
+        self.model = model
+        self.device = device
+        self.precision = precision
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000.0
+        self.batch_windows = Histogram(BATCH_SIZE_BUCKETS)
+        self.batch_requests = Histogram(BATCH_SIZE_BUCKETS)
+        self.scoring_latency = Histogram(LATENCY_BUCKETS_MS)
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, windows):
+        """windows: (n, H, W) float32 array; the Future resolves to (n, M) probabilities."""
+        future = Future()
+        self._queue.put((windows, future, time.perf_counter()))
+        return future
+
+    def _collect(self, first):
+        batch, rows = [first], len(first[0])
+        deadline = first[2] + self.max_latency
+        while rows < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                # score what was collected, then stop
+                self._queue.put(None)
+                break
+            batch.append(item)
+            rows += len(item[0])
+        return batch
+
+    def _score(self, batch):
+        x = torch.from_numpy(np.concatenate([windows for windows, _, _ in batch]))
+        with torch.no_grad():
+            probs = []
+            for start in range(0, len(x), self.max_batch_size):
+                with autocast(self.device, self.precision):
+                    output = self.model(x[start:start + self.max_batch_size].to(self.device))
+                probs.append(torch.sigmoid(output.float()).to(device='cpu').numpy())
+        probs = np.concatenate(probs)
+        self.batch_windows.observe(len(x))
+        self.batch_requests.observe(len(batch))
+        done = time.perf_counter()
+        start = 0
+        for windows, future, queued in batch:
+            future.set_result(probs[start:start + len(windows)])
+            start += len(windows)
+            self.scoring_latency.observe((done - queued) * 1000.0)
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch = self._collect(first)
+            try:
+                self._score(batch)
+            except BaseException as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+
+class ScoringService(object):
+    """Resident models + request handling: validation, folding of raw sequences, encoding and batching."""
+
+    def __init__(self, model, rbp_names, device, batcher, rnafold=INFER_RNAFOLD, fold_workers=None, fold_cache=None,
+                 max_length=200):
+        self.model = model
+        self.rbp_names = list(rbp_names)
+        self.device = device
+        self.batcher = batcher
+        self.rnafold = rnafold
+        self.fold_workers = fold_workers
+        # one cache connection shared by the request threads (FoldCache serializes access)
+        self.fold_cache = open_fold_cache(fold_cache)
+        # RNAfold working directory, removed by close()
+        self._fold_dir = tempfile.TemporaryDirectory(prefix="music_fold_")
+        self.fold_dir = self._fold_dir.name
+        self.max_length = max_length
+        self.request_latency = Histogram(LATENCY_BUCKETS_MS)
+        self.started = time.time()
+
+    def _parse(self, payload):
+        if not isinstance(payload, dict) or not isinstance(payload.get("sequences"), list) or not payload["sequences"]:
+            raise ValueError('expected {"sequences": [{"name": ..., "sequence": ..., "structure": ...}, ...]}')
+        records = []
+        for i, record in enumerate(payload["sequences"]):
+            if isinstance(record, str):
+                record = {"sequence": record}
+            if not isinstance(record, dict) or not isinstance(record.get("sequence"), str) or not record["sequence"]:
+                raise ValueError(f"sequences[{i}] has no sequence")
+            # encoded like an --infer window: centred when shorter than max_length, truncated when longer
+            sequence = normalize_fold_sequence(record["sequence"])
+            structure = record.get("structure")
+            if structure is not None and (not is_dot_bracket(structure) or len(structure) != len(sequence)):
+                raise ValueError(f"sequences[{i}] structure must be balanced dot-bracket of the sequence length")
+            records.append((str(record.get("name", i)), sequence, structure))
+
+        columns = list(range(len(self.rbp_names)))
+        if payload.get("rbps") is not None:
+            if not isinstance(payload["rbps"], list) or not payload["rbps"] or \
+                    not all(isinstance(rbp, str) for rbp in payload["rbps"]):
+                raise ValueError('"rbps" must be a non-empty list of RBP names')
+            unknown = [rbp for rbp in payload["rbps"] if rbp not in self.rbp_names]
+            if unknown:
+                raise ValueError(f"RBPs not loaded: {', '.join(map(str, unknown))}")
+            columns = [self.rbp_names.index(rbp) for rbp in payload["rbps"]]
+        return records, columns
+
+    def _fold(self, records):
+        # RNAfold only the sequences sent without a structure; folds come from the fold cache when possible
+        structures = [structure for _, _, structure in records]
+        missing = [i for i, structure in enumerate(structures) if structure is None]
+        if missing:
+            folded = []
+            for _, shard_output in fold_records(((f">{i}", records[i][1]) for i in missing), rnafold=self.rnafold,
+                                                fold_workers=self.fold_workers, cwd=self.fold_dir,
+                                                fold_cache=self.fold_cache):
+                folded.extend(structure for _, _, structure, _ in iter_fold_records(shard_output.splitlines()))
+            for i, structure in zip(missing, folded):
+                structures[i] = structure
+        return structures, len(missing)
+
+    def score(self, payload):
+        start = time.perf_counter()
+        records, columns = self._parse(payload)
+        structures, n_folded = self._fold(records)
+        _, _, struct_2 = annotate_structures(structures)
+        windows = encode_seq_str_2([sequence for _, sequence, _ in records], struct_2, self.max_length)
+        probs = self.batcher.submit(windows.astype(np.float32)).result()[:, columns]
+        latency = (time.perf_counter() - start) * 1000.0
+        self.request_latency.observe(latency)
+        return {
+            "rbps": [self.rbp_names[c] for c in columns],
+            "results": [{"name": name, "scores": [round(float(p), 6) for p in row]}
+                        for (name, _, _), row in zip(records, probs)],
+            "folded": n_folded,
+            "latency_ms": round(latency, 3),
+        }
+
+    def health(self):
+        return {"status": "ok", "rbps": self.rbp_names, "device": str(self.device),
+                "uptime_s": round(time.time() - self.started, 1)}
+
+    def close(self):
+        """Remove the RNAfold working directory and close the fold cache."""
+        self._fold_dir.cleanup()
+        if self.fold_cache is not None:
+            self.fold_cache.close()
+
+    def metrics(self):
+        return {
+            "request_latency_ms": self.request_latency.snapshot(),
+            "scoring_latency_ms": self.batcher.scoring_latency.snapshot(),
+            "batch_windows": self.batcher.batch_windows.snapshot(),
+            "batch_requests": self.batcher.batch_requests.snapshot(),
+            "max_batch_size": self.batcher.max_batch_size,
+            "max_latency_ms": self.batcher.max_latency * 1000.0,
+        }
+
+
+def make_handler(service, verbose=False):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _send(self, status, body):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/health":
+                self._send(200, service.health())
+            elif self.path == "/metrics":
+                self._send(200, service.metrics())
+            else:
+                self._send(404, {"error": f"unknown path {self.path}"})
+
+        def do_POST(self):
+            if self.path != "/score":
+                self._send(404, {"error": f"unknown path {self.path}"})
+                return
+            try:
+                payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"null")
+                self._send(200, service.score(payload))
+            except ValueError as e:
+                # also covers malformed JSON
+                self._send(400, {"error": str(e)})
+            except OSError as e:
+                self._send(503, {"error": f"folding failed: {e}"})
+            except Exception as e:
+                self._send(500, {"error": repr(e)})
+
+        def address_string(self):
+            # unix socket peers have no address
+            return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+        def log_message(self, format, *args):
+            if verbose:
+                BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    return Handler
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def load_service_model(args, device):
+    """The resident model and its RBP column names: the multi-task model, or one CNN per RBP as a MultiRBPCNN."""
+    if args.multitask:
+        model_path = f"{args.out_dir}/out/model/{model_identity(args, args.rbp_name or 'multitask')}_best.pth"
+        model, rbp_names = load_multitask_model(model_path, device)
+        print("load multi-task model", model_path, "with", len(rbp_names), "RBPs")
+        return model, rbp_names
+    rbp_names = read_rbp_list(args.rbp_list) if args.rbp_list else [args.rbp_name]
+    models = []
+    for rbp in rbp_names:
+        model_path = f"{args.out_dir}/out/model/{model_identity(args, rbp)}_best.pth"
+        models.append(load_model(CNN(), model_path, device))
+        print("load best model path is ", model_path)
+    return MultiRBPCNN(models, scoring_stack_size(args, device)).to(device).eval(), rbp_names
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve MuSIC CNN scores over local HTTP with dynamic micro-batching.")
+    parser.add_argument('--rbp_name', type=str, help='RBP whose checkpoint to serve')
+    parser.add_argument('--rbp_list', type=str, nargs='+', default=None,
+                        help='RBP names (or a file with one name per line) whose checkpoints to serve')
+    parser.add_argument('--multitask', action='store_true', help='serve the multi-task model of --rbp_name (or "multitask")')
+    parser.add_argument('--out_dir', type=str, default="music", help='directory with out/model/*.pth')
+    parser.add_argument('--exp_name', type=str, default="music", help='experiment name of the checkpoints')
+    parser.add_argument('--cross', action='store_true', help='serve the cross-species checkpoints')
+    parser.add_argument('--species_name', type=str, default="human", help='species of the cross-species checkpoints')
+    parser.add_argument('--host', type=str, default="127.0.0.1", help='address to listen on')
+    parser.add_argument('--port', type=int, default=8765, help='TCP port to listen on')
+    parser.add_argument('--unix_socket', type=str, default=None, help='listen on this unix socket instead of TCP')
+    parser.add_argument('--max_batch_size', type=int, default=256, help='windows per forward pass')
+    parser.add_argument('--max_latency_ms', type=float, default=5.0,
+                        help='longest a request waits in the queue for others to join its batch')
+    parser.add_argument('--stack_size', type=int, default=None, help='RBP models per StackedCNN (default: 8 on GPU, 1 on CPU)')
+    parser.add_argument('--precision', type=str, default="fp32", choices=PRECISIONS, help='autocast dtype of the forward pass')
+    parser.add_argument('--gpuid', type=int, default=0, help='GPU to use if available')
+    parser.add_argument('--fold_workers', type=int, default=1, help='RNAfold processes per request with raw sequences')
+    parser.add_argument('--fold_cache', type=str, default=None, help='path of the persistent fold cache')
+    parser.add_argument('--no_fold_cache', action='store_true', help='disable the persistent fold cache')
+    parser.add_argument('--verbose', action='store_true', help='log every request')
+    args = parser.parse_args()
+    if not (args.rbp_name or args.rbp_list or args.multitask):
+        parser.error("give the RBPs to serve with --rbp_name or --rbp_list (or --multitask)")
+
+    GREEN = "\033[32m"
+    RESET = "\033[0m"
+    device = torch.device(f"cuda:{args.gpuid}" if torch.cuda.is_available() else "cpu")
+    model, rbp_names = load_service_model(args, device)
+    batcher = MicroBatcher(model, device, args.precision, args.max_batch_size, args.max_latency_ms)
+    service = ScoringService(model, rbp_names, device, batcher, fold_workers=args.fold_workers,
+                             fold_cache=False if args.no_fold_cache else args.fold_cache)
+    # the first forward pass initializes the kernels; keep it out of the first request's latency
+    with torch.no_grad():
+        model(torch.zeros(1, 6, service.max_length, device=device))
+
+    handler = make_handler(service, verbose=args.verbose)
+    if args.unix_socket:
+        if os.path.exists(args.unix_socket):
+            os.remove(args.unix_socket)
+        server = ThreadingUnixHTTPServer(args.unix_socket, handler)
+        address = f"unix:{args.unix_socket}"
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), handler)
+        address = f"http://{args.host}:{server.server_address[1]}"
+    print(f"Serving {len(rbp_names)} RBPs on {GREEN}{address}{RESET} ({device}, max batch {args.max_batch_size}, "
+          f"max latency {args.max_latency_ms} ms)", flush=True)
+    # SIGTERM stops the server like Ctrl-C, so the cleanup below also runs under a process manager
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+        service.close()
+        if args.unix_socket and os.path.exists(args.unix_socket):
+            os.remove(args.unix_socket)
+
+
+if __name__ == "__main__":
+    main()
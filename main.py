@@ -3,15 +3,324 @@ import numpy as np
 import argparse
 import torch
 import torch.nn as nn
-from model_code.model import CNN
-from train_code.train_loop import train ,validate ,inference ,compute_saliency ,compute_saliency_img ,compute_high_attention_region ,process_shap_labels,save_shap_fig
+from model_code.model import CNN, StackedCNN, MultiTaskCNN, MultiRBPCNN, DenseScanCNN
+from train_code.train_loop import LOSS_WEIGHTINGS ,PRECISIONS ,autocast ,make_grad_scaler ,train ,train_stacked ,train_multitask ,validate_multitask ,teacher_probabilities ,validate ,stream_inference ,compute_saliency ,compute_saliency_img ,compute_high_attention_region ,process_shap_labels,save_shap_fig
 from model_code.GradualWarmupScheduler import GradualWarmupScheduler
+from train_code.distributed import spawn ,is_distributed ,is_main_process ,get_rank ,get_world_size ,barrier ,all_gather_object ,gather_validation
+from train_code.checkpoint import CheckpointWriter ,training_state ,load_training_state ,rng_state
+from data_gerenate.transcript_scan import iter_folded_transcripts ,iter_transcripts ,fold_segment_starts ,transcript_id
+from data_gerenate.data_utils import encode_seq_str_2
+import copy
 import logging
 import os
 import shap
 import matplotlib.pyplot as plt
 
 
+def train_stacked_rbps(args, rbp_names):
+    """Train one CNN per RBP, --stack_size models at a time in lockstep through a StackedCNN.
+
+    Each model keeps its own data, optimizer, warmup scheduler, early stopping and log file, and its best
+    checkpoint is saved to the same {out_dir}/out/model/{identity}_best.pth as a single --train run.
+    """
+    device = torch.device(f"cuda:{args.gpuid}" if torch.cuda.is_available() else "cpu")
+    print("device gpu ID is", args.gpuid)
+    smooth_rate = args.smooth_rate if args.cross else 1
+    fold_cache = False if args.no_fold_cache else args.fold_cache
+    criterion = nn.BCEWithLogitsLoss(pos_weight=torch.tensor(args.pos_weight))
+
+    log_dir = f"{args.out_dir}/out/logs"
+    os.makedirs(log_dir, exist_ok=True)
+    os.makedirs(f"{args.out_dir}/out/model", exist_ok=True)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
+                        handlers=[logging.StreamHandler()])
+
+    COLOR_GREEN = '\033[92m'
+    COLOR_RED = '\033[91m'
+    COLOR_RESET = '\033[0m'
+
+    stack_size = args.stack_size or 8
+    for start in range(0, len(rbp_names), stack_size):
+        group = rbp_names[start:start + stack_size]
+        identities = [model_identity(args, rbp) for rbp in group]
+        print("stacked rbp_clip information is", identities)
+
+        loaders = [train_dataset(args.file_path, rbp, args.batch_size, smooth_rate, fold_workers=args.fold_workers,
+                                 fold_cache=fold_cache, save_annotation=args.save_annotation,
+                                 num_workers=args.num_workers) for rbp in group]
+        stacked = StackedCNN([CNN() for _ in group]).to(device)
+        optimizers, schedulers, scalers, loggers = [], [], [], []
+        for model, identity in zip(stacked.models, identities):
+            optimizer = torch.optim.Adam(model.parameters(), lr=args.learn_rate, betas=(0.9, 0.999),
+                                         weight_decay=args.weight_decay)
+            optimizers.append(optimizer)
+            schedulers.append(GradualWarmupScheduler(optimizer, multiplier=8, total_epoch=float(args.num_epochs),
+                                                     after_scheduler=None))
+            scalers.append(make_grad_scaler(device, args.precision))
+            logger = logging.getLogger(identity)
+            for handler in list(logger.handlers):
+                logger.removeHandler(handler)
+            handler = logging.FileHandler(os.path.join(log_dir, f"{identity}.txt"), mode='w')
+            handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+            logger.addHandler(handler)
+            loggers.append(logger)
+
+        best_auc = [0] * len(group)
+        best_acc = [0] * len(group)
+        best_epoch = [0] * len(group)
+        active = list(range(len(group)))
+        for epoch in range(1, args.num_epochs + 1):
+            t_mets = train_stacked(stacked, device, [train_loader for train_loader, _ in loaders], criterion,
+                                   optimizers, batch_size=64, smooth_rate=smooth_rate, active=active,
+                                   loss_weighting=args.loss_weighting, precision=args.precision, scalers=scalers)
+            for i in list(active):
+                v_met, _, _ = validate(args, stacked.models[i], device, loaders[i][1], criterion,
+                                       smooth_rate=smooth_rate, precision=args.precision)
+                schedulers[i].step()
+                lr = schedulers[i].get_lr()[0]
+
+                color = COLOR_GREEN
+                if best_auc[i] < v_met.auc:
+                    best_auc[i] = v_met.auc
+                    best_acc[i] = v_met.acc
+                    best_epoch[i] = epoch
+                    color = COLOR_RED
+                    torch.save(stacked.models[i].state_dict(), f"{args.out_dir}/out/model/{identities[i]}_best.pth")
+
+                if epoch - best_epoch[i] > args.early_stopping:
+                    print(f"Early stop at {epoch}, {identities[i]}")
+                    active.remove(i)
+                    continue
+
+                t_met = t_mets[i]
+                loggers[i].info(f'{color}Train Epoch: {epoch} avg.loss: {t_met.other[0]:.4f} '
+                                f'Acc: {t_met.acc:.2f}, AUC: {t_met.auc:.4f}, lr: {lr:.6f}{COLOR_RESET}')
+                loggers[i].info(f'{color}Test Epoch: {epoch} avg.loss: {v_met.other[0]:.4f} '
+                                f'Acc: {v_met.acc:.2f}, AUC: {v_met.auc:.4f} '
+                                f'({best_auc[i]:.4f} best){COLOR_RESET}')
+            if not active:
+                break
+
+        for i, logger in enumerate(loggers):
+            logger.info("%s auc: %.4f acc: %.4f", "TEST", best_auc[i], best_acc[i])
+            for handler in list(logger.handlers):
+                handler.close()
+                logger.removeHandler(handler)
+
+
+def load_rbp_models(args, rbp_names, device):
+    """CNNs loaded from the checkpoints of rbp_names; RBPs without a checkpoint are skipped.
+
+    Returns the models and the names and checkpoint paths of the RBPs that were loaded.
+    """
+    model_paths = {rbp: f"{args.out_dir}/out/model/{model_identity(args, rbp)}_best.pth" for rbp in rbp_names}
+    for rbp in rbp_names:
+        if not os.path.exists(model_paths[rbp]):
+            print(f"{rbp}: {model_paths[rbp]} not found, skipped")
+    rbp_names = [rbp for rbp in rbp_names if os.path.exists(model_paths[rbp])]
+    if not rbp_names:
+        raise FileNotFoundError(f"no checkpoint of --rbp_list found in {args.out_dir}/out/model")
+    models = [load_model(CNN(), model_paths[rbp], device) for rbp in rbp_names]
+    print("load", len(models), "RBP models")
+    return models, rbp_names, [model_paths[rbp] for rbp in rbp_names]
+
+
+def infer_rbps(args, rbp_names):
+    """Score --infer_fasta_path with the checkpoint of every RBP in --rbp_list in one pass.
+
+    The FASTA is folded and encoded once and every window is read once; all per-RBP CNNs score each batch,
+    --stack_size at a time as StackedCNNs (MultiRBPCNN, see scoring_stack_size). The probabilities go to one wide .inference file with a
+    column per RBP, streamed and resumable like a single --infer. RBPs without a checkpoint are skipped.
+    """
+    device = torch.device(f"cuda:{args.gpuid}" if torch.cuda.is_available() else "cpu")
+    print("device gpu ID is", args.gpuid)
+    fold_cache = False if args.no_fold_cache else args.fold_cache
+    fasta_path = args.infer_fasta_path
+    print("Inference fasta file path :", fasta_path)
+    inference_h5_file = inference_h5(fasta_path, fold_workers=args.fold_workers, fold_cache=fold_cache, save_annotation=args.save_annotation)
+
+    models, rbp_names, model_paths = load_rbp_models(args, rbp_names, device)
+    model = MultiRBPCNN(models, scoring_stack_size(args, device)).to(device).eval()
+
+    identity = model_identity(args, "rbp_list") + "_" + os.path.basename(fasta_stem(fasta_path))
+    signature = inference_signature(inference_h5_file, model_paths, args.precision)
+    writer = InferenceWriter(args.out_dir, identity, inference_h5_file, signature, columns=rbp_names,
+                             flush_rows=args.infer_chunk_rows)
+    data_loader = create_h5_dataloader(H5RangeDataset([inference_h5_file], start=writer.rows), args.batch_size,
+                                       shuffle=False, num_workers=args.num_workers)
+    print("Test  set:", writer.total, "resuming at", writer.rows)
+    stream_inference(model, device, data_loader, writer, precision=args.precision)
+
+
+def scan_transcripts(args, model, identity, columns, device):
+    """Scan the full transcripts of --infer_fasta_path with model and write per-nucleotide binding tracks.
+
+    The transcripts are tiled into 200-nt windows every --scan_stride nt (scan_h5), folded and encoded in
+    batches, and scored batch by batch; TrackWriter turns the overlapping window scores into one track per
+    transcript in out/scan/{identity}_{fasta}_scan{stride}.bedgraph (or .npz), one column per entry of columns.
+    """
+    fold_cache = False if args.no_fold_cache else args.fold_cache
+    fasta_path = args.infer_fasta_path
+    print("Scan fasta file path :", fasta_path)
+    scan_h5_file = scan_h5(fasta_path, args.scan_stride, fold_workers=args.fold_workers, fold_cache=fold_cache,
+                           save_annotation=args.save_annotation)
+
+    identity = f"{identity}_{os.path.basename(fasta_stem(fasta_path))}_scan{args.scan_stride}"
+    if args.scan_reduce != "mean":
+        identity += "_" + args.scan_reduce
+    # an error during the scan removes the partial tracks
+    with TrackWriter(args.out_dir, identity, scan_h5_file, columns=columns, fmt=args.scan_format, reduce=args.scan_reduce) as writer:
+        data_loader = create_h5_dataloader(H5RangeDataset([scan_h5_file]), args.batch_size, shuffle=False, num_workers=args.num_workers)
+        print("Scan  set:", writer.total)
+        stream_inference(model, device, data_loader, writer, precision=args.precision)
+
+
+def dense_scan_transcripts(args, models, identity, columns, device):
+    """--scan --scan_dense: fold every full transcript of --infer_fasta_path once (MFE with base pairs spanning at
+    most 200 nt), encode it whole and score all of its 200-nt windows (stride 1) in one forward pass of each
+    DenseScanCNN in models.
+
+    The window scores go to TrackWriter.write_transcript, so the tracks have the layout of scan_transcripts
+    in out/scan/{identity}_{fasta}_dense.bedgraph (or .npz).
+    """
+    fold_cache = False if args.no_fold_cache else args.fold_cache
+    fasta_path = args.infer_fasta_path
+    print("Dense scan fasta file path :", fasta_path)
+
+    identity = f"{identity}_{os.path.basename(fasta_stem(fasta_path))}_dense"
+    if args.scan_reduce != "mean":
+        identity += "_" + args.scan_reduce
+    # pre-tiled windows or duplicate transcript IDs fail here, before anything is folded or written
+    n_segments = sum(len(fold_segment_starts(len(sequence))) for _, sequence in iter_transcripts(fasta_path))
+    # Transcripts are folded in overlapping segments with base pairs of at most one window span (see
+    # iter_folded_transcripts); an error during the scan removes the partial tracks
+    with TrackWriter(args.out_dir, identity, None, columns=columns, fmt=args.scan_format, reduce=args.scan_reduce) as writer, \
+            FoldProgress(n_segments, desc="Folding RNA") as progress, torch.no_grad():
+        for header, sequence, struct_2 in iter_folded_transcripts(fasta_path, rnafold=INFER_RNAFOLD, fold_workers=args.fold_workers,
+                                                                  cwd=os.path.dirname(fasta_path), fold_cache=fold_cache, progress=progress):
+            x = torch.from_numpy(encode_seq_str_2([sequence], [struct_2], max(len(sequence), writer.window))).float().to(device)
+            with autocast(device, args.precision):
+                logits = torch.cat([model(x) for model in models], dim=1)
+            probs = torch.sigmoid(logits.float())[0].t()
+            writer.write_transcript(transcript_id(header), len(sequence), probs.to(device='cpu').numpy())
+        print(progress.summary())
+
+
+def scan_rbps(args, rbp_names):
+    """--scan with the checkpoint of every RBP in --rbp_list: one pass, one track column per RBP."""
+    device = torch.device(f"cuda:{args.gpuid}" if torch.cuda.is_available() else "cpu")
+    print("device gpu ID is", args.gpuid)
+    models, rbp_names, _ = load_rbp_models(args, rbp_names, device)
+    identity = model_identity(args, "rbp_list")
+    if args.scan_dense:
+        dense_scan_transcripts(args, [DenseScanCNN(model) for model in models], identity, rbp_names, device)
+    else:
+        model = MultiRBPCNN(models, scoring_stack_size(args, device)).to(device).eval()
+        scan_transcripts(args, model, identity, rbp_names, device)
+
+
+def multitask_identity(args):
+    return model_identity(args, args.rbp_name or "multitask")
+
+
+def train_multitask_rbps(args, rbp_names):
+    """Train one MultiTaskCNN with a head per RBP on the windows of all RBPs (see multitask_dataset).
+
+    With --distill, the per-RBP checkpoints {rbp}_{exp_name}_within_best.pth score every training window once,
+    and the heads are also fitted to those probabilities (weighted by --distill_weight).
+    """
+    device = torch.device(f"cuda:{args.gpuid}" if torch.cuda.is_available() else "cpu")
+    print("device gpu ID is", args.gpuid)
+    fold_cache = False if args.no_fold_cache else args.fold_cache
+    identity = multitask_identity(args)
+    print("multi-task rbp_clip information is", identity, len(rbp_names), "RBPs")
+    best_model_path = f"{args.out_dir}/out/model/{identity}_best.pth"
+    os.makedirs(os.path.dirname(best_model_path), exist_ok=True)
+
+    dataset, train_idx, test_idx = multitask_dataset(args.file_path, rbp_names, args.batch_size, fold_workers=args.fold_workers,
+                                                     fold_cache=fold_cache, save_annotation=args.save_annotation,
+                                                     num_workers=args.num_workers)
+    teacher_file = None
+    if args.distill:
+        teacher_file = f"{args.out_dir}/out/model/{identity}_teacher.npy"
+        teachers = [load_model(CNN(), f"{args.out_dir}/out/model/{model_identity(args, rbp)}_best.pth", device) for rbp in rbp_names]
+        scoring_loader = create_h5_dataloader(dataset, args.batch_size, shuffle=False, num_workers=args.num_workers)
+        teacher_probabilities(teachers, device, scoring_loader, teacher_file, stack_size=scoring_stack_size(args, device), precision=args.precision)
+    train_loader, test_loader = multitask_loaders(dataset, train_idx, test_idx, args.batch_size, teacher_file=teacher_file,
+                                                  num_workers=args.num_workers)
+
+    model = MultiTaskCNN(len(rbp_names)).to(device)
+    optimizer = torch.optim.Adam(model.parameters(), lr=args.learn_rate, betas=(0.9, 0.999), weight_decay=args.weight_decay)
+    scheduler = GradualWarmupScheduler(optimizer, multiplier=8, total_epoch=float(args.num_epochs), after_scheduler=None)
+    criterion = nn.BCEWithLogitsLoss(pos_weight=torch.tensor(args.pos_weight))
+    scaler = make_grad_scaler(device, args.precision)
+    distill_weight = args.distill_weight if args.distill else 0.0
+
+    log_dir = f"{args.out_dir}/out/logs"
+    os.makedirs(log_dir, exist_ok=True)
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.FileHandler(os.path.join(log_dir, f"{identity}.txt"), mode='w'),
+            logging.StreamHandler()
+        ]
+    )
+
+    COLOR_GREEN = '\033[92m'
+    COLOR_RED = '\033[91m'
+    COLOR_RESET = '\033[0m'
+
+    best_auc = 0
+    best_epoch = 0
+    best_mets = None
+    for epoch in range(1, args.num_epochs + 1):
+        t_met = train_multitask(model, device, train_loader, criterion, optimizer, distill_weight=distill_weight,
+                                precision=args.precision, scaler=scaler)
+        v_mets, v_auc = validate_multitask(model, device, test_loader, criterion, precision=args.precision)
+        scheduler.step()
+        lr = scheduler.get_lr()[0]
+
+        color = COLOR_GREEN
+        if best_auc < v_auc:
+            best_auc = v_auc
+            best_epoch = epoch
+            best_mets = v_mets
+            color = COLOR_RED
+            save_multitask_model(model, rbp_names, best_model_path)
+
+        if epoch - best_epoch > args.early_stopping:
+            print(f"Early stop at {epoch}, {identity}")
+            break
+
+        logging.info(f'{color}Train Epoch: {epoch} avg.loss: {t_met.other[0]:.4f} '
+                     f'Acc: {t_met.acc:.2f}, AUC: {t_met.auc:.4f}, lr: {lr:.6f}{COLOR_RESET}')
+        logging.info(f'{color}Test Epoch: {epoch} mean per-RBP AUC: {v_auc:.4f} ({best_auc:.4f} best){COLOR_RESET}')
+
+    for rbp, met in zip(rbp_names, best_mets or []):
+        if met is not None:
+            logging.info("%s %s auc: %.4f acc: %.4f", "TEST", rbp, met.auc, met.acc)
+    logging.info("%s mean auc: %.4f", "TEST", best_auc)
+
+
+def train_ddp(args):
+    """Data-parallel --train in --ddp_procs CPU processes (gloo backend).
+
+    Each rank trains on its shard of the training windows with --batch_size / --ddp_procs windows per step,
+    and DistributedDataParallel all-reduces the gradients. Training and validation predictions are gathered from
+    all ranks, so the logged metrics cover the whole data set.
+    Rank 0 writes the log and the best checkpoint.
+    """
+    # Generate the h5 files and the train/test split once, before the ranks read them
+    fold_cache = False if args.no_fold_cache else args.fold_cache
+    train_dataset(args.file_path, args.rbp_name, args.batch_size, 1, fold_workers=args.fold_workers,
+                  fold_cache=fold_cache, save_annotation=args.save_annotation)
+
+    ddp_args = copy.copy(args)
+    ddp_args.validate = ddp_args.infer = ddp_args.scan = ddp_args.saliency = ddp_args.saliency_img = ddp_args.har = False
+    spawn(main, args.ddp_procs, ddp_args)
+
+
 def main(args):
 
     file_path = args.file_path
@@ -27,17 +336,24 @@ def main(args):
     learn_rate = args.learn_rate
     
     species_name = args.species_name
-
-
-    device = torch.device(f"cuda:{gpuid}" if torch.cuda.is_available() else "cpu")
-    print("device gpu ID is", gpuid)
-
-    if args.cross:
-        identity = f"{rbp}_{exp_name}_cross_{species_name}"
-        smooth_rate = args.smooth_rate
+    fold_workers = args.fold_workers
+    fold_cache = False if args.no_fold_cache else args.fold_cache
+    save_annotation = args.save_annotation
+    num_workers = args.num_workers
+    precision = args.precision
+
+
+    distributed = is_distributed()
+    if distributed:
+        # --ddp_procs workers train on CPU with the gloo backend
+        device = torch.device("cpu")
+        print(f"rank {get_rank()} of {get_world_size()} on cpu")
     else:
-        identity = f"{rbp}_{exp_name}_within"
-        smooth_rate = 1
+        device = torch.device(f"cuda:{gpuid}" if torch.cuda.is_available() else "cpu")
+        print("device gpu ID is", gpuid)
+
+    identity = model_identity(args, rbp)
+    smooth_rate = args.smooth_rate if args.cross else 1
 
     print("rbp_clip information is", identity)
 
@@ -47,7 +363,10 @@ def main(args):
 
     if args.train:
 
-        train_loader , test_loader = train_dataset(file_path , rbp , batch_size ,smooth_rate)
+        # --batch_size is the global batch; each data-parallel rank takes its share of it
+        rank_batch_size = max(1, batch_size // get_world_size())
+        train_loader , test_loader = train_dataset(file_path , rbp , rank_batch_size ,smooth_rate, fold_workers=fold_workers, fold_cache=fold_cache, save_annotation=save_annotation, num_workers=num_workers,
+                                                   num_replicas=get_world_size(), rank=get_rank())
 
         model = CNN().to(device)
 
@@ -55,33 +374,57 @@ def main(args):
         scheduler = GradualWarmupScheduler(
             optimizer, multiplier=8, total_epoch=float(nepochs), after_scheduler=None)
         criterion = nn.BCEWithLogitsLoss(pos_weight=torch.tensor(pos_weight))
+        scaler = make_grad_scaler(device, precision)
 
         best_auc = 0
         best_acc = 0
         best_epoch = 0
+        start_epoch = 1
+
+        # Full training state, written every --checkpoint_every epochs and read back by --resume
+        last_model_path = f"{out_dir}/out/model/{identity}_last.pth"
+        loaders = {"train": train_loader, "test": test_loader}
+        resumed = args.resume and os.path.exists(last_model_path)
+        if resumed:
+            state = load_training_state(last_model_path, model, optimizer, scheduler, scaler, loaders, rank=get_rank(), device=device)
+            best_auc, best_acc, best_epoch = state["best"]["auc"], state["best"]["acc"], state["best"]["epoch"]
+            start_epoch = nepochs + 1 if state["finished"] else state["epoch"] + 1
+            print(f"Resuming {identity} after epoch {state['epoch']} from {last_model_path}")
+        elif args.resume:
+            print(f"{last_model_path} not found, training from epoch 1")
+        # Checkpoints are written by rank 0 on a background thread
+        writer = CheckpointWriter() if is_main_process() else None
+
+        # DDP broadcasts rank 0's initial weights and all-reduces the gradients in backward
+        train_model = nn.parallel.DistributedDataParallel(model) if distributed else model
 
         log_dir = f"{out_dir}/out/logs"
         print("log dir is ", log_dir)
         os.makedirs(log_dir, exist_ok=True)
         log_file = os.path.join(log_dir, f"{identity}.txt")
         
-        logging.basicConfig(
-            level=logging.INFO,
-            format='%(asctime)s - %(levelname)s - %(message)s',
-            handlers=[
-                logging.FileHandler(log_file , mode='w'),
-                logging.StreamHandler()
-            ]
-        )
+        # only rank 0 logs; the other ranks keep the root logger at its WARNING default
+        if is_main_process():
+            logging.basicConfig(
+                level=logging.INFO,
+                format='%(asctime)s - %(levelname)s - %(message)s',
+                handlers=[
+                    logging.FileHandler(log_file , mode='a' if resumed else 'w'),
+                    logging.StreamHandler()
+                ]
+            )
 
         # Define ANSI escape codes for colors
         COLOR_GREEN = '\033[92m'
         COLOR_RED = '\033[91m'
         COLOR_RESET = '\033[0m'
 
-        for epoch in range(1, nepochs + 1):
-            t_met = train(model, device, train_loader, criterion, optimizer, batch_size=64 , smooth_rate=smooth_rate)
-            v_met, _, _ = validate(args, model, device, test_loader, criterion , smooth_rate=smooth_rate)
+        for epoch in range(start_epoch, nepochs + 1):
+            t_met = train(train_model, device, train_loader, criterion, optimizer, batch_size=rank_batch_size if distributed else 64 , smooth_rate=smooth_rate, loss_weighting=args.loss_weighting, precision=precision, scaler=scaler)
+            v_met, y_all, p_all = validate(args, model, device, test_loader, criterion , smooth_rate=smooth_rate, precision=precision)
+            # every rank validates its shard; the merged metrics are the same on all ranks, so they agree on
+            # the best epoch and on early stopping
+            v_met, _, _ = gather_validation(y_all, p_all, v_met)
             scheduler.step()
             lr = scheduler.get_lr()[0]
             
@@ -94,11 +437,21 @@ def main(args):
                 best_epoch = epoch
                 color_best = 'red'  # If it is the best AUC, use red
                 # Ensure the correct file path is passed
-                torch.save(model.state_dict(), best_model_path)
+                if writer is not None:
+                    writer.save(model.state_dict(), best_model_path)
 
             # Check if early stopping condition is met
-            if epoch - best_epoch > early_stopping:
-                print(f"Early stop at {epoch}, {exp_name}")
+            stop = epoch - best_epoch > early_stopping
+            if epoch % args.checkpoint_every == 0 or stop or epoch == nepochs:
+                # every rank's RNG state, so each rank continues its own dropout/shuffle stream
+                rng_states = all_gather_object(rng_state())
+                if writer is not None:
+                    best = {"auc": float(best_auc), "acc": float(best_acc), "epoch": best_epoch}
+                    writer.save(training_state(epoch, model, optimizer, scheduler, scaler, best, loaders, rng_states,
+                                               finished=stop or epoch == nepochs), last_model_path)
+            if stop:
+                if is_main_process():
+                    print(f"Early stop at {epoch}, {exp_name}")
                 break
 
             # Print log information and add color
@@ -118,11 +471,15 @@ def main(args):
         logging.info("%s auc: %.4f acc: %.4f", "TEST", best_auc, best_acc)
 
         filename = best_model_path.format("best")
+        # wait for rank 0 to finish writing the checkpoints
+        if writer is not None:
+            writer.close()
+        barrier()
         print("Loading model: {}".format(filename))
-        model.load_state_dict(torch.load(filename))
+        model.load_state_dict(torch.load(filename, map_location=device))
 
     if args.validate:
-        data_loader = validation_dataset(file_path , rbp , batch_size ,smooth_rate)
+        data_loader = validation_dataset(file_path , rbp , batch_size ,smooth_rate, fold_workers=fold_workers, fold_cache=fold_cache, save_annotation=save_annotation, num_workers=num_workers)
         print("Test  set:", len(data_loader.dataset))
 
         best_model = CNN().to(device)
@@ -130,7 +487,7 @@ def main(args):
         print("load best model path is ", best_model_path)
 
         criterion = nn.BCEWithLogitsLoss(pos_weight=torch.tensor(pos_weight))
-        met, y_all, p_all = validate(args, best_model, device, data_loader, criterion , smooth_rate)
+        met, y_all, p_all = validate(args, best_model, device, data_loader, criterion , smooth_rate, precision=precision)
 
         p_name = identity
 
@@ -143,33 +500,68 @@ def main(args):
     if args.gerenate_h5:
         fasta_path = args.infer_fasta_path
         print("Inference fasta file path :", fasta_path)
-        data_loader, rna_names_all = inference_dataset(fasta_path , batch_size)
+        data_loader, rna_names_all = inference_dataset(fasta_path , batch_size, fold_workers=fold_workers, fold_cache=fold_cache, save_annotation=save_annotation, num_workers=num_workers)
         print("Test  set:", len(data_loader.dataset))
 
-    if args.infer:
+    if args.infer and args.multitask:
         fasta_path = args.infer_fasta_path
         print("Inference fasta file path :", fasta_path)
-        data_loader, rna_names_all = inference_dataset(fasta_path , batch_size)
-        print("Test  set:", len(data_loader.dataset))
+        inference_h5_file = inference_h5(fasta_path, fold_workers=fold_workers, fold_cache=fold_cache, save_annotation=save_annotation)
+
+        # One forward pass gives the probabilities of every RBP head
+        identity = multitask_identity(args)
+        multitask_model_path = f"{out_dir}/out/model/{identity}_best.pth"
+        multitask_model, rbp_names = load_multitask_model(multitask_model_path, device)
+        print("load multi-task model with", len(rbp_names), "RBPs")
+
+        # Results are streamed to the .inference file; an interrupted run continues after its last written chunk
+        identity = identity+"_"+ os.path.basename(fasta_stem(fasta_path))
+        writer = InferenceWriter(out_dir, identity, inference_h5_file, inference_signature(inference_h5_file, multitask_model_path, precision),
+                                 columns=rbp_names, flush_rows=args.infer_chunk_rows)
+        data_loader = create_h5_dataloader(H5RangeDataset([inference_h5_file], start=writer.rows), batch_size, shuffle=False, num_workers=num_workers)
+        print("Test  set:", writer.total, "resuming at", writer.rows)
+        stream_inference(multitask_model, device, data_loader, writer, precision=precision)
+
+    if args.infer and not args.multitask:
+        fasta_path = args.infer_fasta_path
+        print("Inference fasta file path :", fasta_path)
+        inference_h5_file = inference_h5(fasta_path, fold_workers=fold_workers, fold_cache=fold_cache, save_annotation=save_annotation)
 
         best_model = CNN().to(device)
         best_model = load_model(best_model, best_model_path, device)
         print("load best model path is ", best_model_path)
 
-        criterion = nn.BCEWithLogitsLoss(pos_weight=torch.tensor(pos_weight))
-        p_all, y_all, rna_names_out = inference(args, best_model, device, data_loader , rna_names_all)
-
-        identity = identity+"_"+ os.path.basename(fasta_path).replace(".fa","") 
+        identity = identity+"_"+ os.path.basename(fasta_stem(fasta_path)) 
         # out_dir = f"./{exp_name}"
 
-        print(p_all.shape)
-        save_infers(out_dir, identity, rna_names_out ,y_all, p_all)
+        # Results are streamed to the .inference file; an interrupted run continues after its last written chunk
+        writer = InferenceWriter(out_dir, identity, inference_h5_file, inference_signature(inference_h5_file, best_model_path, precision),
+                                 flush_rows=args.infer_chunk_rows)
+        data_loader = create_h5_dataloader(H5RangeDataset([inference_h5_file], start=writer.rows), batch_size, shuffle=False, num_workers=num_workers)
+        print("Test  set:", writer.total, "resuming at", writer.rows)
+        stream_inference(best_model, device, data_loader, writer, precision=precision)
+
+    if args.scan and args.multitask:
+        multitask_model, rbp_names = load_multitask_model(f"{out_dir}/out/model/{multitask_identity(args)}_best.pth", device)
+        print("load multi-task model with", len(rbp_names), "RBPs")
+        if args.scan_dense:
+            dense_scan_transcripts(args, [DenseScanCNN(multitask_model)], multitask_identity(args), rbp_names, device)
+        else:
+            scan_transcripts(args, multitask_model, multitask_identity(args), rbp_names, device)
+
+    if args.scan and not args.multitask:
+        best_model = load_model(CNN().to(device), best_model_path, device)
+        print("load best model path is ", best_model_path)
+        if args.scan_dense:
+            dense_scan_transcripts(args, [DenseScanCNN(best_model)], model_identity(args, rbp), None, device)
+        else:
+            scan_transcripts(args, best_model, model_identity(args, rbp), None, device)
 
     if args.saliency:
 
         fasta_path = args.infer_fasta_path
         print("Inference fasta file path :", fasta_path)
-        data_loader, rna_names_all = inference_dataset(fasta_path , batch_size)
+        data_loader, rna_names_all = inference_dataset(fasta_path , batch_size, fold_workers=fold_workers, fold_cache=fold_cache, save_annotation=save_annotation, num_workers=num_workers)
         print("Test  set:", len(data_loader.dataset))
 
         best_model = CNN().to(device)
@@ -177,15 +569,15 @@ def main(args):
         print("load best model path is ", best_model_path)
 
 
-        identity = identity+"_"+ os.path.basename(fasta_path).replace(".fa","") 
+        identity = identity+"_"+ os.path.basename(fasta_stem(fasta_path)) 
         # out_dir = f"./{exp_name}"
 
-        compute_saliency(args, out_dir, best_model, device, data_loader, identity)
+        compute_saliency(args, out_dir, best_model, device, data_loader, identity, precision=precision)
 
     if args.saliency_img:
         fasta_path = args.infer_fasta_path
         print("Inference fasta file path :", fasta_path)
-        data_loader, rna_names_all = inference_dataset(fasta_path , batch_size)
+        data_loader, rna_names_all = inference_dataset(fasta_path , batch_size, fold_workers=fold_workers, fold_cache=fold_cache, save_annotation=save_annotation, num_workers=num_workers)
         print("Test  set:", len(data_loader.dataset))
 
         best_model = CNN().to(device)
@@ -193,15 +585,15 @@ def main(args):
         print("load best model path is ", best_model_path)
 
 
-        identity = identity+"_"+ os.path.basename(fasta_path).replace(".fa","") 
+        identity = identity+"_"+ os.path.basename(fasta_stem(fasta_path)) 
         # out_dir = f"./{exp_name}"
 
-        compute_saliency_img(args, out_dir, best_model, device, data_loader, identity, rna_names_all)
+        compute_saliency_img(args, out_dir, best_model, device, data_loader, identity, rna_names_all, precision=precision)
     
     if args.har:
         fasta_path = args.infer_fasta_path
         print("Inference fasta file path :", fasta_path)
-        data_loader, rna_names_all = inference_dataset(fasta_path , batch_size)
+        data_loader, rna_names_all = inference_dataset(fasta_path , batch_size, fold_workers=fold_workers, fold_cache=fold_cache, save_annotation=save_annotation, num_workers=num_workers)
         print("Test  set:", len(data_loader.dataset))
 
         best_model = CNN().to(device)
@@ -209,10 +601,10 @@ def main(args):
         print("load best model path is ", best_model_path)
 
 
-        identity = identity+"_"+ os.path.basename(fasta_path).replace(".fa","") 
+        identity = identity+"_"+ os.path.basename(fasta_stem(fasta_path)) 
         # out_dir = f"./{exp_name}"
 
-        compute_high_attention_region(args, out_dir, best_model, device, data_loader, identity)
+        compute_high_attention_region(args, out_dir, best_model, device, data_loader, identity, precision=precision)
 
 
 
@@ -245,8 +637,88 @@ if __name__ == '__main__':
     parser.add_argument('--early_stopping', type=int, default=20, help="Number of epochs with no improvement before early stopping.")
     parser.add_argument('--exp_name', type=str, default="music", help="Name for the experiment, used for saving and logging.")
     parser.add_argument('--species_name', type=str, default="human", help="Name for the cross species, used for saving and logging.")
+    parser.add_argument('--fold_workers', '--fold-workers', type=int, default=None, help="Number of parallel RNAfold workers, defaults to all CPU cores.")
+    parser.add_argument('--fold_cache', type=str, default=None, help="Path of the persistent fold cache, defaults to $MUSIC_FOLD_CACHE or ~/.cache/music/fold_cache.sqlite.")
+    parser.add_argument('--no_fold_cache', action='store_true', help='disable the persistent fold cache')
+    parser.add_argument('--loss_weighting', type=str, default="dynamic", choices=LOSS_WEIGHTINGS,
+                        help="dynamic: loss-ratio weighted sum of the label and smoothed-label losses; legacy: the unweighted, unclipped update of the former two-backward step.")
+    parser.add_argument('--precision', type=str, default="fp32", choices=PRECISIONS,
+                        help="Autocast dtype for training, validation, inference and saliency; fp16 training uses a gradient scaler.")
+    parser.add_argument('--num_workers', type=int, default=0, help="Number of DataLoader worker processes reading the H5 files.")
+    parser.add_argument('--rbp_list', type=str, nargs='+', default=None,
+                        help="RBP names (or a file with one name per line) to run instead of --rbp_name; with --train the models are trained together in lockstep, with --infer they score the FASTA in one pass into one wide output.")
+    parser.add_argument('--stack_size', type=int, default=None,
+                        help="Number of RBP models trained or scored together in one stacked model with --rbp_list (default: 8 for training; 8 on GPU and 1 on CPU for scoring).")
+    parser.add_argument('--multitask', action='store_true',
+                        help="With --train --rbp_list: train one shared-trunk model with a head per RBP; with --infer: score all RBPs of that model in one pass.")
+    parser.add_argument('--distill', action='store_true', help="Distill the per-RBP checkpoints of --rbp_list into the multi-task model.")
+    parser.add_argument('--distill_weight', type=float, default=1.0, help="Weight of the distillation loss relative to the labelled loss.")
+    parser.add_argument('--save_annotation', action='store_true', help='also save the sequence/structure annotation TSV when generating H5 files')
+    parser.add_argument('--infer_chunk_rows', type=int, default=65536, help="Rows per chunk written (and fsynced) to the .inference file; an interrupted --infer resumes after the last chunk.")
+    parser.add_argument('--scan', action='store_true',
+                        help="Scan the full transcripts of --infer_fasta_path with sliding windows and write per-nucleotide binding tracks to out/scan.")
+    parser.add_argument('--scan_stride', '--scan-stride', type=int, default=50,
+                        help="Step between the 200-nt windows of --scan; each nucleotide is covered by about 200/stride windows, so a smaller stride gives finer tracks for proportionally more folding and scoring.")
+    parser.add_argument('--scan_dense', action='store_true',
+                        help="With --scan: fold each transcript whole (MFE, base pairs spanning at most 200 nt) and score every window (stride 1) in one fully-convolutional pass of the CNN instead of tiling it; --scan_stride is not used.")
+    parser.add_argument('--scan_format', type=str, default="bedgraph", choices=SCAN_FORMATS,
+                        help="Track output of --scan: one bedGraph per RBP, or one .npz with a float32 array per transcript.")
+    parser.add_argument('--scan_reduce', type=str, default="mean", choices=SCAN_REDUCTIONS,
+                        help="How --scan combines the scores of the windows covering a nucleotide.")
+    parser.add_argument('--checkpoint_every', type=int, default=1, help="Write the full training state to out/model/{identity}_last.pth every N epochs.")
+    parser.add_argument('--resume', action='store_true', help="Continue --train from out/model/{identity}_last.pth if it exists.")
+    parser.add_argument('--ddp_procs', '--ddp-procs', type=int, default=1,
+                        help="Number of CPU processes for data-parallel --train (gloo DistributedDataParallel); --batch_size is split between them.")
     
     args = parser.parse_args()
-    main(args)
+    if args.multitask and args.train and not args.rbp_list:
+        parser.error("--multitask --train needs the RBPs of the heads in --rbp_list")
+    if args.resume and (args.rbp_list or args.multitask):
+        parser.error("--resume continues a single-RBP --train")
+    if args.ddp_procs > 1 and (args.rbp_list or args.multitask or not args.train):
+        parser.error("--ddp_procs runs a single-RBP --train")
+    if args.scan_dense and not args.scan:
+        parser.error("--scan_dense is a mode of --scan; pass both")
+    if args.scan and not args.infer_fasta_path:
+        parser.error("--scan needs the transcripts in --infer_fasta_path")
+    if args.scan_stride < 1:
+        parser.error("--scan_stride must be at least 1")
+    if args.checkpoint_every < 1:
+        parser.error("--checkpoint_every must be at least 1")
+    if args.rbp_list:
+        rbp_names = read_rbp_list(args.rbp_list)
+        if args.train and args.multitask:
+            train_multitask_rbps(args, rbp_names)
+        elif args.train:
+            train_stacked_rbps(args, rbp_names)
+        if args.multitask:
+            # the multi-task model scores all RBPs at once
+            if args.infer or args.scan:
+                multitask_args = copy.copy(args)
+                multitask_args.train = False
+                main(multitask_args)
+        elif args.infer:
+            # fold and read the FASTA once for all RBP checkpoints
+            infer_rbps(args, rbp_names)
+        if args.scan and not args.multitask:
+            scan_rbps(args, rbp_names)
+        # the remaining modes run once per RBP, with the checkpoints written above
+        per_rbp = not args.multitask and (args.validate or args.saliency or args.saliency_img or args.har)
+        for rbp in rbp_names if per_rbp else []:
+            rbp_args = copy.copy(args)
+            rbp_args.rbp_name = rbp
+            rbp_args.train = False
+            rbp_args.infer = False
+            rbp_args.scan = False
+            main(rbp_args)
+    elif args.ddp_procs > 1:
+        train_ddp(args)
+        # the other modes run in this process with the checkpoint written by rank 0
+        if args.validate or args.infer or args.scan or args.saliency or args.saliency_img or args.har:
+            rbp_args = copy.copy(args)
+            rbp_args.train = False
+            main(rbp_args)
+    else:
+        main(args)
 
 
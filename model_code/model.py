@@ -77,6 +77,20 @@ class CNN(nn.Module):
 
 
 
+class MultiTaskCNN(CNN):
+    """CNN with the conv/SE/residual trunk shared by all RBPs and one linear head (logit) per RBP.
+
+    The trunk and its initialization are those of CNN; only fc has n_tasks outputs, so forward returns (N, n_tasks).
+    """
+
+    def __init__(self, n_tasks):
+        super(MultiTaskCNN, self).__init__()
+        self.n_tasks = n_tasks
+        self.fc = nn.Linear(self.fc.in_features, n_tasks)
+        nn.init.normal_(self.fc.weight, 0, 0.01)
+        nn.init.constant_(self.fc.bias, 0)
+
+
 class CNN_SHAP(nn.Module):
     def __init__(self):
         super(CNN_SHAP, self).__init__()
@@ -146,3 +160,181 @@ class CNN_SHAP(nn.Module):
         x = self.fc(x)
         # print(x.shape)
         return x
+
+
+class StackedCNN(nn.Module):
+    """Runs several independent CNN models in one forward pass.
+
+    Every layer of the member models is applied as a grouped convolution (or a batched matmul for the
+    linear layers) over their concatenated weights, so one kernel launch serves all models. The members stay
+    ordinary CNN modules: each keeps its own parameters, optimizer state and state_dict, and gradients
+    flow back to it through the concatenation.
+    """
+
+    def __init__(self, models):
+        super(StackedCNN, self).__init__()
+        self.models = nn.ModuleList(models)
+
+    def _conv(self, x, idx, get_conv, groups=None):
+        convs = [get_conv(self.models[i]) for i in idx]
+        conv = convs[0]
+        weight = torch.cat([c.weight for c in convs])
+        bias = torch.cat([c.bias for c in convs]) if conv.bias is not None else None
+        conv_fn = F.conv1d if isinstance(conv, nn.Conv1d) else F.conv2d
+        groups = len(idx) if groups is None else groups
+        return conv_fn(x, weight, bias, conv.stride, conv.padding, conv.dilation, groups=groups)
+
+    def _batch_norm(self, x, idx, get_bn):
+        bns = [get_bn(self.models[i]) for i in idx]
+        running_mean = torch.cat([bn.running_mean for bn in bns])
+        running_var = torch.cat([bn.running_var for bn in bns])
+        x = F.batch_norm(x, running_mean, running_var, torch.cat([bn.weight for bn in bns]),
+                         torch.cat([bn.bias for bn in bns]), self.training, bns[0].momentum, bns[0].eps)
+        if self.training:
+            # F.batch_norm updated the concatenated copies, write the statistics back to each model
+            with torch.no_grad():
+                for bn, mean, var in zip(bns, running_mean.chunk(len(bns)), running_var.chunk(len(bns))):
+                    bn.running_mean.copy_(mean)
+                    bn.running_var.copy_(var)
+                    bn.num_batches_tracked += 1
+        return x
+
+    def _linear(self, x, idx, get_linear):
+        """x: (N, M, in) -> (N, M, out)"""
+        linears = [get_linear(self.models[i]) for i in idx]
+        weight = torch.stack([linear.weight for linear in linears])
+        bias = torch.stack([linear.bias for linear in linears])
+        return torch.einsum('nmi,moi->nmo', x, weight) + bias
+
+    def _residual(self, x, idx, get_block):
+        out = F.relu(self._batch_norm(self._conv(x, idx, lambda m: get_block(m).c1), idx, lambda m: get_block(m).b1))
+        out = F.relu(self._batch_norm(self._conv(out, idx, lambda m: get_block(m).c2), idx, lambda m: get_block(m).b2))
+        out = self._batch_norm(self._conv(out, idx, lambda m: get_block(m).c3), idx, lambda m: get_block(m).b3)
+        identity = self._batch_norm(self._conv(x, idx, lambda m: get_block(m).downsample[0]),
+                                    idx, lambda m: get_block(m).downsample[1])
+        return F.relu(out + identity)
+
+    def forward(self, input, idx=None):
+        """[forward]
+
+        Args:
+            input ([tensor],N,M,W,H): one input window per selected model, input[:, j] goes to model idx[j];
+                or N,1,W,H to give every selected model the same window without copying it M times
+            idx (list): indices of the models to run, defaults to all of them
+
+        Returns:
+            [tensor],N,M: logits of each selected model
+        """
+        idx = list(range(len(self.models))) if idx is None else list(idx)
+        n, m = input.shape[0], len(idx)
+
+        # a shared window is one input channel convolved with all models' kernels at once
+        x = self._conv(input, idx, lambda model: model.conv.conv, groups=1 if input.shape[1] == 1 else m)
+        x = F.relu(self._batch_norm(x, idx, lambda model: model.conv.bn))
+        x = F.dropout(x, 0.1, training=self.training)
+
+        z = x.mean(dim=(2, 3)).view(n, m, -1)
+        z = F.relu(self._linear(z, idx, lambda model: model.se.fc[0]))
+        z = torch.sigmoid(self._linear(z, idx, lambda model: model.se.fc[2]))
+        x = self._residual(x * z.reshape(n, -1, 1, 1), idx, lambda model: model.res2d)
+        x = F.dropout(x, 0.5, training=self.training)
+
+        x = F.avg_pool2d(x, (self.models[idx[0]].n_features, 1))
+        x = x.view(x.shape[0], x.shape[1], x.shape[3])
+        x = self._residual(x, idx, lambda model: model.res1d)
+        x = F.dropout(x, 0.3, training=self.training)
+
+        x = x.mean(dim=2).view(n, m, -1)
+        return self._linear(x, idx, lambda model: model.fc).reshape(n, m)
+
+
+class MultiRBPCNN(nn.Module):
+    """Scores the same windows with many independently trained per-RBP CNNs.
+
+    The models run stack_size at a time as StackedCNNs on the shared input, so each batch is read and
+    encoded once for all of them.
+    """
+
+    def __init__(self, models, stack_size=8):
+        super(MultiRBPCNN, self).__init__()
+        self.stacks = nn.ModuleList(StackedCNN(models[start:start + stack_size])
+                                    for start in range(0, len(models), stack_size))
+
+    def forward(self, input):
+        """[forward]
+
+        Args:
+            input ([tensor],N,W,H): windows
+
+        Returns:
+            [tensor],N,M: logits, column i from models[i]
+        """
+        return torch.cat([stacked(input.unsqueeze(1)) for stacked in self.stacks], dim=1)
+
+
+class DenseScanCNN(nn.Module):
+    """Fully-convolutional view of a trained CNN (or MultiTaskCNN) that scores every window of a long sequence.
+
+    The trunk of CNN is position-local (its receptive field is 7 nt) except for the SE gate, which is computed
+    from the mean over the whole window. Here the trunk runs once over the full sequence: the SE gate of each
+    position is taken from the window centred on it (shifted inside the sequence at its ends), fc is applied
+    as a 1x1 convolution and the global average pool becomes a sliding average over `window` positions, so
+    the convolutions are shared by all overlapping windows instead of being recomputed for each of them.
+
+    A sequence of exactly `window` nt (or a shorter, zero-padded one) gets the CNN.forward score. Inside longer
+    sequences a window differs from CNN.forward through the real flanking context at its 3 edge positions and
+    the per-position SE gates; python -m benchmarks.check_dense_scan measures both. Inference only; the
+    parameters are those of `model`, not copies.
+    """
+
+    # positions of trunk input needed on each side of a chunk: res2d and res1d each look 1 position further
+    halo = 2
+
+    def __init__(self, model, window=200, chunk_size=4096):
+        super(DenseScanCNN, self).__init__()
+        self.model = model
+        self.window = window
+        self.chunk_size = chunk_size
+
+    def _gates(self, x):
+        # SE squeeze of every window with a sliding average, then the gate of the window centred on each position
+        length = x.shape[3]
+        squeeze = F.avg_pool1d(x.mean(dim=2), self.window, stride=1)
+        starts = (torch.arange(length, device=x.device) - self.window // 2).clamp(0, length - self.window)
+        z = self.model.se.fc(squeeze[:, :, starts].transpose(1, 2))
+        return z.transpose(1, 2).unsqueeze(2)
+
+    def position_scores(self, input):
+        """[tensor],N,M,L: fc (without its bias) applied to the trunk features at each position of input (N,H,L)."""
+        model = self.model
+        length = input.shape[2]
+        x = model.conv(input)
+        x = x * self._gates(x)
+
+        weight = model.fc.weight.unsqueeze(2)
+        scores = []
+        for start in range(0, length, self.chunk_size):
+            end = min(start + self.chunk_size, length)
+            lo, hi = max(start - self.halo, 0), min(end + self.halo, length)
+            h = model.res2d(x[..., lo:hi])
+            h = model.avgpool(h).squeeze(2)
+            h = model.res1d(h)
+            scores.append(F.conv1d(h[..., start - lo:end - lo], weight))
+        return torch.cat(scores, dim=2)
+
+    def forward(self, input):
+        """[forward]
+
+        Args:
+            input ([tensor],N,H,L): encoded sequences (the CNN input features), L >= 1 positions;
+                shorter than window they are centred and zero-padded like the encoder pads a window
+
+        Returns:
+            [tensor],N,M,max(L-window+1, 1): logits of the window starting at each position, M outputs of fc
+        """
+        if input.shape[2] < self.window:
+            pad = self.window - input.shape[2]
+            input = F.pad(input, (pad // 2, pad - pad // 2))
+        # fc is linear, so the fc of a window's mean feature is the mean of fc applied at each position
+        scores = self.position_scores(input)
+        return F.avg_pool1d(scores, self.window, stride=1) + self.model.fc.bias.view(1, -1, 1)
@@ -1,11 +1,13 @@
 import h5py
+from data_gerenate.data_utils import h5_storage, read_h5_one_hot
 
 h5_file = "data/predict_data/test.h5"
 # Open .h5 file
 with h5py.File(h5_file, "r") as h5f:
     rna_names = h5f["rna_names"][:]  # Load RNA names
-    one_hot_matrices = h5f["one_hot_matrices"][:]  # Load one-hot matrices
+    one_hot_matrices = read_h5_one_hot(h5f)  # Load one-hot matrices (token h5 files are expanded)
 
     # Print data
     print("RNA Names:", [name.decode('utf-8') for name in rna_names])  # Convert to string
+    print("Storage:", h5_storage(h5f))
     print("One-hot Matrices Shape:", one_hot_matrices.shape)
\ No newline at end of file
@@ -0,0 +1 @@
+python main.py --train --rbp_list LIN28A_HITS-CLIP_Human TARDBP_iCLIP_Human --file_path data/within_species_test/ --gpuid 0 --stack_size 8
@@ -0,0 +1,136 @@
+import os
+import random
+import threading
+import queue
+import numpy as np
+import torch
+
+
+def snapshot(obj):
+    """Copy of a (nested) state dict with every tensor cloned to CPU, safe to write while training goes on."""
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return np.copy(obj) if isinstance(obj, np.ndarray) else obj
+
+def atomic_save(obj, path):
+    """torch.save to a temporary file next to path, then rename, so a crash never leaves a truncated checkpoint."""
+    tmp_path = f"{path}.tmp"
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+class CheckpointWriter(object):
+    """
+    Writes checkpoints on a background thread.
+
+    save() snapshots the state to CPU before returning, so the caller can keep training; the files are then
+    written in order with atomic_save. An error in the writer thread is raised by the next save(), wait()
+    or close().
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name="checkpoint-writer", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                obj, path = item
+                if self._error is None:
+                    atomic_save(obj, path)
+            except BaseException as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _raise(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("writing a checkpoint failed") from error
+
+    def save(self, state, path):
+        self._raise()
+        self._queue.put((snapshot(state), path))
+
+    def wait(self):
+        """Block until every queued checkpoint is on disk."""
+        self._queue.join()
+        self._raise()
+
+    def close(self):
+        self.wait()
+        self._queue.put(None)
+        self._thread.join()
+
+
+def rng_state():
+    """Python, NumPy and torch (CPU and CUDA) random generator states."""
+    return {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+    }
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if state["cuda"] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def training_state(epoch, model, optimizer, scheduler, scaler, best, loaders, rng_states, finished=False):
+    """
+    Everything needed to continue a run after `epoch`: weights, Adam moments, warmup scheduler, loss scaler,
+    best metrics, the train/test split, the epoch counters of the shuffling samplers and the RNG states
+    (one per data-parallel rank).
+    """
+    return {
+        "epoch": epoch,
+        "finished": finished,
+        "model": model.state_dict(),
+        "optimizer": optimizer.state_dict(),
+        "scheduler": scheduler.state_dict(),
+        "scaler": scaler.state_dict(),
+        "best": dict(best),
+        "split": {name: np.asarray(loader.dataset.indices) for name, loader in loaders.items()},
+        "sampler_epochs": {name: getattr(loader.sampler, "epoch", 0) for name, loader in loaders.items()},
+        "rng": rng_states,
+    }
+
+def load_training_state(path, model, optimizer, scheduler, scaler, loaders, rank=0, device="cpu"):
+    """
+    Restore a training_state() checkpoint in place and return it.
+
+    Raises ValueError when the train/test split of the loaders is not the one the checkpoint was trained on.
+    """
+    try:
+        # the RNG states and split indices are not plain tensors
+        state = torch.load(path, map_location=device, weights_only=False)
+    except TypeError:
+        # torch < 1.13 has no weights_only and always unpickles
+        state = torch.load(path, map_location=device)
+    if rank >= len(state["rng"]):
+        raise ValueError(f"{path} was written by {len(state['rng'])} data-parallel processes, cannot resume rank {rank}")
+    for name, loader in loaders.items():
+        if not np.array_equal(np.asarray(loader.dataset.indices), state["split"][name]):
+            raise ValueError(f"the {name} split of {path} does not match the current data, cannot resume")
+    model.load_state_dict(state["model"])
+    optimizer.load_state_dict(state["optimizer"])
+    scheduler.load_state_dict(state["scheduler"])
+    scaler.load_state_dict(state["scaler"])
+    for name, loader in loaders.items():
+        if hasattr(loader.sampler, "epoch"):
+            loader.sampler.epoch = state["sampler_epochs"][name]
+    set_rng_state(state["rng"][rank])
+    return state
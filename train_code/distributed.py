@@ -0,0 +1,70 @@
+import os
+import socket
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from .metrics_utils import MLMetrics
+
+
+def is_distributed():
+    """True inside a worker of a multi-process run (see spawn)."""
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+def is_main_process():
+    """Rank 0 writes logs and checkpoints."""
+    return get_rank() == 0
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+def all_gather_object(obj):
+    """List with obj from every rank, in rank order ([obj] outside a multi-process run)."""
+    if not is_distributed():
+        return [obj]
+    gathered = [None] * get_world_size()
+    dist.all_gather_object(gathered, obj)
+    return gathered
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _run(rank, world_size, worker, args):
+    # Split the cores between the ranks instead of every rank starting a thread per core
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    try:
+        worker(*args)
+    finally:
+        dist.destroy_process_group()
+
+def spawn(worker, nprocs, *args):
+    """Run worker(*args) in nprocs processes joined in a gloo process group on this machine."""
+    os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+    os.environ.setdefault("MASTER_PORT", str(_free_port()))
+    mp.spawn(_run, args=(nprocs, worker, args), nprocs=nprocs, join=True)
+
+def gather_validation(y_all, p_all, met):
+    """Merge the predictions of every rank's shard into one MLMetrics, identical on all ranks.
+
+    Used for the validation and the training epoch metrics. The average loss is weighted by the shard sizes.
+    Returns the (met, y_all, p_all) of validate().
+    """
+    if not is_distributed():
+        return met, y_all, p_all
+    shards = all_gather_object((y_all, p_all, float(met.other[0])))
+    y_all = np.concatenate([y for y, _, _ in shards])
+    p_all = np.concatenate([p for _, p, _ in shards])
+    loss = sum(l * len(y) for y, _, l in shards) / max(len(y_all), 1)
+    met = MLMetrics(objective='binary')
+    met.update(y_all, p_all, [loss])
+    return met, y_all, p_all
@@ -1,11 +1,15 @@
 import os, sys
 import numpy as np
+import torch
 from six.moves import cPickle
-from sklearn.metrics import roc_curve, auc, precision_recall_curve, accuracy_score, roc_auc_score, confusion_matrix
 from scipy import stats
 
 
 __all__ = [
+    "roc_curve",
+    "precision_recall_curve",
+    "trapezoid_area",
+    "BinnedMetrics",
     "pearsonr",
     "rsquare",
     "accuracy",
@@ -18,18 +22,26 @@ class MLMetrics(object):
     def __init__(self, objective='binary'):
         self.objective = objective
         self.metrics = []
+        self._total = None
 
     def update(self, label, pred, other_lst):
         met, _ = calculate_metrics(label, pred, self.objective)
         if len(other_lst)>0:
             met.extend(other_lst)
+        self.append(met)
+
+    def append(self, met):
+        """Add an already computed metric row (calculate_metrics order, then the other values)."""
         self.metrics.append(met)
+        # running sum, so each update costs the same however many came before
+        met = np.asarray(met, dtype=np.float64)
+        self._total = met if self._total is None else self._total + met
         self.compute_avg() 
 
     def compute_avg(self):
         if len(self.metrics)>1:
-            self.avg = np.array(self.metrics).mean(axis=0)
-            self.sum = np.array(self.metrics).sum(axis=0)
+            self.avg = self._total / len(self.metrics)
+            self.sum = self._total
         else:
             self.avg = self.metrics[0]
             self.sum = self.metrics[0]
@@ -44,6 +56,214 @@ class MLMetrics(object):
             self.other = self.avg[7:]
 
 
+class MetricAccumulator(object):
+    """
+    Collects the labels, probabilities and losses of a whole epoch and computes the metrics once at the end.
+
+    update() appends the batch to buffers on the batch's device that grow by doubling, so it is O(1) amortized
+    and does not synchronize with the GPU. compute() moves everything to the host once and returns an MLMetrics
+    of the epoch (AUC over all samples rather than a mean of per-batch AUCs, mean batch loss in met.other).
+    """
+
+    def __init__(self, objective='binary', capacity=4096):
+        self.objective = objective
+        self.capacity = capacity
+        self.n = 0
+        self._label = None
+        self._pred = None
+        self._losses = []
+
+    def _reserve(self, n, device):
+        if self._label is None:
+            size = max(self.capacity, n)
+            self._label = torch.empty(size, dtype=torch.long, device=device)
+            self._pred = torch.empty(size, dtype=torch.float32, device=device)
+        elif self.n + n > len(self._label):
+            size = max(2 * len(self._label), self.n + n)
+            label = torch.empty(size, dtype=torch.long, device=self._label.device)
+            pred = torch.empty(size, dtype=torch.float32, device=self._pred.device)
+            label[:self.n] = self._label[:self.n]
+            pred[:self.n] = self._pred[:self.n]
+            self._label, self._pred = label, pred
+
+    def update(self, label, pred, loss=None):
+        """label and pred: tensors (or arrays) with one entry per sample; loss: the batch loss, if any."""
+        label = torch.as_tensor(label).detach().reshape(-1)
+        pred = torch.as_tensor(pred).detach().reshape(-1)
+        n = len(label)
+        self._reserve(n, label.device)
+        self._label[self.n:self.n + n] = label
+        self._pred[self.n:self.n + n] = pred
+        self.n += n
+        if loss is not None:
+            self._losses.append(torch.as_tensor(loss).detach().float().reshape(()))
+
+    def labels(self):
+        return np.zeros(0, dtype=np.int64) if self._label is None else self._label[:self.n].cpu().numpy()
+
+    def probabilities(self):
+        return np.zeros(0, dtype=np.float32) if self._pred is None else self._pred[:self.n].cpu().numpy()
+
+    def mean_loss(self):
+        return torch.stack(self._losses).mean().item() if self._losses else float('nan')
+
+    def compute(self):
+        met = MLMetrics(objective=self.objective)
+        met.update(self.labels(), self.probabilities(), [self.mean_loss()] if self._losses else [])
+        return met
+
+
+def _sort_scores(label, prediction):
+    """Scores sorted in ascending order, with their labels."""
+    if prediction.dtype.kind == "f" and prediction.dtype.itemsize <= 4:
+        # Sort one uint64 key per sample: an order-preserving integer form of the float32 score (negative
+        # floats get all bits flipped, the others their sign bit set), shifted left by one bit for the label.
+        # This avoids an argsort and the gathers, and float32 is what the models output.
+        bits = prediction.astype(np.float32).view(np.uint32)
+        key = np.where(bits >> 31, ~bits, bits | np.uint32(0x80000000)).astype(np.uint64) << np.uint64(1)
+        key |= label.astype(np.uint64)
+        key.sort()
+        bits = (key >> np.uint64(1)).astype(np.uint32)
+        bits = np.where(bits >> 31, bits & np.uint32(0x7FFFFFFF), ~bits)
+        return (key & np.uint64(1)).astype(bool), bits.view(np.float32)
+    order = np.argsort(prediction)
+    return label[order], prediction[order]
+
+def _clf_curve(label, prediction):
+    """fps, tps and thresholds: cumulative false/true positive counts when thresholding at each distinct score,
+    from the highest score down. The order within ties does not matter, so one unstable sort is enough."""
+    label = np.asarray(label).reshape(-1) == 1
+    prediction = np.asarray(prediction).reshape(-1)
+    label, prediction = _sort_scores(label, prediction)
+    label, prediction = label[::-1], prediction[::-1]
+    # last index of every run of equal scores
+    last = np.r_[np.flatnonzero(prediction[1:] != prediction[:-1]), len(prediction) - 1]
+    tps = np.cumsum(label, dtype=np.int64)[last]
+    fps = last + 1 - tps
+    return fps, tps, prediction[last].astype(np.float64)
+
+def _curves_from_counts(fps, tps, thresholds):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        fpr = np.r_[0, fps] / fps[-1]
+        tpr = np.r_[0, tps] / tps[-1]
+        precision = tps / (tps + fps)
+        recall = tps / tps[-1]
+    roc_curve = (fpr, tpr, np.r_[np.inf, thresholds])
+    # same layout as sklearn: recall decreasing, ending at (recall 0, precision 1)
+    pr_curve = (np.r_[precision[::-1], 1.0], np.r_[recall[::-1], 0.0], thresholds[::-1])
+    return roc_curve, pr_curve
+
+def roc_curve(label, prediction):
+    """Exact ROC curve: fpr, tpr and the thresholds (scores >= threshold are positive), like sklearn's roc_curve
+    without dropping intermediate points. fpr/tpr are NaN when a class is missing."""
+    return _curves_from_counts(*_clf_curve(label, prediction))[0]
+
+def precision_recall_curve(label, prediction):
+    """Exact precision/recall curve: precision, recall (decreasing) and thresholds, like sklearn's."""
+    return _curves_from_counts(*_clf_curve(label, prediction))[1]
+
+def trapezoid_area(x, y):
+    """Area under a curve whose x is monotonic in either direction (sklearn.metrics.auc)."""
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    area = np.sum(np.diff(x) * (y[1:] + y[:-1])) / 2
+    return -area if len(x) > 1 and x[-1] < x[0] else area
+
+
+class BinnedMetrics(object):
+    """
+    Approximate AUROC/AUPRC from fixed-bin score histograms of the positives and negatives.
+
+    Memory is 2 x bins counters whatever the number of samples, and histograms of different shards or
+    processes are merged by adding them (merge(), all_reduce()). Scores in the same bin count as ties, so the
+    AUROC error is at most half the fraction of positive/negative pairs falling into the same bin; scores are
+    clipped to [low, high]. `python -m benchmarks.bench_metrics` shows how many bins match the exact values
+    to 1e-4. The update runs on the device of the scores.
+    """
+
+    def __init__(self, bins=65536, low=0.0, high=1.0):
+        self.bins = bins
+        self.low = low
+        self.high = high
+        self.hist = None
+        self._losses = []
+
+    def _counts(self, device):
+        if self.hist is None:
+            self.hist = torch.zeros(2, self.bins, dtype=torch.int64, device=device)
+        return self.hist
+
+    def update(self, label, pred, loss=None):
+        label = torch.as_tensor(label).detach().reshape(-1)
+        pred = torch.as_tensor(pred).detach().reshape(-1).double()
+        hist = self._counts(pred.device)
+        index = ((pred - self.low) * (self.bins / (self.high - self.low))).long().clamp_(0, self.bins - 1)
+        # row 1 counts positives, row 0 negatives
+        hist.view(-1).index_add_(0, (label.to(hist.device) == 1).long() * self.bins + index.to(hist.device),
+                                 torch.ones_like(index, device=hist.device))
+        if loss is not None:
+            self._losses.append(torch.as_tensor(loss).detach().float().reshape(()))
+
+    def merge(self, other):
+        """Add the histograms of another BinnedMetrics with the same bins."""
+        if (other.bins, other.low, other.high) != (self.bins, self.low, self.high):
+            raise ValueError("cannot merge BinnedMetrics with different bins")
+        if other.hist is not None:
+            self._counts(other.hist.device).add_(other.hist.to(self.hist.device))
+        self._losses.extend(other._losses)
+        return self
+
+    def all_reduce(self):
+        """Sum the histograms over all processes of the default torch.distributed group (in place)."""
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            torch.distributed.all_reduce(self._counts("cpu"))
+        return self
+
+    def counts(self):
+        """fps, tps and thresholds (lower bin edges) from the highest bin down, for the non-empty bins."""
+        hist = self._counts("cpu").cpu().numpy()[:, ::-1]
+        edges = (self.low + np.arange(self.bins, dtype=np.float64) * (self.high - self.low) / self.bins)[::-1]
+        keep = hist.sum(axis=0) > 0
+        return np.cumsum(hist[0])[keep], np.cumsum(hist[1])[keep], edges[keep]
+
+    def roc_curve(self):
+        return _curves_from_counts(*self.counts())[0]
+
+    def precision_recall_curve(self):
+        return _curves_from_counts(*self.counts())[1]
+
+    def auroc(self):
+        """NaN before any sample (or with a class missing), like the exact roc_curve."""
+        if len(self.counts()[0]) == 0:
+            return float('nan')
+        fpr, tpr, _ = self.roc_curve()
+        return trapezoid_area(fpr, tpr)
+
+    def auprc(self):
+        if len(self.counts()[0]) == 0:
+            return float('nan')
+        precision, recall, _ = self.precision_recall_curve()
+        return trapezoid_area(recall, precision)
+
+    def compute(self):
+        """MLMetrics of everything seen so far; accuracy and the confusion counts use the bins above 0.5.
+        Without samples (e.g. a shard that saw nothing) accuracy, AUROC and AUPRC are NaN and the counts 0."""
+        fps, tps, thresholds = self.counts()
+        if len(fps) == 0:
+            met = [float('nan'), float('nan'), float('nan'), 0, 0, 0, 0]
+        else:
+            n_neg, n_pos = fps[-1], tps[-1]
+            above = thresholds >= 0.5
+            tp = tps[above][-1] if above.any() else 0
+            fp = fps[above][-1] if above.any() else 0
+            tn, fn = n_neg - fp, n_pos - tp
+            met = [(tp + tn) / (n_pos + n_neg), self.auroc(), self.auprc(), tp, tn, fp, fn]
+        if self._losses:
+            met.append(torch.stack(self._losses).mean().item())
+        result = MLMetrics(objective='binary')
+        result.append(met)
+        return result
+
+
 def pearsonr(label, prediction):
     ndim = np.ndim(label)
     if ndim == 1:
@@ -88,12 +308,12 @@ def rsquare(label, prediction):
 def accuracy(label, prediction):
     ndim = np.ndim(label)
     if ndim == 1:
-        metric = np.array(accuracy_score(label, np.round(prediction)))
+        metric = np.array(np.mean(label == np.round(prediction)))
     else:
         num_labels = label.shape[1]
         metric = np.zeros((num_labels))
         for i in range(num_labels):
-            metric[i] = accuracy_score(label[:,i], np.round(prediction[:,i]))
+            metric[i] = np.mean(label[:,i] == np.round(prediction[:,i]))
     return metric
 
 
@@ -101,7 +321,7 @@ def roc(label, prediction):
     ndim = np.ndim(label)
     if ndim == 1:
         fpr, tpr, thresholds = roc_curve(label, prediction)
-        score = auc(fpr, tpr)
+        score = trapezoid_area(fpr, tpr)
         metric = np.array(score)
         curves = [(fpr, tpr)]
     else:
@@ -110,7 +330,7 @@ def roc(label, prediction):
         metric = np.zeros((num_labels))
         for i in range(num_labels):
             fpr, tpr, thresholds = roc_curve(label[:,i], prediction[:,i])
-            score = auc(fpr, tpr)
+            score = trapezoid_area(fpr, tpr)
             metric[i]= score
             curves.append((fpr, tpr))
     return metric, curves
@@ -120,7 +340,7 @@ def pr(label, prediction):
     ndim = np.ndim(label)
     if ndim == 1:
         precision, recall, thresholds = precision_recall_curve(label, prediction)
-        score = auc(recall, precision)
+        score = trapezoid_area(recall, precision)
         metric = np.array(score)
         curves = [(precision, recall)]
     else:
@@ -129,16 +349,18 @@ def pr(label, prediction):
         metric = np.zeros((num_labels))
         for i in range(num_labels):
             precision, recall, thresholds = precision_recall_curve(label[:,i], prediction[:,i])
-            score = auc(recall, precision)
+            score = trapezoid_area(recall, precision)
             metric[i] = score
             curves.append((precision, recall))
     return metric, curves
 
 def tfnp(label, prediction):
-    try:
-        tn, fp, fn, tp = confusion_matrix(label, prediction).ravel()
-    except Exception:
-        tp, tn, fp, fn =0,0,0,0
+    label = np.asarray(label) == 1
+    prediction = np.asarray(prediction).astype(bool)
+    tp = int(np.sum(label & prediction))
+    fp = int(np.sum(~label & prediction))
+    fn = int(np.sum(label & ~prediction))
+    tn = len(label) - tp - fp - fn
     
     return tp, tn, fp, fn
 
@@ -0,0 +1,10 @@
+import torch
+
+PRECISIONS = ("fp32", "bf16", "fp16")
+_AUTOCAST_DTYPES = {"fp32": torch.bfloat16, "bf16": torch.bfloat16, "fp16": torch.float16}
+
+
+def autocast(device, precision="fp32"):
+    """Autocast context for forward passes; a no-op for fp32."""
+    return torch.autocast(device_type=torch.device(device).type, dtype=_AUTOCAST_DTYPES[precision],
+                          enabled=precision != "fp32")
@@ -1,7 +1,9 @@
 import torch
 import torch.optim as optim
 import torch.nn as nn
-from .metrics_utils import MLMetrics
+from .metrics_utils import MLMetrics, MetricAccumulator
+from .precision import PRECISIONS, autocast
+from .distributed import gather_validation
 import numpy as np
 import argparse, os, copy
 from tqdm import tqdm
@@ -33,68 +35,275 @@ def mat2str(m):
                 string+= "%.3f," % m[i,j]
     return string
 
-def train(model, device, train_loader, criterion, optimizer, batch_size, smooth_rate):
+LOSS_WEIGHTINGS = ("dynamic", "legacy")
+
+def make_grad_scaler(device, precision="fp32"):
+    """Loss scaler for fp16 training (fp16 gradients underflow without it); a pass-through otherwise."""
+    device_type = torch.device(device).type
+    enabled = precision == "fp16"
+    if hasattr(torch.amp, "GradScaler"):
+        return torch.amp.GradScaler(device_type, enabled=enabled)
+    return torch.cuda.amp.GradScaler(enabled=enabled and device_type == "cuda")
+
+
+def dynamic_loss_weights(loss_cls, loss_smooth, previous_losses):
+    """Loss-ratio weights: each loss is weighted by previous/current loss, normalized to sum to 1.
+
+    The weights are detached tensors, so no host sync is needed before the backward pass.
+    previous_losses is None on the first step, which gets equal weights.
+    """
+    if previous_losses is None:
+        return 0.5, 0.5
+    previous_cls, previous_smooth = previous_losses
+    weight_cls = previous_cls / loss_cls.detach().clamp_min(1e-12)
+    weight_smooth = previous_smooth / loss_smooth.detach().clamp_min(1e-12)
+    total = weight_cls + weight_smooth
+    return weight_cls / total, weight_smooth / total
+
+def train(model, device, train_loader, criterion, optimizer, batch_size, smooth_rate, loss_weighting="dynamic",
+          precision="fp32", scaler=None):
+    """One training epoch with a single backward pass per step.
+
+    loss_weighting:
+        dynamic: backpropagate the loss-ratio weighted sum of the two losses (see dynamic_loss_weights),
+                 then clip the gradient norm to 5.
+        legacy:  reproduce the update of the former two-backward step. Both backward passes accumulated into
+                 the same p.grad, so its normalized weights recombined to loss_cls + loss_smooth, and the
+                 clipped gradient was overwritten by that unclipped sum.
+    precision: forward pass dtype under autocast (see PRECISIONS). Pass the same make_grad_scaler() scaler
+        every epoch so the fp16 loss scale carries over.
+
+    model may be wrapped in DistributedDataParallel. Single-class batches are then still trained on, because
+    every rank must take part in each gradient all-reduce, and the metrics are merged over all ranks' shards.
+
+    Returns the MLMetrics of the whole epoch (see MetricAccumulator).
+    """
+    if loss_weighting not in LOSS_WEIGHTINGS:
+        raise ValueError(f"unknown loss_weighting {loss_weighting!r}, expected one of {LOSS_WEIGHTINGS}")
+    if scaler is None:
+        scaler = make_grad_scaler(device, precision)
     model.train()
-    met = MLMetrics(objective='binary')
-    previous_loss_cls = 0.0
-    previous_loss_smooth = 0.0
+    distributed = isinstance(model, nn.parallel.DistributedDataParallel)
+    met = MetricAccumulator(objective='binary')
+    previous_losses = None
     for batch_idx, (x0, y0, y_s0) in enumerate(train_loader):
         x, y, y_s = x0.float().to(device), y0.to(device).float(), y_s0.to(device).float()
 
-        if y0.sum() == 0 or y0.sum() == batch_size:
+        single_class = y0.sum() == 0 or y0.sum() == batch_size
+        if single_class and not distributed:
             continue
 
         optimizer.zero_grad()
-        output = model(x)
-        output = output.squeeze(1)
+        with autocast(device, precision):
+            output = model(x)
+        output = output.squeeze(1).float()
 
         loss_cls = criterion(output, y)
         loss_smooth = criterion(output, y_s)
 
-        loss_cls.backward(retain_graph=True)
-        loss_smooth.backward()
+        if loss_weighting == "legacy":
+            loss = loss_cls + loss_smooth
+        else:
+            weight_cls, weight_smooth = dynamic_loss_weights(loss_cls, loss_smooth, previous_losses)
+            loss = weight_cls * loss_cls + weight_smooth * loss_smooth
+        scaler.scale(loss).backward()
 
-        gradients_loss_cls = [p.grad for p in model.parameters()]
-        gradients_loss_smooth = [p.grad for p in model.parameters()]
+        if loss_weighting != "legacy":
+            scaler.unscale_(optimizer)
+            torch.nn.utils.clip_grad_norm_(model.parameters(), 5)
+        scaler.step(optimizer)
+        scaler.update()
 
-        delta_smooth = loss_smooth.item() / previous_loss_smooth if previous_loss_smooth > 0 else 1
-        delta_cls = loss_cls.item() / previous_loss_cls if previous_loss_cls > 0 else 1
+        previous_losses = (loss_cls.detach(), loss_smooth.detach())
 
-        weight_cross_entropy = 1 / delta_cls
-        weight_smooth = 1 / delta_smooth
+        prob = torch.sigmoid(output)
 
-        weight_cross_entropy_norm = weight_cross_entropy / (weight_cross_entropy + weight_smooth)
-        weight_smooth_norm = weight_smooth / (weight_cross_entropy + weight_smooth)
+        loss_total = smooth_rate * loss_cls + (1 - smooth_rate) * loss_smooth
 
-        final_gradients = []
-        for grad_lc, grad_smooth in zip(gradients_loss_cls, gradients_loss_smooth):
-            final_gradients.append(weight_cross_entropy_norm * grad_lc + weight_smooth_norm * grad_smooth)
+        met.update(y, prob, loss_total)
+
+    if distributed:
+        return gather_validation(met.labels(), met.probabilities(), met.compute())[0]
+    return met.compute()
+
+def train_stacked(stacked, device, train_loaders, criterion, optimizers, batch_size, smooth_rate, active=None,
+                  loss_weighting="dynamic", precision="fp32", scalers=None):
+    """One lockstep epoch for the models of a StackedCNN.
+
+    Model i reads train_loaders[i] and is updated by optimizers[i] (and scalers[i]); every step takes one batch
+    from each active loader and runs the models whose batches have the same size in a single stacked forward.
+    Each model follows the same per-step rules as train(): batches with a single class are skipped, and the
+    loss weighting and gradient clipping are applied per model. A model whose loader is exhausted sits out the
+    remaining steps of the epoch.
+
+    Returns:
+        dict: model index -> MLMetrics of the epoch, for every active model.
+    """
+    if loss_weighting not in LOSS_WEIGHTINGS:
+        raise ValueError(f"unknown loss_weighting {loss_weighting!r}, expected one of {LOSS_WEIGHTINGS}")
+    active = list(range(len(stacked.models))) if active is None else list(active)
+    if scalers is None:
+        scalers = {i: make_grad_scaler(device, precision) for i in active}
+    stacked.train()
+    mets = {i: MetricAccumulator(objective='binary') for i in active}
+    previous_losses = {i: None for i in active}
+    iterators = {i: iter(train_loaders[i]) for i in active}
+    while iterators:
+        batches = {}
+        for i in list(iterators):
+            try:
+                x0, y0, y_s0 = next(iterators[i])
+            except StopIteration:
+                del iterators[i]
+                continue
+            if y0.sum() == 0 or y0.sum() == batch_size:
+                continue
+            batches[i] = (x0, y0.to(device).float(), y_s0.to(device).float())
+        if not batches:
+            continue
 
-        prob = torch.sigmoid(output)
+        # the last batch of a loader can be smaller, models are stacked only with batches of the same size
+        groups = {}
+        for i, (x0, _, _) in batches.items():
+            groups.setdefault(len(x0), []).append(i)
+
+        total_loss = 0
+        step_losses = {}
+        for idx in groups.values():
+            x = torch.stack([batches[i][0] for i in idx], dim=1).float().to(device)
+            with autocast(device, precision):
+                outputs = stacked(x, idx)
+            outputs = outputs.float()
+            for j, i in enumerate(idx):
+                _, y, y_s = batches[i]
+                output = outputs[:, j]
+                loss_cls = criterion(output, y)
+                loss_smooth = criterion(output, y_s)
+                if loss_weighting == "legacy":
+                    loss = loss_cls + loss_smooth
+                else:
+                    weight_cls, weight_smooth = dynamic_loss_weights(loss_cls, loss_smooth, previous_losses[i])
+                    loss = weight_cls * loss_cls + weight_smooth * loss_smooth
+                # the models share no parameters, so one backward through the sum gives each its own gradient
+                total_loss = total_loss + scalers[i].scale(loss)
+                step_losses[i] = (output, loss_cls, loss_smooth)
+
+        for i in batches:
+            optimizers[i].zero_grad()
+        total_loss.backward()
+
+        for i, (output, loss_cls, loss_smooth) in step_losses.items():
+            if loss_weighting != "legacy":
+                scalers[i].unscale_(optimizers[i])
+                torch.nn.utils.clip_grad_norm_(stacked.models[i].parameters(), 5)
+            scalers[i].step(optimizers[i])
+            scalers[i].update()
+            previous_losses[i] = (loss_cls.detach(), loss_smooth.detach())
+
+            _, y, _ = batches[i]
+            loss_total = smooth_rate * loss_cls + (1 - smooth_rate) * loss_smooth
+            mets[i].update(y, torch.sigmoid(output), loss_total)
 
-        y_np = y.to(device='cpu', dtype=torch.long).detach().numpy()
-        p_np = prob.to(device='cpu').detach().numpy()
+    return {i: met.compute() for i, met in mets.items()}
 
-        loss_total = smooth_rate * loss_cls + (1 - smooth_rate) * loss_smooth
+def train_multitask(model, device, train_loader, criterion, optimizer, distill_weight=0.0, precision="fp32", scaler=None):
+    """One epoch of a MultiTaskCNN on (window, labels, teacher) batches from a MultiTaskWindowDataset.
 
-        met.update(y_np, p_np, [loss_total.item()])
-        
-        # loss_total.backward(retain_graph=True)
+    The supervised loss is criterion over the known (non-NaN) entries of the label matrix only. With
+    distill_weight > 0 the logits of all heads are also fitted to the teacher probabilities.
+
+    Returns:
+        MLMetrics over all labelled entries of the epoch, with the mean loss in met.other.
+    """
+    if scaler is None:
+        scaler = make_grad_scaler(device, precision)
+    model.train()
+    met = MetricAccumulator(objective='binary')
+    for x0, labels0, teacher0 in train_loader:
+        x, labels = x0.float().to(device), labels0.to(device)
+        known = ~torch.isnan(labels)
+        if not known.any():
+            continue
+
+        optimizer.zero_grad()
+        with autocast(device, precision):
+            output = model(x)
+        output = output.float()
+        loss = criterion(output[known], labels[known])
+        if distill_weight > 0:
+            loss = loss + distill_weight * nn.functional.binary_cross_entropy_with_logits(output, teacher0.to(device))
+        scaler.scale(loss).backward()
+        scaler.unscale_(optimizer)
         torch.nn.utils.clip_grad_norm_(model.parameters(), 5)
+        scaler.step(optimizer)
+        scaler.update()
 
-        for param, final_grad in zip(model.parameters(), final_gradients):
-            param.grad = final_grad
+        met.update(labels[known], torch.sigmoid(output[known]), loss)
 
-        optimizer.step()
+    return met.compute()
+
+def validate_multitask(model, device, test_loader, criterion, precision="fp32"):
+    """Per-RBP metrics of a MultiTaskCNN on the labelled entries of the held-out windows.
 
-        previous_loss_cls = loss_cls.item()
-        previous_loss_smooth = loss_smooth.item()
+    Returns:
+        (list, float): MLMetrics per head (None for heads without both classes) and their mean AUC.
+    """
+    model.eval()
+    labels_all, p_all, l_all = [], [], []
+    with torch.no_grad():
+        for x0, labels0, _ in test_loader:
+            x, labels = x0.float().to(device), labels0.to(device)
+            with autocast(device, precision):
+                output = model(x)
+            output = output.float()
+            known = ~torch.isnan(labels)
+            if known.any():
+                l_all.append(criterion(output[known], labels[known]).item())
+            labels_all.append(labels0.numpy())
+            p_all.append(torch.sigmoid(output).to(device='cpu').numpy())
+    labels_all = np.concatenate(labels_all)
+    p_all = np.concatenate(p_all)
 
-    return met
+    mets = []
+    for task in range(labels_all.shape[1]):
+        known = ~np.isnan(labels_all[:, task])
+        y = labels_all[known, task].astype(np.int64)
+        if len(np.unique(y)) < 2:
+            mets.append(None)
+            continue
+        met = MLMetrics(objective='binary')
+        met.update(y, p_all[known, task], [np.mean(l_all)])
+        mets.append(met)
+    aucs = [met.auc for met in mets if met is not None]
+    return mets, float(np.mean(aucs)) if aucs else 0.0
+
+def teacher_probabilities(teachers, device, data_loader, output_file, stack_size=8, precision="fp32"):
+    """Score every window of data_loader (in order) with every teacher CNN and save the (N, teachers)
+    probabilities as a float16 .npy, for distillation into a MultiTaskCNN.
+
+    The teachers run stack_size at a time as StackedCNNs on each batch (MultiRBPCNN).
+    """
+    from model_code.model import MultiRBPCNN
+
+    n = len(data_loader.dataset)
+    probs = np.lib.format.open_memmap(output_file + ".tmp.npy", mode="w+", dtype=np.float16, shape=(n, len(teachers)))
+    model = MultiRBPCNN(teachers, stack_size).to(device).eval()
+    row = 0
+    with torch.no_grad():
+        for batch in tqdm(data_loader, desc="Teacher scoring"):
+            x = batch[0].float().to(device)
+            with autocast(device, precision):
+                output = model(x)
+            probs[row:row + len(x)] = torch.sigmoid(output.float()).to(device='cpu').numpy()
+            row += len(x)
+    probs.flush()
+    del probs
+    os.replace(output_file + ".tmp.npy", output_file)
+    return output_file
 
 def train_rbp_smi(model, device, train_loader, criterion, optimizer ,batch_size, rbp_smi):
     model.train()
-    met = MLMetrics(objective='binary')
+    met = MetricAccumulator(objective='binary')
     for batch_idx, (x0, y0) in enumerate(train_loader):
         x, y = x0.float().to(device), y0.to(device).float()
         if y0.sum() ==0 or y0.sum() ==batch_size:
@@ -110,74 +319,46 @@ def train_rbp_smi(model, device, train_loader, criterion, optimizer ,batch_size,
         loss = rbp_smi * criterion(output, y)
         prob = torch.sigmoid(output)
 
-        y_np = y.to(device='cpu', dtype=torch.long).detach().numpy()
-        p_np = prob.to(device='cpu').detach().numpy()
-        met.update(y_np, p_np,[loss.item()])
+        met.update(y, prob, loss)
         loss.backward()
         torch.nn.utils.clip_grad_norm_(model.parameters(), 5)
         optimizer.step()
 
-    return met
+    return met.compute()
 
-def validate(args, model, device, test_loader, criterion ,smooth_rate):
+def validate(args, model, device, test_loader, criterion ,smooth_rate, precision="fp32"):
     model.eval()
-    y_all = []
-    p_all = []
-    l_all = []
+    met = MetricAccumulator(objective='binary')
     with torch.no_grad():
         for batch_idx, (x0, y0, y_s0) in enumerate(test_loader):
             x, y, y_s = x0.float().to(device), y0.to(device).float(), y_s0.to(device).float()
-            output  = model(x)
-            output = output.squeeze(1)
+            with autocast(device, precision):
+                output  = model(x)
+            output = output.squeeze(1).float()
 
             loss_cls = criterion(output, y)
             loss_smooth = criterion(output, y_s)
             prob = torch.sigmoid(output)
             loss_total = smooth_rate * loss_cls + (1 - smooth_rate) * loss_smooth
-            y_np = y.to(device='cpu', dtype=torch.long).numpy()
-            p_np = prob.to(device='cpu').numpy()
-            l_np = loss_total.item()
-
-            y_all.append(y_np)
-            p_all.append(p_np)
-            l_all.append(l_np)
-
-    y_all = np.concatenate(y_all)
-    p_all = np.concatenate(p_all)
-    l_all = np.array(l_all)
-    
-    met = MLMetrics(objective='binary')
-    met.update(y_all, p_all,[l_all.mean()])
-    
+            met.update(y, prob, loss_total)
 
-    
-    return met, y_all, p_all
+    return met.compute(), met.labels(), met.probabilities()
 
-def inference(args, model, device, test_loader, rna_names_all):
+def stream_inference(model, device, data_loader, writer, precision="fp32"):
+    """Score data_loader batch by batch and pass each batch's labels and probabilities straight to writer
+    (utils.InferenceWriter), which writes them to disk in chunks; nothing is collected in memory."""
     model.eval()
-    p_all = []
-    y_all = []
-    rna_names_out = []  # 保存 RNA 名称
     with torch.no_grad():
-        for batch_idx, (x0, y0) in enumerate(test_loader):
-            x, y = x0.float().to(device), y0.to(device).float()
-            output = model(x)
-            prob = torch.sigmoid(output)
-
-            p_np = prob.to(device='cpu').numpy()
-            p_all.append(p_np)
-
-            y_np = y.to(device='cpu').numpy()
-            y_all.append(y_np)
-
-            # 获取 RNA 名称并追加
-            rna_names_out.extend(rna_names_all[batch_idx * test_loader.batch_size : (batch_idx + 1) * test_loader.batch_size])
-
-    p_all = np.concatenate(p_all)
-    y_all = np.concatenate(y_all)
-    return p_all, y_all, rna_names_out
-
-def compute_saliency(args, out_dir, model, device, test_loader, identity):
+        for x0, y0 in data_loader:
+            x = x0.float().to(device)
+            with autocast(device, precision):
+                output = model(x)
+            prob = torch.sigmoid(output.float())
+            writer.write(y0.numpy(), prob.to(device='cpu').numpy())
+    writer.close()
+    return writer.path
+
+def compute_saliency(args, out_dir, model, device, test_loader, identity, precision="fp32"):
     from model_code.smoothgrad import GuidedBackpropSmoothGrad
     model.eval()
 
@@ -189,10 +370,12 @@ def compute_saliency(args, out_dir, model, device, test_loader, identity):
     sal = ""
     for batch_idx, (x0, y0) in enumerate(test_loader):
         X, Y = x0.float().to(device), y0.to(device).float()
-        output = model(X)
-        prob = torch.sigmoid(output)
+        with autocast(device, precision):
+            output = model(X)
+        prob = torch.sigmoid(output.float())
         p_np = prob.to(device='cpu').detach().numpy().squeeze(-1)
-        guided_saliency = sgrad.get_batch_gradients(X, Y)
+        with autocast(device, precision):
+            guided_saliency = sgrad.get_batch_gradients(X, Y)
 
         # print(f"Shape of guided_saliency: {guided_saliency.shape}") (N, 6, 200)
         N, _, NS = guided_saliency.shape # (N, 6, 200)
@@ -207,7 +390,7 @@ def compute_saliency(args, out_dir, model, device, test_loader, identity):
     f.close()
     print(saliency_path)
 
-def compute_saliency_img(args, out_dir, model, device, test_loader, identity , rna_names_all):
+def compute_saliency_img(args, out_dir, model, device, test_loader, identity , rna_names_all, precision="fp32"):
     from model_code.smoothgrad import GuidedBackpropSmoothGrad
     from model_code import visualize
 
@@ -250,10 +433,12 @@ def compute_saliency_img(args, out_dir, model, device, test_loader, identity , r
     sgrad = GuidedBackpropSmoothGrad(model, device=device, magnitude=1)
     for batch_idx, (x0, y0) in enumerate(test_loader):
         X, Y = x0.float().to(device), y0.to(device).float()
-        output = model(X)
-        prob = torch.sigmoid(output)
+        with autocast(device, precision):
+            output = model(X)
+        prob = torch.sigmoid(output.float())
         p_np = prob.to(device='cpu').detach().numpy().flatten()
-        guided_saliency  = sgrad.get_batch_gradients(X, Y)
+        with autocast(device, precision):
+            guided_saliency  = sgrad.get_batch_gradients(X, Y)
         mul_saliency = copy.deepcopy(guided_saliency)
         # print("guided_saliency.shape",guided_saliency.shape)
         mul_saliency[:,:,:4] = guided_saliency[:,:,:4] * X[:,:,:4]
@@ -277,7 +462,7 @@ def compute_saliency_img(args, out_dir, model, device, test_loader, identity , r
         print(saliency_path)
 
 
-def compute_high_attention_region(args, out_dir, model, device, test_loader, identity):
+def compute_high_attention_region(args, out_dir, model, device, test_loader, identity, precision="fp32"):
     from model_code.smoothgrad import GuidedBackpropSmoothGrad
     model.eval()
     har_dir = make_directory(out_dir, "out/har")
@@ -289,10 +474,12 @@ def compute_high_attention_region(args, out_dir, model, device, test_loader, ide
     sgrad = GuidedBackpropSmoothGrad(model, device=device)
     for batch_idx, (x0, y0) in enumerate(test_loader):
         X, Y = x0.float().to(device), y0.to(device).float()
-        output = model(X)
-        prob = torch.sigmoid(output)
+        with autocast(device, precision):
+            output = model(X)
+        prob = torch.sigmoid(output.float())
         p_np = prob.to(device='cpu').detach().numpy().squeeze()
-        guided_saliency  = sgrad.get_batch_gradients(X, Y)
+        with autocast(device, precision):
+            guided_saliency  = sgrad.get_batch_gradients(X, Y)
 
         attention_region = guided_saliency.sum(dim=1, keepdim=True)[:, 0, :].to(device='cpu').numpy() # (N, 1, 200)
         N,NS = attention_region.shape # (N, 101)
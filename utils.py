@@ -1,66 +1,272 @@
 import torch
+import torch.nn.functional as F
 from sklearn.model_selection import train_test_split
-from torch.utils.data import Dataset, DataLoader, TensorDataset
+from torch.utils.data import Dataset, DataLoader, Sampler
+from torch.utils.data.dataloader import default_collate
 import pandas as pd
 import os
+import json
+import hashlib
+import zipfile
+from collections import OrderedDict
 import h5py
 import numpy as np
 from data_gerenate.RNAfold_annotation_gerenate_h5 import *
-
-def init_fasta_headers(fasta_path, replacement='|'):
-    import re
-
-    lines = []
-    with open(fasta_path, 'r') as infile:
-        for line in infile:
-            if line.startswith('>'):
-                clean_line = re.sub(r'[\s\t]+', replacement, line.strip())
-                lines.append(clean_line + '\n')
+from data_gerenate.data_utils import h5_windows, h5_storage, H5_STORAGE_TOKENS
+from data_gerenate.fasta_io import fasta_stem
+from data_gerenate.h5_cache import read_manifest
+from data_gerenate.transcript_scan import write_transcript_windows, parse_window_header
+from data_gerenate.one_hot_encode_decode import TOKEN_ONE_HOT_LUT, encode_tokens
+
+def expand_token_tensor(tokens):
+    """Expand (B, L) uint8 tokens to the (B, 6, L) float one-hot tensor, on the tokens' device."""
+    lut = torch.from_numpy(TOKEN_ONE_HOT_LUT).to(tokens.device)
+    return lut[tokens.long()].permute(0, 2, 1).contiguous()
+
+def expand_collate(batch):
+    x, *rest = default_collate(batch)
+    if x.dtype == torch.uint8:
+        x = expand_token_tensor(x)
+    return [x, *rest]
+
+class H5WindowDataset(Dataset):
+    """
+    Lazily reads windows from one or more h5 files (concatenated in order) instead of loading them into memory.
+
+    Rows are read one h5 chunk at a time and the most recently used chunks are cached, so sequential access and
+    ChunkShuffleSampler touch each chunk once. File handles are opened on first access in each process, which gives
+    every DataLoader worker its own handles. `indices` selects a subset of rows (train/val splits) without copying.
+    Items are (window, label[, smoothed label]); token windows stay uint8 and are expanded by expand_collate.
+    """
+
+    def __init__(self, h5_files, labels, smooth_labels=None, indices=None, cached_chunks=8):
+        self.h5_files = list(h5_files)
+        self.labels = np.asarray(labels, dtype=np.float32)
+        self.smooth_labels = None if smooth_labels is None else np.asarray(smooth_labels, dtype=np.float32)
+        self.cached_chunks = cached_chunks
+
+        sizes, self.chunk_rows, storages = [], [], []
+        for h5_file in self.h5_files:
+            with h5py.File(h5_file, "r") as h5f:
+                windows = h5_windows(h5f)
+                sizes.append(len(windows))
+                self.chunk_rows.append(windows.chunks[0] if windows.chunks else 1024)
+                storages.append(h5_storage(h5f))
+        # Mixed token/one-hot files are served as tokens
+        self.tokens = H5_STORAGE_TOKENS in storages
+        self.storages = storages
+        self.offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+        self.indices = np.arange(self.offsets[-1]) if indices is None else np.asarray(indices, dtype=np.int64)
+        self._pid = None
+
+    def subset(self, indices):
+        """A view of this dataset restricted to `indices` (positions in this dataset); no data is copied."""
+        view = type(self).__new__(type(self))
+        view.__dict__.update(self.__getstate__())
+        view.indices = self.indices[np.asarray(indices, dtype=np.int64)]
+        return view
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(_pid=None, _files=None, _cache=None)
+        return state
+
+    def _open(self):
+        if self._pid != os.getpid():
+            self._files = [h5py.File(h5_file, "r") for h5_file in self.h5_files]
+            self._cache = OrderedDict()
+            self._pid = os.getpid()
+
+    def chunk_id(self, rows):
+        """(file, chunk) ids of global rows, used to group reads by h5 chunk."""
+        rows = np.asarray(rows, dtype=np.int64)
+        file_ids = np.searchsorted(self.offsets, rows, side="right") - 1
+        chunk_rows = np.asarray(self.chunk_rows, dtype=np.int64)[file_ids]
+        return file_ids, (rows - self.offsets[file_ids]) // chunk_rows
+
+    def _chunk(self, file_id, chunk):
+        key = (file_id, chunk)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        chunk_rows = self.chunk_rows[file_id]
+        windows = h5_windows(self._files[file_id])[chunk * chunk_rows:(chunk + 1) * chunk_rows]
+        if self.tokens and self.storages[file_id] != H5_STORAGE_TOKENS:
+            windows = encode_tokens(windows)
+        self._cache[key] = windows
+        if len(self._cache) > self.cached_chunks:
+            self._cache.popitem(last=False)
+        return windows
+
+    def __len__(self):
+        return len(self.indices)
+
+    def _window(self, row):
+        self._open()
+        file_id = np.searchsorted(self.offsets, row, side="right") - 1
+        local = row - self.offsets[file_id]
+        chunk_rows = self.chunk_rows[file_id]
+        return torch.from_numpy(np.ascontiguousarray(self._chunk(file_id, local // chunk_rows)[local % chunk_rows]))
+
+    def __getitem__(self, index):
+        row = self.indices[index]
+        window = self._window(row)
+        if self.smooth_labels is None:
+            return window, self.labels[row]
+        return window, self.labels[row], self.smooth_labels[row]
+
+class H5RangeDataset(H5WindowDataset):
+    """
+    Rows start..end of the h5 files in order, all with the same label, for streaming inference.
+
+    Unlike H5WindowDataset no per-row index or label arrays are allocated, so memory does not grow with the
+    number of windows.
+    """
+
+    def __init__(self, h5_files, start=0, end=None, label=1.0, cached_chunks=8):
+        super(H5RangeDataset, self).__init__(h5_files, np.zeros(0), indices=np.zeros(0, dtype=np.int64),
+                                             cached_chunks=cached_chunks)
+        self.start = int(start)
+        self.end = int(self.offsets[-1] if end is None else end)
+        self.label = np.float32(label)
+
+    def __len__(self):
+        return max(self.end - self.start, 0)
+
+    def __getitem__(self, index):
+        return self._window(self.start + index), self.label
+
+class MultiTaskWindowDataset(H5WindowDataset):
+    """
+    Windows of several RBP datasets with a sparse (windows x RBPs) label matrix: 1/0 for the RBPs a window is
+    labelled for, no entry for the others. Items are (window, labels, teacher): labels is the dense row with NaN
+    for unknown RBPs, teacher the distillation probabilities of all RBPs read from `teacher_file` (a (N, RBPs)
+    .npy, memory-mapped), or an empty row without distillation.
+    """
+
+    def __init__(self, h5_files, label_matrix, teacher_file=None, indices=None, cached_chunks=8):
+        super(MultiTaskWindowDataset, self).__init__(h5_files, np.zeros(0), indices=indices, cached_chunks=cached_chunks)
+        self.label_matrix = label_matrix.tocsr()
+        self.teacher_file = teacher_file
+
+    def __getstate__(self):
+        state = super(MultiTaskWindowDataset, self).__getstate__()
+        state.update(_teacher=None)
+        return state
+
+    def _open(self):
+        if self._pid != os.getpid():
+            self._teacher = None if self.teacher_file is None else np.load(self.teacher_file, mmap_mode="r")
+        super(MultiTaskWindowDataset, self)._open()
+
+    def __getitem__(self, index):
+        row = self.indices[index]
+        window = self._window(row)
+        labels = np.full(self.label_matrix.shape[1], np.nan, dtype=np.float32)
+        start, end = self.label_matrix.indptr[row], self.label_matrix.indptr[row + 1]
+        labels[self.label_matrix.indices[start:end]] = self.label_matrix.data[start:end]
+        teacher = np.zeros(0, dtype=np.float32) if self._teacher is None else self._teacher[row].astype(np.float32)
+        return window, torch.from_numpy(labels), torch.from_numpy(teacher)
+
+class ChunkShuffleSampler(Sampler):
+    """
+    Shuffles cache-friendly: h5 chunks are visited in random order, and samples are shuffled within blocks of
+    `chunks_per_block` chunks, so each chunk is read from disk once per epoch.
+
+    With num_replicas > 1 every rank draws the same order and keeps its contiguous slice of it, so the shards
+    stay chunk-local. pad=True repeats samples from the start of the order until all ranks get the same
+    number (data-parallel training needs the same number of steps on every rank); pad=False gives disjoint
+    shards that together cover the dataset once (validation).
+    """
+
+    def __init__(self, dataset, chunks_per_block=8, seed=42, num_replicas=1, rank=0, pad=True):
+        self.dataset = dataset
+        self.chunks_per_block = chunks_per_block
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.pad = pad
+        self.epoch = 0
+        file_ids, chunks = dataset.chunk_id(dataset.indices)
+        _, self.groups = np.unique(np.stack([file_ids, chunks], axis=1), axis=0, return_inverse=True)
+        self.groups = self.groups.reshape(-1)
+
+    def __len__(self):
+        n = len(self.groups)
+        if self.pad:
+            return -(-n // self.num_replicas)
+        return n // self.num_replicas + int(self.rank < n % self.num_replicas)
+
+    def __iter__(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        self.epoch += 1
+        chunk_order = rng.permutation(self.groups.max() + 1 if len(self.groups) else 0)
+        rank = np.empty_like(chunk_order)
+        rank[chunk_order] = np.arange(len(chunk_order))
+        # Order samples by (block of shuffled chunks, random key)
+        block = rank[self.groups] // self.chunks_per_block
+        order = np.lexsort((rng.random_sample(len(self.groups)), block))
+        if self.num_replicas > 1:
+            if self.pad:
+                per_rank = len(self)
+                order = np.resize(order, per_rank * self.num_replicas)[self.rank * per_rank:(self.rank + 1) * per_rank]
             else:
-                lines.append(line)
-
-    with open(fasta_path, 'w') as outfile:
-        outfile.writelines(lines)
-
-    return fasta_path
-
-def load_h5_file(h5_file):
-    with h5py.File(h5_file, "r") as h5f:
-        rna_names = h5f["rna_names"][:]  # Load RNA names
-        one_hot_matrices = h5f["one_hot_matrices"][:]  # Load one-hot matrices
-
-    return rna_names,one_hot_matrices
-
-def split_dataset(data ,labels ,test_size):
-    X_train, X_test, y_train, y_test = train_test_split(data, labels, test_size=test_size, random_state=42 ,stratify=labels)
-    return X_train, X_test, y_train, y_test
-
-def create_dataloader(X, y, y_smooth, batch_size):
-    tensor_x = torch.Tensor(X)
-    tensor_y = torch.Tensor(y)
-    tensor_y_smooth = torch.Tensor(y_smooth)
-    dataset = TensorDataset(tensor_x, tensor_y, tensor_y_smooth)
-    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True)
-    
-    return dataloader
-
-def create_infer_dataloader(X, y, rna_names, batch_size=32):
-    tensor_x = torch.Tensor(X)  # Convert to Tensor
-    tensor_y = torch.Tensor(y)  # Convert to Tensor
-    dataset = TensorDataset(tensor_x, tensor_y)
-    
-    # Create data loader
-    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=False)
-
-    # Return data loader and rna_names
-    return dataloader, rna_names
+                order = np.array_split(order, self.num_replicas)[self.rank]
+        return iter(order.tolist())
+
+def create_h5_dataloader(dataset, batch_size, shuffle, num_workers=0, num_replicas=1, rank=0, pad=True):
+    if num_replicas > 1 and not shuffle:
+        raise ValueError("sharded loaders are built on ChunkShuffleSampler, pass shuffle=True")
+    sampler = ChunkShuffleSampler(dataset, num_replicas=num_replicas, rank=rank, pad=pad) if shuffle else None
+    return DataLoader(dataset, batch_size=batch_size, sampler=sampler, collate_fn=expand_collate,
+                      num_workers=num_workers, pin_memory=torch.cuda.is_available(),
+                      persistent_workers=num_workers > 0)
+
+def load_split_indices(split_file, n_samples, test_size=0.2, random_state=42):
+    """Train/test index arrays, cached in `split_file` next to the data and recomputed when the data size changes."""
+    meta = {"n_samples": int(n_samples), "test_size": test_size, "random_state": random_state}
+    if os.path.exists(split_file):
+        with np.load(split_file) as split:
+            if json.loads(str(split["meta"])) == meta:
+                return split["train"], split["test"]
+    # Same permutation as train_test_split on the full arrays, which only depends on the number of samples
+    train_idx, test_idx = train_test_split(np.arange(n_samples), test_size=test_size, random_state=random_state)
+    np.savez(split_file, train=train_idx, test=test_idx, meta=json.dumps(meta))
+    return train_idx, test_idx
+
+def h5_sizes(h5_files):
+    sizes = []
+    for h5_file in h5_files:
+        with h5py.File(h5_file, "r") as h5f:
+            sizes.append(len(h5_windows(h5f)))
+    return sizes
 
 def load_model(model, model_path, device):
-    model.load_state_dict(torch.load(model_path))
+    # map_location lets checkpoints saved on a GPU be loaded on CPU-only nodes
+    model.load_state_dict(torch.load(model_path, map_location=device))
     model.to(device)
     model.eval()
     return model
 
+def model_identity(args, rbp):
+    if args.cross:
+        return f"{rbp}_{args.exp_name}_cross_{args.species_name}"
+    return f"{rbp}_{args.exp_name}_within"
+
+def scoring_stack_size(args, device):
+    # Stacking the models pays off on a GPU; on CPU the grouped convolutions are slower than running the
+    # models one after another on the shared batch (python -m benchmarks.bench_multi_rbp)
+    if args.stack_size:
+        return args.stack_size
+    return 8 if device.type == "cuda" else 1
+
+def read_rbp_list(rbp_list):
+    # --rbp_list takes RBP names, or a single file with one RBP name per line
+    if len(rbp_list) == 1 and os.path.isfile(rbp_list[0]):
+        with open(rbp_list[0]) as f:
+            return [line.strip() for line in f if line.strip()]
+    return rbp_list
+
 def make_directory(path, foldername, verbose=1):
     """make a directory"""
 
@@ -89,7 +295,8 @@ def smooth_onehot_label(one_hot_label, smooth_rate):
     # print("smoothed_labels:", smoothed_labels[1:5])
     return smoothed_labels
 
-def train_dataset(file_path, rbp_name, batch_size, smooth_rate):
+def train_dataset(file_path, rbp_name, batch_size, smooth_rate, fold_workers=None, fold_cache=None, save_annotation=False, num_workers=0,
+                  num_replicas=1, rank=0):
     # H5 file path
     train_positive_h5_file = f"{file_path}/{rbp_name}/positive_data/train.h5"
     train_negative_h5_file = f"{file_path}/{rbp_name}/negative_data/train.h5"
@@ -97,76 +304,130 @@ def train_dataset(file_path, rbp_name, batch_size, smooth_rate):
     # Check if H5 files exist, if not, call process_rnafold_data
     if not os.path.exists(train_positive_h5_file) or not os.path.exists(train_negative_h5_file):
         print(f"{train_positive_h5_file} or {train_negative_h5_file} not found, generating H5 files.")
-        process_train_rnafold_data(file_path, rbp_name)
+        process_train_rnafold_data(file_path, rbp_name, fold_workers=fold_workers, fold_cache=fold_cache, save_annotation=save_annotation)
 
-    # Load positive and negative datasets
-    train_positive_rna_names, train_positive_dataset = load_h5_file(train_positive_h5_file)
-    train_negative_rna_names, train_negative_dataset = load_h5_file(train_negative_h5_file)
-
-    # Merge datasets
-    train_data = np.concatenate((train_positive_dataset, train_negative_dataset), axis=0)
+    # Positive and negative windows are read lazily from the h5 files; only labels are held in memory
+    n_positive, n_negative = h5_sizes([train_positive_h5_file, train_negative_h5_file])
 
     # Create labels for training and testing sets
-    train_labels = np.concatenate((np.ones(len(train_positive_dataset)), np.zeros(len(train_negative_dataset))), axis=0)
+    train_labels = np.concatenate((np.ones(n_positive), np.zeros(n_negative)), axis=0)
 
     print(train_labels.shape)
     smoothed_label = smooth_onehot_label(torch.tensor(train_labels) , smooth_rate)
     print("smoothed_label shape:", smoothed_label.shape)
 
-    # Split training and testing sets
-    X_train, X_test, y_train, y_test, y_train_smooth, y_test_smooth = train_test_split(
-    train_data, train_labels, smoothed_label, test_size=0.2, random_state=42
-    )
+    # Split training and testing sets as index arrays, cached next to the data
+    split_file = f"{file_path}/{rbp_name}/train_split.npz"
+    train_idx, test_idx = load_split_indices(split_file, len(train_labels), test_size=0.2, random_state=42)
 
-    train_loader = create_dataloader(X_train, y_train, y_train_smooth, batch_size)
-    test_loader = create_dataloader(X_test, y_test, y_test_smooth, batch_size)
+    dataset = H5WindowDataset([train_positive_h5_file, train_negative_h5_file], train_labels, smoothed_label)
+    # With num_replicas > 1 each rank gets its shard: padded to equal length for training, disjoint for testing
+    train_loader = create_h5_dataloader(dataset.subset(train_idx), batch_size, shuffle=True, num_workers=num_workers,
+                                        num_replicas=num_replicas, rank=rank)
+    test_loader = create_h5_dataloader(dataset.subset(test_idx), batch_size, shuffle=True, num_workers=num_workers,
+                                       num_replicas=num_replicas, rank=rank, pad=False)
 
 
     return train_loader, test_loader
 
-def validation_dataset(file_path , rbp_name , batch_size , smooth_rate):
+def validation_dataset(file_path , rbp_name , batch_size , smooth_rate, fold_workers=None, fold_cache=None, save_annotation=False, num_workers=0):
     
     test_positive_h5_file = f"{file_path}/{rbp_name}/positive_data/test.h5"
     test_negative_h5_file = f"{file_path}/{rbp_name}/negative_data/test.h5"
 
     if not os.path.exists(test_positive_h5_file) or not os.path.exists(test_negative_h5_file):
         print(f"{test_positive_h5_file} or {test_negative_h5_file} not found, generating H5 files.")
-        process_validation_rnafold_data(file_path, rbp_name)
-
-    test_positive_rna_names , test_positive_dataset = load_h5_file(test_positive_h5_file)
-    test_negative_rna_names , test_negative_dataset = load_h5_file(test_negative_h5_file)
+        process_validation_rnafold_data(file_path, rbp_name, fold_workers=fold_workers, fold_cache=fold_cache, save_annotation=save_annotation)
 
-    test_data = np.concatenate((test_positive_dataset, test_negative_dataset), axis=0)
-    test_labels = np.concatenate((np.ones(len(test_positive_dataset)), np.zeros(len(test_negative_dataset))), axis=0)
+    n_positive, n_negative = h5_sizes([test_positive_h5_file, test_negative_h5_file])
+    test_labels = np.concatenate((np.ones(n_positive), np.zeros(n_negative)), axis=0)
 
     print(test_labels.shape)
     smoothed_label = smooth_onehot_label(torch.tensor(test_labels) , smooth_rate)
     print("smoothed_label shape:", smoothed_label.shape)
 
-    data_loader = create_dataloader(test_data, test_labels, smoothed_label , batch_size)
+    dataset = H5WindowDataset([test_positive_h5_file, test_negative_h5_file], test_labels, smoothed_label)
+    data_loader = create_h5_dataloader(dataset, batch_size, shuffle=True, num_workers=num_workers)
 
     return data_loader
 
-def inference_dataset(fasta_path , batch_size):
+def inference_h5(fasta_path, fold_workers=None, fold_cache=None, save_annotation=False):
     print(os.path.basename(fasta_path))
-    fasta_path = init_fasta_headers(fasta_path)
-    inference_h5_file = os.path.splitext(fasta_path)[0] + ".h5"
+    # FASTA headers are normalized while the file is streamed into the fold stage; the input file is never rewritten
+    inference_h5_file = fasta_stem(fasta_path) + ".h5"
     print(inference_h5_file)
 
-    if not os.path.exists(inference_h5_file):
-        print(f"{inference_h5_file} not found, generating H5 files.")
-        process_rnafold_infer_data(fasta_path)
+    # The h5 is reused only while its manifest matches the FASTA content and the encoding/fold settings;
+    # stale files are updated by refolding just the records that changed
+    process_rnafold_infer_data(fasta_path, fold_workers=fold_workers, fold_cache=fold_cache, save_annotation=save_annotation)
+    return inference_h5_file
 
-    inference_rna_names , inference_dataset = load_h5_file(inference_h5_file)
+def inference_dataset(fasta_path , batch_size, fold_workers=None, fold_cache=None, save_annotation=False, num_workers=0):
+    inference_h5_file = inference_h5(fasta_path, fold_workers=fold_workers, fold_cache=fold_cache, save_annotation=save_annotation)
 
-    test_data = inference_dataset
-    test_labels = np.ones(len(inference_dataset))
+    with h5py.File(inference_h5_file, "r") as h5f:
+        rna_names_all = h5f["rna_names"][:]
 
-    # Create data loader
-    data_loader, rna_names_all = create_infer_dataloader(test_data, test_labels, inference_rna_names, batch_size)
+    # Create data loader, windows are read lazily in file order
+    dataset = H5WindowDataset([inference_h5_file], np.ones(len(rna_names_all)))
+    data_loader = create_h5_dataloader(dataset, batch_size, shuffle=False, num_workers=num_workers)
 
     return data_loader, rna_names_all
 
+def multitask_dataset(file_path, rbp_names, batch_size, fold_workers=None, fold_cache=None, save_annotation=False, num_workers=0):
+    """Training windows of all RBPs in one dataset with a sparse (windows x RBPs) label matrix.
+
+    Each RBP keeps the train/test split of its single-RBP model (train_split.npz), so per-RBP checkpoints used as
+    distillation teachers never saw the held-out windows. Returns the full dataset (file order, for teacher
+    scoring) and the train/test rows, see multitask_loaders.
+    """
+    from scipy import sparse
+
+    h5_files, rows, cols, values, train_idx, test_idx = [], [], [], [], [], []
+    offset = 0
+    for task, rbp_name in enumerate(rbp_names):
+        positive_h5_file = f"{file_path}/{rbp_name}/positive_data/train.h5"
+        negative_h5_file = f"{file_path}/{rbp_name}/negative_data/train.h5"
+        if not os.path.exists(positive_h5_file) or not os.path.exists(negative_h5_file):
+            print(f"{positive_h5_file} or {negative_h5_file} not found, generating H5 files.")
+            process_train_rnafold_data(file_path, rbp_name, fold_workers=fold_workers, fold_cache=fold_cache, save_annotation=save_annotation)
+        n_positive, n_negative = h5_sizes([positive_h5_file, negative_h5_file])
+        h5_files += [positive_h5_file, negative_h5_file]
+        n = n_positive + n_negative
+        rows.append(np.arange(offset, offset + n))
+        cols.append(np.full(n, task))
+        values.append(np.concatenate((np.ones(n_positive), np.zeros(n_negative))))
+        rbp_train_idx, rbp_test_idx = load_split_indices(f"{file_path}/{rbp_name}/train_split.npz", n, test_size=0.2, random_state=42)
+        train_idx.append(rbp_train_idx + offset)
+        test_idx.append(rbp_test_idx + offset)
+        offset += n
+
+    # explicit zeros (negatives) are kept as stored entries, absent entries are unknown
+    label_matrix = sparse.csr_matrix((np.concatenate(values).astype(np.float32), (np.concatenate(rows), np.concatenate(cols))),
+                                     shape=(offset, len(rbp_names)))
+    print("multi-task label matrix:", label_matrix.shape, "labelled entries:", label_matrix.nnz)
+    dataset = MultiTaskWindowDataset(h5_files, label_matrix)
+    return dataset, np.concatenate(train_idx), np.concatenate(test_idx)
+
+def multitask_loaders(dataset, train_idx, test_idx, batch_size, teacher_file=None, num_workers=0):
+    dataset.teacher_file = teacher_file
+    train_loader = create_h5_dataloader(dataset.subset(train_idx), batch_size, shuffle=True, num_workers=num_workers)
+    test_loader = create_h5_dataloader(dataset.subset(test_idx), batch_size, shuffle=False, num_workers=num_workers)
+    return train_loader, test_loader
+
+def save_multitask_model(model, rbp_names, model_path):
+    # The head order is stored with the weights so inference does not depend on the order of --rbp_list
+    torch.save({"rbp_names": list(rbp_names), "state_dict": model.state_dict()}, model_path)
+
+def load_multitask_model(model_path, device):
+    from model_code.model import MultiTaskCNN
+    checkpoint = torch.load(model_path, map_location=device)
+    model = MultiTaskCNN(len(checkpoint["rbp_names"]))
+    model.load_state_dict(checkpoint["state_dict"])
+    model.to(device)
+    model.eval()
+    return model, checkpoint["rbp_names"]
+
 def save_validations(out_dir, filename, dataname, predictions, label, met):
     evals_dir = make_directory(out_dir, f"out/evals")
     metrics_path = os.path.join(evals_dir, filename+'.metrics')
@@ -188,23 +449,296 @@ def save_validations(out_dir, filename, dataname, predictions, label, met):
     print("Evaluation file:", metrics_path)
     print("Prediction file:", probs_path)
 
-def save_infers(out_dir, filename, rna_names_all, y_all, p_all):
-    # Create directory
-    evals_dir = make_directory(out_dir, "out/infer")
-    probs_path = os.path.join(evals_dir, filename + '.inference')
-    
-    # Open file for writing
-    with open(probs_path, "w") as f:
-        for i in range(len(y_all)):
-            rna_name = rna_names_all[i]
-            
-            # Check if it is a byte string, if so, decode
+def file_digest(path, block_size=1 << 20):
+    """sha1 of a file's content, e.g. to tell which checkpoint produced a result."""
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def inference_signature(h5_file, model_path, precision):
+    """What an .inference file depends on: the h5 content (its manifest), the checkpoint(s) and the precision."""
+    manifest = read_manifest(h5_file)
+    if manifest is None:
+        stat = os.stat(h5_file)
+        manifest = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    model = file_digest(model_path) if isinstance(model_path, str) else [file_digest(path) for path in model_path]
+    return {"h5": manifest, "model": model, "precision": precision}
+
+class InferenceWriter(object):
+    """
+    Writes an .inference file chunk by chunk while inference runs, so memory stays flat whatever the input size.
+
+    Probabilities are buffered until `flush_rows` rows are complete; the chunk is then formatted with the RNA
+    names read from the h5 file for those rows, written and fsynced, and the row count and byte offset are
+    recorded in `<file>.progress` (replaced atomically). A writer opened on the same file with the same
+    `signature` truncates it to the recorded offset and continues at `self.rows`; any other signature starts over.
+    The progress file is removed by close().
+
+    Without `columns` the rows are `name<TAB>label<TAB>probability`; with `columns` a header
+    `rna_name<TAB>columns...` is written and each row holds one probability per column.
+    """
+
+    def __init__(self, out_dir, filename, h5_file, signature, columns=None, flush_rows=65536):
+        evals_dir = make_directory(out_dir, "out/infer")
+        self.path = os.path.join(evals_dir, filename + '.inference')
+        self.progress_path = self.path + ".progress"
+        self.signature = json.loads(json.dumps(signature))
+        self.columns = None if columns is None else list(columns)
+        self.flush_rows = flush_rows
+        self.rows = 0
+        self._pending = []
+        self._pending_rows = 0
+
+        progress = None
+        if os.path.exists(self.progress_path) and os.path.exists(self.path):
+            with open(self.progress_path) as f:
+                progress = json.load(f)
+            same = progress.get("signature") == self.signature and progress.get("columns") == self.columns
+            progress = progress if same and os.path.getsize(self.path) >= progress["bytes"] else None
+        if progress is not None:
+            self._file = open(self.path, "r+b")
+            self._file.truncate(progress["bytes"])
+            self._file.seek(progress["bytes"])
+            self.rows = progress["rows"]
+        else:
+            self._file = open(self.path, "wb")
+            if self.columns is not None:
+                self._file.write(("rna_name\t" + "\t".join(self.columns) + "\n").encode("utf-8"))
+            self._commit()
+        self._h5 = h5py.File(h5_file, "r")
+        self.total = len(self._h5["rna_names"])
+
+    def _commit(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        progress = {"rows": self.rows, "bytes": self._file.tell(), "signature": self.signature, "columns": self.columns}
+        tmp_path = self.progress_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(progress, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.progress_path)
+
+    def write(self, labels, probs):
+        """Append the results of the next rows: labels (B,) and probabilities (B, 1) or (B, len(columns))."""
+        self._pending.append((np.asarray(labels).reshape(-1), np.asarray(probs).reshape(len(labels), -1)))
+        self._pending_rows += len(labels)
+        if self._pending_rows >= self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        labels = np.concatenate([y for y, _ in self._pending])
+        probs = np.concatenate([p for _, p in self._pending])
+        self._pending, self._pending_rows = [], 0
+        names = self._h5["rna_names"][self.rows:self.rows + len(labels)]
+        lines = []
+        for rna_name, y, p in zip(names, labels, probs):
             if isinstance(rna_name, bytes):
                 rna_name = rna_name.decode('utf-8')
-            
-            y_line = "{:f}".format(y_all[i])
-            p_line = "{:f}".format(p_all[i][0])
-            f.write(f"{rna_name}\t{y_line}\t{p_line}\n")
-
-    print(f"Prediction file saved to: {probs_path}")
-
+            if self.columns is None:
+                lines.append("{}\t{:f}\t{:f}\n".format(rna_name, y, p[0]))
+            else:
+                lines.append(rna_name + "\t" + "\t".join("{:f}".format(v) for v in p) + "\n")
+        self._file.write("".join(lines).encode("utf-8"))
+        self.rows += len(labels)
+        self._commit()
+
+    def close(self):
+        self.flush()
+        self._file.close()
+        self._h5.close()
+        if self.rows >= self.total:
+            os.remove(self.progress_path)
+        print(f"Prediction file saved to: {self.path}")
+
+SCAN_FORMATS = ("bedgraph", "npz")
+SCAN_REDUCTIONS = ("mean", "max")
+
+def scan_h5(fasta_path, stride, window=200, fold_workers=None, fold_cache=None, save_annotation=False):
+    """Tile the full transcripts of fasta_path into windows at `stride` and fold/encode them into an inference h5.
+
+    The windows are written to `<fasta>_scan<stride>.fa` next to the input and go through inference_h5, so
+    the h5 is reused while the transcripts are unchanged and folds come from the fold cache.
+    """
+    windows_path = f"{fasta_stem(fasta_path)}_scan{stride}.fa"
+    n_transcripts, n_nucleotides, n_windows = write_transcript_windows(fasta_path, windows_path, window, stride)
+    # Each nucleotide is scored by about window / stride windows: a smaller stride gives a finer track for
+    # proportionally more folding and scoring
+    print(f"{n_transcripts} transcripts, {n_nucleotides} nt -> {n_windows} windows of {window} nt at stride {stride} "
+          f"(mean coverage {n_windows * window / max(n_nucleotides, 1):.1f}x)")
+    return inference_h5(windows_path, fold_workers=fold_workers, fold_cache=fold_cache, save_annotation=save_annotation)
+
+class TrackWriter(object):
+    """
+    Aggregates the window probabilities of a transcript scan (scan_h5) into per-nucleotide binding tracks.
+
+    Rows arrive in h5 order, in which the windows of a transcript are contiguous. Each window's probability is
+    added to the nucleotides it covers; when the next transcript starts, the finished track (the mean or max
+    over the windows covering each nucleotide) is written out, so only one transcript is held in memory.
+
+    "bedgraph" writes one bedGraph per column (chrom = transcript ID, 0-based half-open intervals, runs of
+    equal values merged); "npz" writes one .npz with a float32 array per transcript, (length,) or
+    (length, len(columns)), and the column names under "__columns__". Files are renamed into place by close().
+    Used as a context manager, an exception closes the files and removes the partial .tmp outputs (abort()).
+
+    A dense scan has no h5 file (h5_file=None) and passes the scores of every window start of a transcript
+    to write_transcript() instead.
+    """
+
+    def __init__(self, out_dir, filename, h5_file, columns=None, fmt="bedgraph", reduce="mean", window=200):
+        if fmt not in SCAN_FORMATS:
+            raise ValueError(f"unknown track format {fmt!r}, expected one of {SCAN_FORMATS}")
+        if reduce not in SCAN_REDUCTIONS:
+            raise ValueError(f"unknown reduction {reduce!r}, expected one of {SCAN_REDUCTIONS}")
+        scan_dir = make_directory(out_dir, "out/scan")
+        self.columns = None if columns is None else list(columns)
+        self.fmt = fmt
+        self.reduce = reduce
+        self.window = window
+        self.rows = 0
+        self.transcripts = 0
+        self._seen = set()
+        self._current = None
+        self._closed = False
+        self._zip = None
+        self._files = []
+        self._h5 = None if h5_file is None else h5py.File(h5_file, "r")
+        self.total = 0 if h5_file is None else len(self._h5["rna_names"])
+
+        if fmt == "npz":
+            self.paths = [os.path.join(scan_dir, filename + ".npz")]
+            self._zip = zipfile.ZipFile(self.paths[0] + ".tmp", "w", compression=zipfile.ZIP_DEFLATED, allowZip64=True)
+            if self.columns is not None:
+                self._write_npy("__columns__", np.array(self.columns))
+        else:
+            names = [filename] if self.columns is None else [f"{filename}_{column}" for column in self.columns]
+            self.paths = [os.path.join(scan_dir, name + ".bedgraph") for name in names]
+            self._files = [open(path + ".tmp", "w") for path in self.paths]
+            for name, f in zip(names, self._files):
+                f.write(f'track type=bedGraph name="{name}"\n')
+        self.path = self.paths[0] if len(self.paths) == 1 else scan_dir
+
+    def _write_npy(self, key, array):
+        with self._zip.open(key + ".npy", "w", force_zip64=True) as f:
+            np.lib.format.write_array(f, array, allow_pickle=False)
+
+    def _start(self, tid, length, n_columns):
+        if tid in self._seen:
+            raise ValueError(f"the windows of transcript {tid} are not contiguous (duplicate transcript ID?)")
+        self._seen.add(tid)
+        fill = 0.0 if self.reduce == "mean" else -np.inf
+        self._current = (tid, np.full((length, n_columns), fill), np.zeros(length, dtype=np.int64))
+
+    def _finish(self):
+        if self._current is None:
+            return
+        tid, scores, coverage = self._current
+        self._current = None
+        if self.reduce == "mean":
+            scores = scores / np.maximum(coverage, 1)[:, None]
+        scores[coverage == 0] = np.nan
+        self._write_track(tid, scores)
+
+    def _write_track(self, tid, scores):
+        scores = scores.astype(np.float32)
+        if self.fmt == "npz":
+            self._write_npy(tid, scores if self.columns is not None else scores[:, 0])
+        else:
+            for f, track in zip(self._files, scores.T):
+                self._write_bedgraph(f, tid, track)
+        self.transcripts += 1
+
+    @staticmethod
+    def _write_bedgraph(f, tid, track):
+        values = np.round(track.astype(np.float64), 6)
+        # runs of equal values become one interval; nucleotides without a window are left out
+        bounds = np.flatnonzero(~((values[1:] == values[:-1]) | (np.isnan(values[1:]) & np.isnan(values[:-1])))) + 1
+        starts = np.concatenate([[0], bounds])
+        ends = np.concatenate([bounds, [len(values)]])
+        f.write("".join(f"{tid}\t{start}\t{end}\t{values[start]:f}\n"
+                        for start, end in zip(starts, ends) if not np.isnan(values[start])))
+
+    def write(self, labels, probs):
+        """Add the results of the next rows: probabilities (B, 1) or (B, len(columns)); labels are ignored."""
+        probs = np.asarray(probs).reshape(len(labels), -1)
+        names = self._h5["rna_names"][self.rows:self.rows + len(labels)]
+        for rna_name, p in zip(names, probs):
+            if isinstance(rna_name, bytes):
+                rna_name = rna_name.decode('utf-8')
+            tid, start, end, length = parse_window_header(rna_name)
+            if self._current is None or self._current[0] != tid:
+                self._finish()
+                self._start(tid, length, len(p))
+            _, scores, coverage = self._current
+            if self.reduce == "mean":
+                scores[start - 1:end] += p
+            else:
+                np.maximum(scores[start - 1:end], p, out=scores[start - 1:end])
+            coverage[start - 1:end] += 1
+        self.rows += len(labels)
+
+    def write_transcript(self, tid, length, probs):
+        """Write the track of a whole transcript from the probabilities (S, M) of its windows starting at
+        0 .. S-1 (S = max(length - window + 1, 1), i.e. stride 1)."""
+        self._finish()
+        if tid in self._seen:
+            raise ValueError(f"transcript {tid} was already written (duplicate transcript ID?)")
+        self._seen.add(tid)
+        probs = np.asarray(probs, dtype=np.float64).reshape(max(length - self.window + 1, 1), -1)
+        n_starts = len(probs)
+        # nucleotide p is covered by the windows starting at max(p - window + 1, 0) .. min(p, S - 1)
+        position = np.arange(length)
+        lo = np.clip(position - self.window + 1, 0, n_starts)
+        hi = np.minimum(position + 1, n_starts)
+        if self.reduce == "mean":
+            cumulative = np.concatenate([np.zeros((1, probs.shape[1])), np.cumsum(probs, axis=0)])
+            scores = (cumulative[hi] - cumulative[lo]) / (hi - lo)[:, None]
+        else:
+            padded = F.pad(torch.from_numpy(probs.T[None]), (self.window - 1, self.window - 1), value=-np.inf)
+            scores = F.max_pool1d(padded, self.window, stride=1)[0].numpy().T[:length]
+        self._write_track(tid, scores)
+
+    def _close_files(self):
+        self._closed = True
+        if self._h5 is not None:
+            self._h5.close()
+        if self._zip is not None:
+            self._zip.close()
+        for f in self._files:
+            f.close()
+
+    def close(self):
+        if self._closed:
+            return
+        try:
+            self._finish()
+        except BaseException:
+            self.abort()
+            raise
+        self._close_files()
+        for path in self.paths:
+            os.replace(path + ".tmp", path)
+        print(f"{self.transcripts} transcript tracks saved to: {self.path}")
+
+    def abort(self):
+        """Close the files and remove the partial .tmp outputs, e.g. after an error during the scan."""
+        if self._closed:
+            return
+        self._current = None
+        self._close_files()
+        for path in self.paths:
+            if os.path.exists(path + ".tmp"):
+                os.remove(path + ".tmp")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()